@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Compares two benchmark result files written by ``benchmarks/run.py``::
+
+    $ python benchmarks/compare.py baseline.json results.json
+"""
+import argparse
+import json
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    return {(result['entry_point'], result['concurrency']): result for result in report['results']}
+
+
+def change(old, new):
+    if not old:
+        return ''
+    return f"{(new - old) / old * 100:+7.1f}%"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    options = parser.parse_args(argv)
+
+    baseline = load_results(options.baseline)
+    candidate = load_results(options.candidate)
+
+    print(f"{'entry point':<22} {'conc':>4}  {'p50 ms':>18}  {'p99 ms':>18}  {'req/s':>18}  {'queries':>12}")
+    for key in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[key], candidate[key]
+        print(f"{key[0]:<22} {key[1]:>4}  "
+              f"{new['latency_ms']['p50']:9.2f} {change(old['latency_ms']['p50'], new['latency_ms']['p50'])}  "
+              f"{new['latency_ms']['p99']:9.2f} {change(old['latency_ms']['p99'], new['latency_ms']['p99'])}  "
+              f"{new['throughput_rps']:9.1f} {change(old['throughput_rps'], new['throughput_rps'])}  "
+              f"{old['queries_per_call']['mean']:5.1f} -> {new['queries_per_call']['mean']:<5.1f}")
+
+    for key in sorted(set(baseline) ^ set(candidate)):
+        print(f"{key[0]:<22} {key[1]:>4}  only in {'baseline' if key in baseline else 'candidate'}")
+
+
+if __name__ == '__main__':
+    main()
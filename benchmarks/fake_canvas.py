@@ -0,0 +1,154 @@
+"""
+In-process fake Canvas for benchmarks.
+
+Serves the three endpoints the OAuth flow touches:
+
+* ``GET /login/oauth2/auth`` redirects back to ``redirect_uri`` with a code
+  (``user-<id>``) and the given state;
+* ``POST /login/oauth2/token`` performs both grant types, and returns the
+  token response including its ``user`` object;
+* ``GET /api/v1/users/self`` returns the profile of the token's owner.
+
+Every response is delayed by ``latency`` seconds (plus up to ``jitter``
+seconds), and a fraction ``error_rate`` of requests fail with a 503.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+
+class FakeCanvasHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle's algorithm
+    # the body waits on the client's delayed ACK on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        if self.server.inject_fault():
+            self.send_json(503, {'errors': [{'message': 'Service Unavailable'}]})
+            return
+        if url.path == '/login/oauth2/auth':
+            code = f"user-{next(self.server.user_ids)}"
+            location = f"{params['redirect_uri']}?{urlencode({'code': code, 'state': params.get('state', '')})}"
+            self.send_body(302, b'', headers={'Location': location})
+        elif url.path == '/api/v1/users/self':
+            token = self.headers.get('Authorization', '').replace('Bearer ', '')
+            user_id = self.server.token_owners.get(token)
+            if user_id is None:
+                self.send_json(401, {'errors': [{'message': 'Invalid access token.'}]})
+            else:
+                self.send_json(200, self.server.get_profile(user_id))
+        else:
+            self.send_json(404, {'errors': [{'message': 'The specified resource does not exist.'}]})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+        params = dict(parse_qsl(body))
+        if self.server.inject_fault():
+            self.send_json(503, {'errors': [{'message': 'Service Unavailable'}]})
+            return
+        if urlparse(self.path).path != '/login/oauth2/token':
+            self.send_json(404, {'errors': [{'message': 'The specified resource does not exist.'}]})
+            return
+
+        if params.get('grant_type') == 'authorization_code':
+            code = params.get('code', '')
+            if not code.startswith('user-'):
+                self.send_json(400, {'error': 'invalid_grant', 'error_description': 'Invalid code'})
+                return
+            user_id = int(code[len('user-'):])
+        else:
+            user_id = self.server.refresh_owners.get(params.get('refresh_token'))
+            if user_id is None:
+                self.send_json(400, {'error': 'invalid_grant', 'error_description': 'refresh_token not found'})
+                return
+        self.send_json(200, self.server.issue_token(user_id, params.get('grant_type')))
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data).encode(), headers={'Content-Type': 'application/json'})
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Rate-Limit-Remaining', '700.0')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCanvas(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__((host, port), FakeCanvasHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.user_ids = count(1)
+        self.token_owners = {}
+        self.refresh_owners = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def domain(self):
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    def inject_fault(self):
+        """Applies the injected latency; returns True if the request should fail."""
+        with self._lock:
+            self.requests += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return bool(self.error_rate) and random.random() < self.error_rate
+
+    def issue_token(self, user_id, grant_type):
+        access_token = f"access-{user_id}-{random.getrandbits(64):x}"
+        response = {
+            'access_token': access_token,
+            'token_type': 'Bearer',
+            'user': {'id': user_id, 'name': f"User {user_id}"},
+            'expires_in': 3600,
+        }
+        with self._lock:
+            self.token_owners[access_token] = user_id
+            if grant_type == 'authorization_code':
+                response['refresh_token'] = f"refresh-{user_id}-{random.getrandbits(64):x}"
+                self.refresh_owners[response['refresh_token']] = user_id
+        return response
+
+    def add_refresh_token(self, refresh_token, user_id):
+        with self._lock:
+            self.refresh_owners[refresh_token] = user_id
+
+    def get_profile(self, user_id):
+        return {
+            'id': user_id,
+            'name': f"User {user_id}",
+            'sortable_name': f"{user_id}, User",
+            'short_name': f"User {user_id}",
+            'email': f"user{user_id}@example.edu",
+            'avatar_url': f"https://example.edu/avatars/{user_id}.png",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
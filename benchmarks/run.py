@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Benchmarks the canvas_oauth entry points against an in-process fake Canvas.
+
+Each entry point is called --requests times at every --concurrency level,
+recording latency percentiles, throughput, database queries per call and
+errors.  Results are written as JSON, and two runs can be compared with
+``benchmarks/compare.py``::
+
+    $ python benchmarks/run.py --concurrency 1 4 16 --latency 0.02 --output results.json
+    $ python benchmarks/compare.py baseline.json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import count
+from urllib.parse import parse_qs, urlparse
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from fake_canvas import FakeCanvas  # noqa: E402
+
+ENTRY_POINTS = ['get_oauth_token', 'handle_missing_token', 'oauth_callback', 'refresh_oauth_token']
+
+
+def configure(domain, db_path, options):
+    database_options = {'timeout': 30}
+    if django.VERSION >= (5, 1):
+        # Take the write lock when a transaction starts, so writers wait out
+        # the busy timeout instead of failing to upgrade a read lock
+        database_options['transaction_mode'] = 'IMMEDIATE'
+    settings.configure(
+        SECRET_KEY='benchmark',
+        ALLOWED_HOSTS=['*'],
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'canvas_oauth.apps.CanvasOAuthConfig',
+        ],
+        ROOT_URLCONF='canvas_oauth.urls',
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': db_path,
+            'OPTIONS': database_options,
+        }},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        USE_TZ=True,
+        CANVAS_OAUTH_CLIENT_ID='benchmark-client',
+        CANVAS_OAUTH_CLIENT_SECRET='benchmark-secret',
+        CANVAS_OAUTH_CANVAS_DOMAIN=domain,
+        CANVAS_OAUTH_HTTP_SCHEME='http',
+        CANVAS_OAUTH_TOKEN_CACHE_ENABLED=options.token_cache,
+        CANVAS_OAUTH_STATELESS_STATE=options.stateless_state,
+        CANVAS_OAUTH_PROFILE_UPDATER=options.profile_updater,
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import connection
+    # WAL mode is kept in the database file: readers no longer block the
+    # writer, or each other
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL')
+    call_command('migrate', verbosity=0)
+
+
+class Scenario(object):
+    """An entry point to benchmark.  `prepare` is not timed, `call` is."""
+
+    def __init__(self, fake_canvas):
+        self.fake_canvas = fake_canvas
+
+    def setup(self, requests):
+        pass
+
+    def prepare(self, i):
+        return None
+
+    def call(self, args):
+        raise NotImplementedError
+
+    def get_request(self, path='/index', data=None, user_id=None):
+        from django.contrib.auth.models import AnonymousUser
+        from django.contrib.sessions.backends.signed_cookies import SessionStore
+        from django.test.client import RequestFactory
+
+        request = RequestFactory().get(path, data or {})
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        if user_id is not None:
+            request.session['user_id'] = str(user_id)
+        return request
+
+    def create_tokens(self, user_ids, expires):
+        from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+
+        tokens = []
+        for user_id in user_ids:
+            canvas_user, _ = CanvasUser.objects.get_or_create(
+                canvas_user_id=str(user_id), canvas_domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+                defaults={'name': f"User {user_id}"})
+            refresh_token = f"refresh-{user_id}"
+            self.fake_canvas.add_refresh_token(refresh_token, user_id)
+            oauth_token, _ = CanvasOAuth2Token.objects.update_or_create(
+                user=canvas_user, canvas_domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+                defaults={'access_token': f"access-{user_id}", 'refresh_token': refresh_token,
+                          'expires': expires})
+            tokens.append(oauth_token)
+        return tokens
+
+
+class GetOauthToken(Scenario):
+    pool_size = 100
+
+    def setup(self, requests):
+        from django.utils import timezone
+        self.create_tokens(range(1, self.pool_size + 1), timezone.now() + timedelta(hours=1))
+
+    def prepare(self, i):
+        return self.get_request(user_id=i % self.pool_size + 1)
+
+    def call(self, request):
+        from canvas_oauth.oauth import get_oauth_token
+        get_oauth_token(request)
+
+
+class HandleMissingToken(Scenario):
+
+    def prepare(self, i):
+        return self.get_request('/index', {'user_id': i})
+
+    def call(self, request):
+        from canvas_oauth.oauth import handle_missing_token
+        handle_missing_token(request)
+
+
+class OauthCallback(Scenario):
+    user_ids = count(1000000)
+
+    def prepare(self, i):
+        from canvas_oauth.oauth import handle_missing_token
+
+        request = self.get_request('/index')
+        state = parse_qs(urlparse(handle_missing_token(request).url).query)['state'][0]
+        callback_request = self.get_request(
+            '/oauth/oauth-callback', {'code': f"user-{next(self.user_ids)}", 'state': state})
+        callback_request.session = request.session
+        return callback_request
+
+    def call(self, request):
+        from canvas_oauth.oauth import oauth_callback
+        response = oauth_callback(request)
+        if response.status_code != 302:
+            raise RuntimeError(f"Callback returned {response.status_code}")
+
+
+class RefreshOauthToken(Scenario):
+    user_ids = count(2000000)
+
+    def setup(self, requests):
+        from django.utils import timezone
+        # Each call refreshes its own expired token
+        user_ids = [next(self.user_ids) for _ in range(requests)]
+        self.tokens = self.create_tokens(user_ids, timezone.now() - timedelta(minutes=1))
+
+    def prepare(self, i):
+        from canvas_oauth.models import CanvasOAuth2Token
+        return (self.get_request(), CanvasOAuth2Token.objects.select_related('user').get(pk=self.tokens[i].pk))
+
+    def call(self, args):
+        from canvas_oauth.oauth import refresh_oauth_token
+        refresh_oauth_token(*args)
+
+
+SCENARIOS = {
+    'get_oauth_token': GetOauthToken,
+    'handle_missing_token': HandleMissingToken,
+    'oauth_callback': OauthCallback,
+    'refresh_oauth_token': RefreshOauthToken,
+}
+
+
+def run_call(scenario, i):
+    from django.db import DatabaseError, close_old_connections, connection
+
+    args = scenario.prepare(i)
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    error = None
+    with connection.execute_wrapper(count_queries):
+        started = time.perf_counter()
+        try:
+            scenario.call(args)
+        except DatabaseError as e:
+            # A harness problem rather than a result, see `run_level`
+            error = f"db:{type(e).__name__}"
+        except Exception as e:
+            error = type(e).__name__
+        elapsed = time.perf_counter() - started
+    close_old_connections()
+    return elapsed, queries, error
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_level(scenario, entry_point, concurrency, requests):
+    scenario.setup(requests)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: run_call(scenario, i), range(requests)))
+    wall_time = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in results)
+    queries = [query_count for _, query_count, _ in results]
+    errors = {}
+    for _, _, error in results:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    # Database errors come from the benchmark's own database, not from the
+    # library or injected Canvas faults, so they are counted apart
+    db_errors = sum(n for error, n in errors.items() if error.startswith('db:'))
+    return {
+        'entry_point': entry_point,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': sum(errors.values()) - db_errors,
+        'db_errors': db_errors,
+        'error_types': errors,
+        'wall_time_s': round(wall_time, 4),
+        'throughput_rps': round(requests / wall_time, 2) if wall_time else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'p50': round(percentile(latencies, 50), 3),
+            'p90': round(percentile(latencies, 90), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3),
+        },
+        'queries_per_call': {
+            'mean': round(sum(queries) / len(queries), 2),
+            'max': max(queries),
+        },
+    }
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entry-points', nargs='+', choices=ENTRY_POINTS, default=ENTRY_POINTS)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=200, help="Calls per entry point and concurrency level")
+    parser.add_argument('--latency', type=float, default=0.0, help="Fake Canvas latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra random fake Canvas latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of fake Canvas requests that fail")
+    parser.add_argument('--token-cache', action='store_true', help="Enable CANVAS_OAUTH_TOKEN_CACHE_ENABLED")
+    parser.add_argument('--stateless-state', action='store_true', help="Enable CANVAS_OAUTH_STATELESS_STATE")
+    parser.add_argument('--profile-updater', default='canvas_oauth.profile.ThreadPoolProfileUpdater')
+    parser.add_argument('--output', default='benchmark-results.json')
+    options = parser.parse_args(argv)
+
+    fake_canvas = FakeCanvas(latency=options.latency, jitter=options.jitter, error_rate=options.error_rate).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            configure(fake_canvas.domain, os.path.join(tmpdir, 'benchmark.sqlite3'), options)
+
+            results = []
+            for entry_point in options.entry_points:
+                scenario = SCENARIOS[entry_point](fake_canvas)
+                for concurrency in options.concurrency:
+                    result = run_level(scenario, entry_point, concurrency, options.requests)
+                    results.append(result)
+                    print(f"{entry_point:<22} c={concurrency:<3} "
+                          f"p50={result['latency_ms']['p50']:8.2f}ms p99={result['latency_ms']['p99']:8.2f}ms "
+                          f"{result['throughput_rps']:9.1f} req/s "
+                          f"{result['queries_per_call']['mean']:5.1f} queries/call "
+                          f"{result['errors']} errors ({result['db_errors']} database errors)")
+    finally:
+        fake_canvas.stop()
+
+    report = {
+        'metadata': {
+            'timestamp': datetime.now(dt_timezone.utc).isoformat(),
+            'git_revision': get_git_revision(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'options': vars(options),
+        },
+        'results': results,
+    }
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {options.output}")
+
+
+if __name__ == '__main__':
+    main()
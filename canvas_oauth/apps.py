@@ -1,8 +1,17 @@
 
 
 from django.apps import AppConfig
+from django.core.signals import setting_changed
 
 
 class CanvasOAuthConfig(AppConfig):
     name = 'canvas_oauth'
     verbose_name = 'Django Canvas OAuth'
+
+    def ready(self):
+        from canvas_oauth import settings as oauth_settings
+
+        oauth_settings.build_credentials_index()
+        # Held strongly, so the receiver survives the settings module being
+        # reloaded
+        setting_changed.connect(oauth_settings.reset_caches, weak=False)
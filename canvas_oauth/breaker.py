@@ -0,0 +1,205 @@
+"""
+Per-domain circuit breaker for the Canvas token endpoint.
+
+When a Canvas instance's ``/login/oauth2/token`` fails or times out
+CANVAS_OAUTH_BREAKER_FAILURE_THRESHOLD times in a row, its circuit opens and
+grant requests to it fail fast with `CircuitOpenError` instead of tying up a
+worker each.  After CANVAS_OAUTH_BREAKER_RESET_TIMEOUT seconds the circuit
+is half open: a single probe request is let through, which closes the
+circuit if it succeeds and opens it again if it fails.
+
+Only failures of Canvas count: transport errors, timeouts, 5xx responses and
+429s.  Canvas answering a grant with an error (e.g. ``invalid_grant``) is a
+success as far as the breaker is concerned.  Each process has its own
+breakers; `get_breaker_states` reports them, and the state of each domain's
+circuit is recorded in the ``canvas_oauth_breaker_state`` gauge.
+"""
+import logging
+import threading
+import time
+
+from canvas_oauth import metrics
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.exceptions import CanvasOAuthError, CircuitOpenError, DeadlineExceededError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+
+# Values of the canvas_oauth_breaker_state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker(object):
+    """Thread-safe circuit breaker for one Canvas domain."""
+
+    def __init__(self, domain, failure_threshold=None, reset_timeout=None):
+        self.domain = domain
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._state = CLOSED
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def failure_threshold(self):
+        return self._failure_threshold or oauth_settings.CANVAS_OAUTH_BREAKER_FAILURE_THRESHOLD
+
+    @property
+    def reset_timeout(self):
+        return self._reset_timeout or oauth_settings.CANVAS_OAUTH_BREAKER_RESET_TIMEOUT
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._get_state()
+
+    def _get_state(self):
+        if self._state == OPEN and time.monotonic() >= self.opened_at + self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def is_open(self):
+        """True while requests are rejected, i.e. open and not due for a probe."""
+        return self.state == OPEN
+
+    def before_call(self):
+        """Raises CircuitOpenError unless a request may be made now."""
+        with self._lock:
+            state = self._get_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                logger.info("Probing the token endpoint of %s", self.domain)
+                self._probing = True
+                self._set_state(HALF_OPEN)
+                return
+        metrics.increment(metrics.BREAKER_REJECTIONS, domain=self.domain)
+        raise CircuitOpenError("The token endpoint of %s is unavailable" % self.domain)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self._state != CLOSED:
+                logger.info("Closing the circuit of %s", self.domain)
+                self.opened_at = None
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # Requests made before the circuit opened may still fail afterwards
+            if self._probing or (self._state == CLOSED and self.failures >= self.failure_threshold):
+                logger.warning("Opening the circuit of %s after %s failures", self.domain, self.failures)
+                self._probing = False
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def release(self):
+        """Ends a probe that was abandoned, e.g. cancelled, without a result."""
+        with self._lock:
+            self._probing = False
+
+    def _set_state(self, state):
+        self._state = state
+        metrics.set_gauge(metrics.BREAKER_STATE, STATE_VALUES[state], domain=self.domain)
+
+    def guard(self):
+        """
+        Returns a context manager for one request to the token endpoint.
+        Set `failed` on it if the request got an unavailable response.
+        """
+        return _Guard(self)
+
+    def get_state(self):
+        with self._lock:
+            state = self._get_state()
+            retry_in = None
+            if self._state == OPEN:
+                retry_in = max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+            return {'state': state, 'failures': self.failures, 'retry_in': retry_in}
+
+
+class _Guard(object):
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.failed = False
+
+    def __enter__(self):
+        self.breaker.before_call()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Requests abandoned, or not made for lack of time, say nothing of Canvas
+        if exc_type is not None and (not issubclass(exc_type, Exception)
+                                     or issubclass(exc_type, DeadlineExceededError)):
+            self.breaker.release()
+        elif self.failed or (exc_type is not None and not issubclass(exc_type, CanvasOAuthError)):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return False
+
+
+class _NoBreaker(object):
+    """Stands in for a breaker when CANVAS_OAUTH_BREAKER_ENABLED is off."""
+
+    def is_open(self):
+        return False
+
+    def guard(self):
+        return _NoGuard()
+
+
+class _NoGuard(object):
+    failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def is_unavailable(response):
+    """True if the response means Canvas could not handle the request."""
+    return response.status_code >= 500 or response.status_code == 429
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(domain):
+    """Returns the process's circuit breaker for the domain's token endpoint."""
+    if not oauth_settings.CANVAS_OAUTH_BREAKER_ENABLED:
+        return _NoBreaker()
+    breaker = _breakers.get(domain)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(domain, CircuitBreaker(domain))
+    return breaker
+
+
+def get_breaker_states():
+    """
+    Returns the state of every domain's circuit in this process, as
+    ``{domain: {'state': ..., 'failures': ..., 'retry_in': ...}}``, where
+    `retry_in` is the number of seconds until an open circuit lets a probe
+    through.
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.domain: breaker.get_state() for breaker in breakers}
+
+
+def reset_breakers():
+    """Forgets every circuit breaker, closing all circuits."""
+    with _breakers_lock:
+        _breakers.clear()
@@ -4,13 +4,17 @@ from datetime import timedelta
 import requests
 from django.utils import timezone
 
-from canvas_oauth.exceptions import InvalidOAuthReturnError
+from canvas_oauth import metrics, signals
+from canvas_oauth.breaker import get_circuit_breaker, is_unavailable
+from canvas_oauth.client import get_async_client, get_client
+from canvas_oauth.exceptions import InvalidGrantError, InvalidOAuthReturnError
+from canvas_oauth.models import CanvasOAuth2Token
 from canvas_oauth.settings import get_canvas_credentials
 
 logger = logging.getLogger(__name__)
 
 AUTHORIZE_URL_PATTERN = "https://%s/login/oauth2/auth"
-ACCESS_TOKEN_URL_PATTERN = "https://%s/login/oauth2/token"
+ACCESS_TOKEN_PATH = "/login/oauth2/token"
 
 
 def get_oauth_login_url(domain, redirect_uri, response_type='code',
@@ -42,7 +46,7 @@ def get_oauth_login_url(domain, redirect_uri, response_type='code',
 
 
 def get_access_token(domain, grant_type, redirect_uri,
-                     code=None, refresh_token=None):
+                     code=None, refresh_token=None, include_user=False):
     """Performs one of the two grant types supported by Canvas' OAuth endpoint to
     to retrieve an access token.  Expect a `code` kwarg when performing an
     `authorization_code` grant; otherwise, assume we're doing a `refresh_token`
@@ -54,17 +58,65 @@ def get_access_token(domain, grant_type, redirect_uri,
         redirect_uri: OAuth redirect URI
         code: Authorization code (required for 'authorization_code' grant)
         refresh_token: Refresh token (required for 'refresh_token' grant)
+        include_user: Also return the `user` object (id and name) of the
+            token response, or None if it has none
 
     Returns:
-        tuple: (access_token, expiration_datetime, refresh_token)
+        tuple: (access_token, expiration_datetime, refresh_token), followed
+        by the token response's user when `include_user` is set
 
     Raises:
         InvalidOAuthReturnError: If the OAuth request fails
+        CircuitOpenError: If the circuit breaker of the domain's token
+            endpoint is open (see `canvas_oauth.breaker`)
     """
+    post_params = _get_access_token_params(
+        domain, grant_type, redirect_uri, code=code, refresh_token=refresh_token)
+    with get_circuit_breaker(domain).guard() as guard, \
+            metrics.timer(metrics.TOKEN_GRANT_SECONDS, grant_type=grant_type, domain=domain) as grant_timer:
+        r = get_client().post(domain, ACCESS_TOKEN_PATH, data=post_params,
+                              idempotent=_is_idempotent(grant_type), hedge=True)
+        guard.failed = is_unavailable(r)
+        token = _parse_access_token_response(grant_type, r, include_user=include_user)
+    _access_token_granted(domain, grant_type, grant_timer.elapsed)
+    return token
+
+
+async def aget_access_token(domain, grant_type, redirect_uri,
+                            code=None, refresh_token=None, include_user=False):
+    """Async version of `get_access_token`, using the non-blocking client
+    from `canvas_oauth.client.get_async_client`.
+    """
+    post_params = _get_access_token_params(
+        domain, grant_type, redirect_uri, code=code, refresh_token=refresh_token)
+    # Unlike requests, httpx sends None values as empty strings
+    post_params = {key: value for key, value in post_params.items() if value is not None}
+    with get_circuit_breaker(domain).guard() as guard, \
+            metrics.timer(metrics.TOKEN_GRANT_SECONDS, grant_type=grant_type, domain=domain) as grant_timer:
+        r = await get_async_client().post(domain, ACCESS_TOKEN_PATH, data=post_params,
+                                          idempotent=_is_idempotent(grant_type), hedge=True)
+        guard.failed = is_unavailable(r)
+        token = _parse_access_token_response(grant_type, r, include_user=include_user)
+    _access_token_granted(domain, grant_type, grant_timer.elapsed)
+    return token
+
+
+def _is_idempotent(grant_type):
+    # Refresh tokens can be used any number of times, so refresh grants may be
+    # retried and hedged; authorization codes can only be used once
+    return grant_type == 'refresh_token'
+
+
+def _access_token_granted(domain, grant_type, duration):
+    signals.access_token_granted.send(
+        sender=CanvasOAuth2Token, domain=domain, grant_type=grant_type, duration=duration)
+
+
+def _get_access_token_params(domain, grant_type, redirect_uri,
+                             code=None, refresh_token=None):
     client_id, client_secret, _ = get_canvas_credentials(domain)
 
     # Call Canvas endpoint
-    oauth_token_url = ACCESS_TOKEN_URL_PATTERN % domain
     post_params = {
         'grant_type': grant_type,  # Use 'authorization_code' for new tokens
         'client_id': client_id,
@@ -78,9 +130,22 @@ def get_access_token(domain, grant_type, redirect_uri,
     else:
         post_params['refresh_token'] = refresh_token
 
-    r = requests.post(oauth_token_url, post_params)
+    return post_params
+
+
+def _get_oauth_error(r):
+    try:
+        return r.json().get('error')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _parse_access_token_response(grant_type, r, include_user=False):
     logger.info("%s POST response from Canvas is %s", grant_type, r.text)
     if r.status_code != 200:
+        if _get_oauth_error(r) == 'invalid_grant':
+            raise InvalidGrantError("%s request failed to get a token: %s" % (
+                grant_type, r.text))
         raise InvalidOAuthReturnError("%s request failed to get a token: %s" % (
             grant_type, r.text))
 
@@ -98,4 +163,6 @@ def get_access_token(domain, grant_type, redirect_uri,
     if 'refresh_token' in response_data:
         refresh_token = response_data['refresh_token']
 
+    if include_user:
+        return (access_token, expires, refresh_token, response_data.get('user'))
     return (access_token, expires, refresh_token)
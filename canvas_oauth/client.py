@@ -0,0 +1,512 @@
+"""
+Pooled HTTP client for Canvas.
+
+Every Canvas-facing call in this package goes through a CanvasClient, which
+keeps one keep-alive ``requests.Session`` per Canvas domain so repeated calls
+reuse TCP/TLS connections instead of paying a new handshake each time.
+Applications can share the same connection pools through ``get_client()``.
+``CanvasClient.get_json`` can revalidate cached responses with conditional
+requests (see ``canvas_oauth.response_cache``).
+``AsyncCanvasClient`` (``get_async_client()``) is the non-blocking
+counterpart for ASGI deployments and requires the optional ``httpx``
+dependency.
+
+Timeouts are capped by the current deadline (see ``canvas_oauth.deadline``).
+Idempotent requests that fail with a connection error or a 502, 503 or 504
+are retried with jittered exponential backoff while the deadline allows, and
+may be hedged: if no response has arrived after CANVAS_OAUTH_HTTP_HEDGE_DELAY
+seconds, a second request is sent and the first response is used.
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import urlsplit
+
+import requests
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
+
+from canvas_oauth import deadline, metrics
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.ratelimit import get_rate_limit_scheduler
+from canvas_oauth.response_cache import CachedResponse, get_owner, get_response_cache
+
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# Responses to idempotent requests that are worth retrying
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class BaseCanvasClient(object):
+
+    def __init__(self, pool_maxsize=None, timeout=None, keep_alive=None, scheme=None,
+                 retries=None, backoff=None, hedge_delay=None):
+        self.pool_maxsize = pool_maxsize or oauth_settings.CANVAS_OAUTH_HTTP_POOL_MAXSIZE
+        self.timeout = timeout or oauth_settings.CANVAS_OAUTH_HTTP_TIMEOUT
+        self.keep_alive = oauth_settings.CANVAS_OAUTH_HTTP_KEEP_ALIVE if keep_alive is None else keep_alive
+        self.scheme = scheme or oauth_settings.CANVAS_OAUTH_HTTP_SCHEME
+        self.retries = oauth_settings.CANVAS_OAUTH_HTTP_RETRIES if retries is None else retries
+        self.backoff = oauth_settings.CANVAS_OAUTH_HTTP_BACKOFF if backoff is None else backoff
+        self.hedge_delay = oauth_settings.CANVAS_OAUTH_HTTP_HEDGE_DELAY if hedge_delay is None else hedge_delay
+
+    def build_url(self, domain, path):
+        """
+        Returns the URL of `path` on the Canvas domain.  Full URLs (such as
+        those of `Link` headers) must be on the domain, with the client's
+        scheme, so access tokens are never sent anywhere else.
+        """
+        if path.startswith(('https://', 'http://')):
+            url = urlsplit(path)
+            if url.scheme != self.scheme or url.netloc.lower() != domain.lower():
+                raise ValueError(f"Refusing to send a Canvas request for {domain} to {url.scheme}://{url.netloc}")
+            return path
+        return f"{self.scheme}://{domain}{path}"
+
+    def get_headers(self, access_token, headers=None):
+        headers = dict(headers or {})
+        if access_token is not None:
+            headers['Authorization'] = f"Bearer {access_token}"
+        return headers
+
+    def get_retry_delay(self, attempt):
+        """
+        Returns how long to wait before retry number `attempt` (from 0), or
+        None if the request should not be retried.  The delay is drawn
+        between 0 and an exponentially growing cap ("full jitter"), and a
+        retry that could not start before the deadline is not made.
+        """
+        if attempt >= self.retries:
+            return None
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        remaining = deadline.get_remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
+
+
+class CanvasClient(BaseCanvasClient):
+    """
+    Thread-safe client with a per-domain pool of keep-alive connections and a
+    default timeout for every request.
+    """
+
+    def __init__(self, *args, rate_limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+        self._sessions = {}
+        self._hedge_executor = None
+        self._lock = threading.Lock()
+
+    def get_session(self, domain):
+        """Returns the session (and connection pool) used for a Canvas domain."""
+        session = self._sessions.get(domain)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(domain)
+                if session is None:
+                    session = self._sessions[domain] = self._create_session()
+        return session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def request(self, method, domain, path, access_token=None, idempotent=None, hedge=False, **kwargs):
+        """
+        Makes a request against a Canvas domain.  `path` may be an absolute
+        path (e.g. '/api/v1/users/self') or a full URL on that domain.  When
+        `access_token` is given it is sent as a bearer token.
+
+        GET, HEAD, OPTIONS, PUT and DELETE requests are retried on
+        connection errors and 502, 503 and 504 responses; pass `idempotent`
+        to decide for other methods.  With `hedge`, a slow idempotent
+        request is raced against a second one (see CANVAS_OAUTH_HTTP_HEDGE_DELAY).
+        """
+        timeout = kwargs.pop('timeout', self.timeout)
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        hedge = bool(idempotent and hedge and self.hedge_delay)
+        attempt = 0
+        while True:
+            kwargs['timeout'] = deadline.get_timeout(timeout)
+            try:
+                response = self._send(method, domain, path, access_token, hedge, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = self.get_retry_delay(attempt) if idempotent else None
+                if delay is None:
+                    raise
+                reason = type(e).__name__
+            else:
+                if response.status_code not in RETRY_STATUSES or not idempotent:
+                    return response
+                delay = self.get_retry_delay(attempt)
+                if delay is None:
+                    return response
+                response.close()
+                reason = str(response.status_code)
+            metrics.increment(metrics.HTTP_RETRIES, domain=domain, reason=reason)
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, method, domain, path, access_token, hedge, **kwargs):
+        url = self.build_url(domain, path)
+        if access_token is None:
+            return self._send_once(method, domain, url, hedge, **kwargs)
+
+        kwargs['headers'] = self.get_headers(access_token, kwargs.pop('headers', None))
+        rate_limiter = self.get_rate_limiter()
+        if rate_limiter is None:
+            return self._send_once(method, domain, url, hedge, **kwargs)
+
+        with rate_limiter.slot(domain, access_token):
+            response = self._send_once(method, domain, url, hedge, **kwargs)
+        rate_limiter.record(domain, access_token, response)
+        return response
+
+    def _send_once(self, method, domain, url, hedge, **kwargs):
+        session = self.get_session(domain)
+        if not hedge:
+            return session.request(method, url, **kwargs)
+
+        executor = self._get_hedge_executor()
+        first = executor.submit(session.request, method, url, **kwargs)
+        try:
+            return first.result(timeout=self.hedge_delay)
+        except FutureTimeoutError:
+            pass
+        metrics.increment(metrics.HEDGED_REQUESTS, domain=domain)
+        second = executor.submit(session.request, method, url, **kwargs)
+        return _get_first_response([first, second])
+
+    def _get_hedge_executor(self):
+        if self._hedge_executor is None:
+            with self._lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = ThreadPoolExecutor(
+                        max_workers=self.pool_maxsize, thread_name_prefix='canvas-oauth-hedge')
+        return self._hedge_executor
+
+    def get_rate_limiter(self):
+        """
+        Returns the scheduler pacing API requests made with an access token:
+        the one given to the client, or else the shared one.
+        """
+        if self.rate_limiter is not None:
+            return self.rate_limiter
+        return get_rate_limit_scheduler()
+
+    def get(self, domain, path, access_token=None, **kwargs):
+        return self.request('GET', domain, path, access_token=access_token, **kwargs)
+
+    def post(self, domain, path, access_token=None, **kwargs):
+        return self.request('POST', domain, path, access_token=access_token, **kwargs)
+
+    def get_json(self, domain, path, access_token=None, owner=None, params=None, **kwargs):
+        """
+        GETs a Canvas API resource and returns its decoded JSON body, raising
+        for error responses.  If the response cache is enabled, bodies with
+        an ETag or Last-Modified header are cached per `owner` and URL, and
+        revalidated with a conditional request on subsequent calls.  The
+        owner defaults to a hash of the access token, which changes on every
+        refresh; pass a stable one (see `response_cache.get_user_owner`)
+        where the Canvas user is known.
+        """
+        response_cache = get_response_cache()
+        if response_cache is None:
+            response = self.get(domain, path, access_token=access_token, params=params, **kwargs)
+            response.raise_for_status()
+            return response.json()
+
+        key = response_cache.make_key(self._get_cache_owner(access_token, owner),
+                                      self._get_cache_url(domain, path, params))
+        entry = response_cache.get(key)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        response = self.get(domain, path, access_token=access_token, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            return json.loads(entry.content)
+        response.raise_for_status()
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if (etag or last_modified) and 'no-store' not in response.headers.get('Cache-Control', ''):
+            response_cache.set(key, CachedResponse(etag, last_modified, response.content))
+        elif entry is not None:
+            response_cache.delete(key)
+        return response.json()
+
+    def invalidate(self, domain, path, access_token=None, owner=None, params=None):
+        """
+        Drops the cached response for a resource, e.g. after writing to it.
+        A no-op if the response cache is disabled.
+        """
+        response_cache = get_response_cache()
+        if response_cache is not None:
+            response_cache.delete(response_cache.make_key(self._get_cache_owner(access_token, owner),
+                                                          self._get_cache_url(domain, path, params)))
+
+    def _get_cache_owner(self, access_token, owner):
+        if owner is not None:
+            return owner
+        return get_owner(access_token) if access_token is not None else 'anonymous'
+
+    def _get_cache_url(self, domain, path, params):
+        return requests.Request('GET', self.build_url(domain, path), params=params).prepare().url
+
+    def paginate(self, domain, path, access_token=None, params=None, per_page=100,
+                 prefetch=True, data_key=None, **kwargs):
+        """
+        Lazily yields the items of a paginated Canvas API list endpoint,
+        following `Link: rel="next"` headers.  Each page is decoded one item
+        at a time, so memory use is bounded by a page rather than the whole
+        collection.  With `prefetch`, the next page is fetched in the
+        background while the current one is consumed (holding at most two
+        pages).  For endpoints that wrap the list in an object, pass the
+        object key as `data_key`.
+        """
+        params = dict(params or {})
+        params.setdefault('per_page', per_page)
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            response = self._get_page(domain, path, access_token, params, **kwargs)
+            while response is not None:
+                next_url = response.links.get('next', {}).get('url')
+                next_page = None
+                if next_url and executor is not None:
+                    next_page = executor.submit(self._get_page, domain, next_url, access_token, None, **kwargs)
+
+                if data_key is None:
+                    yield from iter_json_array(response.text)
+                else:
+                    yield from response.json()[data_key]
+                # Drop the consumed page before waiting on the next one
+                response = None
+
+                if next_page is not None:
+                    response = next_page.result()
+                elif next_url:
+                    response = self._get_page(domain, next_url, access_token, None, **kwargs)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _get_page(self, domain, url, access_token, params, **kwargs):
+        response = self.get(domain, url, access_token=access_token, params=params, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+            hedge_executor, self._hedge_executor = self._hedge_executor, None
+        if hedge_executor is not None:
+            hedge_executor.shutdown(wait=False)
+        for session in sessions.values():
+            session.close()
+
+
+def _get_first_response(futures):
+    """
+    Returns the response of the first of `futures` to succeed, or raises
+    the error of the last one if all fail.  Other responses are closed.
+    """
+    pending = set(futures)
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        succeeded = [future for future in done if future.exception() is None]
+        if succeeded or not pending:
+            for future in pending:
+                future.add_done_callback(_close_response)
+            for future in succeeded[1:]:
+                _close_response(future)
+            if not succeeded:
+                raise done.pop().exception()
+            return succeeded[0].result()
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(text):
+    """
+    Yields the items of a JSON array document one at a time, without
+    building the full list in memory.
+    """
+    index = _json_whitespace.match(text, 0).end()
+    if text[index:index + 1] != '[':
+        raise ValueError("Expected a JSON array")
+    index = _json_whitespace.match(text, index + 1).end()
+    if text[index:index + 1] == ']':
+        return
+    while True:
+        item, index = _json_decoder.raw_decode(text, index)
+        yield item
+        index = _json_whitespace.match(text, index).end()
+        separator = text[index:index + 1]
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(f"Expected ',' or ']' at position {index}")
+        index = _json_whitespace.match(text, index + 1).end()
+
+
+class AsyncCanvasClient(BaseCanvasClient):
+    """
+    Non-blocking client built on ``httpx.AsyncClient``.  Connection pools are
+    kept per event loop and Canvas domain, since httpx clients cannot be
+    shared between event loops.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def get_session(self, domain):
+        sessions = self._sessions.setdefault(asyncio.get_running_loop(), {})
+        session = sessions.get(domain)
+        if session is None:
+            session = sessions[domain] = self._create_session()
+        return session
+
+    def _create_session(self):
+        httpx = _import_httpx()
+        limits = httpx.Limits(
+            max_connections=self.pool_maxsize,
+            max_keepalive_connections=self.pool_maxsize if self.keep_alive else 0)
+        return httpx.AsyncClient(limits=limits, timeout=self._get_timeout(self.timeout))
+
+    def _get_timeout(self, timeout):
+        httpx = _import_httpx()
+        if isinstance(timeout, (tuple, list)):
+            connect, read = timeout
+            return httpx.Timeout(read, connect=connect)
+        return httpx.Timeout(timeout)
+
+    async def request(self, method, domain, path, access_token=None, idempotent=None, hedge=False, **kwargs):
+        """Async version of `CanvasClient.request`."""
+        httpx = _import_httpx()
+        timeout = kwargs.pop('timeout', None)
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        hedge = bool(idempotent and hedge and self.hedge_delay)
+        if access_token is not None:
+            kwargs['headers'] = self.get_headers(access_token, kwargs.pop('headers', None))
+        url = self.build_url(domain, path)
+        attempt = 0
+        while True:
+            # Without a deadline or a timeout, the session's default timeout applies
+            if timeout is not None or deadline.get_remaining() is not None:
+                kwargs['timeout'] = self._get_timeout(
+                    deadline.get_timeout(self.timeout if timeout is None else timeout))
+            try:
+                response = await self._send_once(method, domain, url, hedge, **kwargs)
+            except httpx.TransportError as e:
+                delay = self.get_retry_delay(attempt) if idempotent else None
+                if delay is None:
+                    raise
+                reason = type(e).__name__
+            else:
+                if response.status_code not in RETRY_STATUSES or not idempotent:
+                    return response
+                delay = self.get_retry_delay(attempt)
+                if delay is None:
+                    return response
+                await response.aclose()
+                reason = str(response.status_code)
+            metrics.increment(metrics.HTTP_RETRIES, domain=domain, reason=reason)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _send_once(self, method, domain, url, hedge, **kwargs):
+        session = self.get_session(domain)
+        if not hedge:
+            return await session.request(method, url, **kwargs)
+
+        tasks = [asyncio.ensure_future(session.request(method, url, **kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                metrics.increment(metrics.HEDGED_REQUESTS, domain=domain)
+                tasks.append(asyncio.ensure_future(session.request(method, url, **kwargs)))
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    for task in succeeded[1:]:
+                        await task.result().aclose()
+                    return succeeded[0].result()
+                if not pending:
+                    raise done.pop().exception()
+        finally:
+            # The slower request is abandoned
+            for task in tasks:
+                task.cancel()
+
+    async def get(self, domain, path, access_token=None, **kwargs):
+        return await self.request('GET', domain, path, access_token=access_token, **kwargs)
+
+    async def post(self, domain, path, access_token=None, **kwargs):
+        return await self.request('POST', domain, path, access_token=access_token, **kwargs)
+
+    async def aclose(self):
+        sessions = self._sessions.pop(asyncio.get_running_loop(), {})
+        for session in sessions.values():
+            await session.aclose()
+
+
+def _import_httpx():
+    try:
+        import httpx
+    except ImportError:
+        raise ImproperlyConfigured(
+            "httpx is required for async Canvas requests; install canvas-oauth[async]")
+    return httpx
+
+
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the shared CanvasClient used by canvas_oauth."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = CanvasClient()
+    return _client
+
+
+def get_async_client():
+    """Returns the shared AsyncCanvasClient used by canvas_oauth."""
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncCanvasClient()
+    return _async_client
@@ -0,0 +1,60 @@
+"""
+Time budgets for Canvas calls.
+
+A deadline set with `deadline()` (by `OAuthMiddleware` for every request,
+with CANVAS_OAUTH_REQUEST_DEADLINE) caps the timeout of every Canvas call
+made inside it, including retries, so a request spends at most its budget
+waiting on Canvas however many calls it makes.  Deadlines are kept in a
+context variable, so they follow the request across async tasks but not
+into other threads.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from canvas_oauth.exceptions import DeadlineExceededError
+
+# Monotonic time by which the current request's Canvas calls must be done
+_deadline = ContextVar('canvas_oauth_deadline', default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Gives the Canvas calls made inside the block `seconds` in total, or
+    less if an enclosing deadline ends sooner.  A no-op if `seconds` is None.
+    """
+    if seconds is None:
+        yield
+        return
+    until = time.monotonic() + seconds
+    current = _deadline.get()
+    reset_token = _deadline.set(until if current is None else min(current, until))
+    try:
+        yield
+    finally:
+        _deadline.reset(reset_token)
+
+
+def get_remaining():
+    """Returns the seconds left before the current deadline, or None without one."""
+    until = _deadline.get()
+    if until is None:
+        return None
+    return until - time.monotonic()
+
+
+def get_timeout(timeout):
+    """
+    Returns `timeout` (a number or a (connect, read) tuple) capped by the
+    time left before the current deadline.  Raises DeadlineExceededError
+    if there is none left.
+    """
+    remaining = get_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceededError("No time left for Canvas requests")
+    if isinstance(timeout, (tuple, list)):
+        return tuple(remaining if part is None else min(part, remaining) for part in timeout)
+    return remaining if timeout is None else min(timeout, remaining)
@@ -0,0 +1,67 @@
+"""
+Probabilistic early refresh for `get_oauth_token`.
+
+With a fixed CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER, tokens granted in the
+same burst (a class launching the tool at 9:00) all reach the buffer at the
+same moment and are refreshed together.  With CANVAS_OAUTH_EARLY_REFRESH_ENABLED,
+each lookup instead refreshes the token when
+
+    now - latency * CANVAS_OAUTH_EARLY_REFRESH_BETA * ln(random()) >= expires - buffer
+
+(the "XFetch" rule), where `latency` is the observed duration of refreshes
+on the token's domain.  The chance of an early refresh rises smoothly as
+the buffer approaches, so refreshes of a burst of tokens are spread out
+ahead of it, and spread further when Canvas is slow to grant tokens.
+Tokens are never refreshed more than CANVAS_OAUTH_EARLY_REFRESH_MAX_AHEAD
+before the buffer.
+"""
+import math
+import random
+import threading
+from datetime import timedelta
+
+from canvas_oauth import settings as oauth_settings
+
+# Refresh latency assumed for a domain until a refresh has been observed
+DEFAULT_LATENCY = 1.0
+
+# Weight of the latest refresh in the moving average of refresh latencies
+LATENCY_WEIGHT = 0.2
+
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+
+def record_refresh_latency(domain, seconds):
+    """Adds the duration of a refresh grant to the domain's moving average."""
+    with _latencies_lock:
+        latency = _latencies.get(domain)
+        if latency is None:
+            _latencies[domain] = seconds
+        else:
+            _latencies[domain] = latency + LATENCY_WEIGHT * (seconds - latency)
+
+
+def get_refresh_latency(domain):
+    """Returns the moving average of refresh durations on the domain, in seconds."""
+    return _latencies.get(domain, DEFAULT_LATENCY)
+
+
+def get_refresh_buffer(domain):
+    """
+    Returns how long before expiry a token of the domain is refreshed by
+    this lookup.  Without early refresh, this is CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER;
+    with it, a random amount of time is added for every lookup.
+    """
+    buffer = oauth_settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
+    if not oauth_settings.CANVAS_OAUTH_EARLY_REFRESH_ENABLED:
+        return buffer
+    # 1 - random() is in (0, 1], so its logarithm is finite and <= 0
+    ahead = -get_refresh_latency(domain) * oauth_settings.CANVAS_OAUTH_EARLY_REFRESH_BETA * math.log(
+        1.0 - random.random())
+    return buffer + min(timedelta(seconds=ahead), oauth_settings.CANVAS_OAUTH_EARLY_REFRESH_MAX_AHEAD)
+
+
+def _clear_latencies():
+    with _latencies_lock:
+        _latencies.clear()
@@ -12,3 +12,22 @@ class InvalidOAuthStateError(CanvasOAuthError):
 
 class InvalidOAuthReturnError(CanvasOAuthError):
     pass
+
+
+class InvalidGrantError(InvalidOAuthReturnError):
+    """Canvas rejected the grant, e.g. because the refresh token was revoked"""
+    pass
+
+
+class CanvasDomainError(CanvasOAuthError):
+    pass
+
+
+class DeadlineExceededError(CanvasOAuthError):
+    """The request's time budget for Canvas calls ran out"""
+    pass
+
+
+class CircuitOpenError(CanvasOAuthError):
+    """The circuit breaker of a Canvas domain's token endpoint is open"""
+    pass
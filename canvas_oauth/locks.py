@@ -0,0 +1,84 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.db import router, transaction
+from django.utils.crypto import get_random_string
+
+from canvas_oauth import settings as oauth_settings
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshLock(ABC):
+    """
+    Abstract base class for the lock that serializes token refreshes for a
+    single (user, canvas_domain) pair across threads and worker processes.
+    """
+
+    @abstractmethod
+    def hold(self, oauth_token):
+        """
+        Context manager that holds the refresh lock for the given token.
+        Yields True if the lock was acquired and False if waiting for it
+        timed out.
+        """
+        pass
+
+    def get_key(self, oauth_token):
+        return f"{oauth_token.user_id}:{oauth_token.canvas_domain}"
+
+
+class CacheLock(RefreshLock):
+    """
+    Lock built on the atomic ``cache.add`` operation.  The cache must be
+    shared between worker processes (e.g. memcached or redis) for the lock
+    to coalesce refreshes across processes.
+    """
+
+    def __init__(self, alias=None, timeout=None, wait=None, poll_interval=0.05):
+        self.alias = alias or oauth_settings.CANVAS_OAUTH_TOKEN_CACHE_ALIAS
+        self.timeout = timeout or oauth_settings.CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT
+        self.wait = oauth_settings.CANVAS_OAUTH_REFRESH_LOCK_WAIT if wait is None else wait
+        self.poll_interval = poll_interval
+
+    @contextmanager
+    def hold(self, oauth_token):
+        cache = caches[self.alias]
+        lock_key = f"canvas_oauth:refresh-lock:{self.get_key(oauth_token)}"
+        owner = get_random_string(16)
+        deadline = time.monotonic() + self.wait
+
+        acquired = cache.add(lock_key, owner, self.timeout)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            acquired = cache.add(lock_key, owner, self.timeout)
+        if not acquired:
+            logger.warning("Timed out waiting for refresh lock %s", lock_key)
+
+        try:
+            yield acquired
+        finally:
+            # Only release a lock we still own; it may have expired and been
+            # taken by another worker in the meantime.
+            if acquired and cache.get(lock_key) == owner:
+                cache.delete(lock_key)
+
+
+class DatabaseLock(RefreshLock):
+    """
+    Lock that takes a row lock (SELECT ... FOR UPDATE) on the token for the
+    duration of the refresh.  Waiters block in the database until the winner
+    commits.  The lock is taken on the write database, even when the token
+    was read from a replica.
+    """
+
+    @contextmanager
+    def hold(self, oauth_token):
+        model = type(oauth_token)
+        db = router.db_for_write(model, instance=oauth_token)
+        with transaction.atomic(using=db):
+            list(model.objects.using(db).select_for_update().filter(pk=oauth_token.pk).values_list('pk'))
+            yield True
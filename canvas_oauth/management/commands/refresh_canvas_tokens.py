@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Count, Q
+from django.db.models.functions import TruncMinute
+from django.utils import timezone
+
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import refresh_access_token
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Refreshes Canvas OAuth2 tokens that expire within the given window, "
+            "so that user requests don't have to wait on the Canvas token endpoint. "
+            "Tokens that expired longer ago than --max-expired are left alone.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=600,
+                            help="Refresh tokens expiring within this many seconds (default: 600)")
+        parser.add_argument('--max-expired', type=int, default=3600,
+                            help="Skip tokens that expired more than this many seconds ago, e.g. abandoned "
+                                 "or revoked ones, so they can go idle and be swept (default: 3600)")
+        parser.add_argument('--workers', type=int, default=8,
+                            help="Maximum number of concurrent refresh requests (default: 8)")
+        parser.add_argument('--per-domain', type=int, default=4,
+                            help="Maximum number of concurrent refresh requests per Canvas domain (default: 4)")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of tokens loaded from the database at a time (default: 500)")
+        parser.add_argument('--redirect-uri', default=None,
+                            help="Redirect URI sent with the refresh_token grant")
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help="Keep running, scanning again every SECONDS seconds")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many tokens would be refreshed per minute")
+
+    def handle(self, *args, **options):
+        window = timedelta(seconds=options['window'])
+        max_expired = timedelta(seconds=options['max_expired'])
+        while True:
+            if options['dry_run']:
+                self.report(window, max_expired)
+            else:
+                self.refresh(window, max_expired, options)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+
+    def report(self, window, max_expired):
+        total = 0
+        for row in self.expiring_per_minute(window, max_expired):
+            total += row['count']
+            self.stdout.write(f"{row['minute']:%Y-%m-%d %H:%M}  {row['count']}")
+        self.stdout.write(f"{total} tokens would be refreshed")
+
+    def refresh(self, window, max_expired, options):
+        workers = options['workers']
+        per_domain = options['per_domain']
+        redirect_uri = options['redirect_uri']
+
+        # Bound the number of queued tokens so memory stays flat no matter
+        # how many rows match
+        pending = threading.BoundedSemaphore(workers * 2)
+        domain_slots = defaultdict(lambda: threading.BoundedSemaphore(per_domain))
+        domain_slots_lock = threading.Lock()
+        counts = {'refreshed': 0, 'failed': 0}
+        counts_lock = threading.Lock()
+
+        def refresh_one(oauth_token):
+            with domain_slots_lock:
+                domain_slot = domain_slots[oauth_token.canvas_domain]
+            try:
+                with domain_slot:
+                    refresh_access_token(oauth_token, redirect_uri=redirect_uri, buffer=window)
+                result = 'refreshed'
+            except Exception as e:
+                logger.warning("Failed to refresh token %s: %s", oauth_token.pk, e)
+                result = 'failed'
+            finally:
+                close_old_connections()
+                pending.release()
+            with counts_lock:
+                counts[result] += 1
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for oauth_token in self.iter_expiring_tokens(window, max_expired, options['chunk_size']):
+                pending.acquire()
+                executor.submit(refresh_one, oauth_token)
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            f"Refreshed {counts['refreshed']} tokens ({counts['failed']} failed) in {elapsed:.1f}s")
+
+    def expiring_tokens(self, window, max_expired):
+        now = timezone.now()
+        return CanvasOAuth2Token.objects.filter(expires__lte=now + window, expires__gt=now - max_expired)
+
+    def expiring_per_minute(self, window, max_expired):
+        return (self.expiring_tokens(window, max_expired)
+                .annotate(minute=TruncMinute('expires'))
+                .values('minute')
+                .annotate(count=Count('pk'))
+                .order_by('minute'))
+
+    def iter_expiring_tokens(self, window, max_expired, chunk_size):
+        """
+        Yields expiring tokens in (expires, pk) order, one chunk at a time,
+        using keyset pagination on the `expires` index.
+        """
+        queryset = self.expiring_tokens(window, max_expired).select_related('user').order_by('expires', 'pk')
+        last = None
+        while True:
+            chunk = queryset
+            if last is not None:
+                chunk = chunk.filter(Q(expires__gt=last.expires) | Q(expires=last.expires, pk__gt=last.pk))
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return
+            yield from chunk
+            last = chunk[-1]
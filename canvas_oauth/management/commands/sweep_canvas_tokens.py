@@ -0,0 +1,115 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from canvas_oauth import canvas
+from canvas_oauth.exceptions import InvalidGrantError
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Deletes dead Canvas OAuth2 tokens (idle past a TTL or, with --verify, whose "
+            "refresh token Canvas rejects) and Canvas users left without a token, in "
+            "small primary key ranges so it can run alongside live traffic.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-days', type=int, default=90,
+                            help="Delete tokens that expired more than this many days ago (default: 90)")
+        parser.add_argument('--orphan-days', type=int, default=1,
+                            help="Delete Canvas users created more than this many days ago "
+                                 "that have no token (default: 1)")
+        parser.add_argument('--verify', action='store_true',
+                            help="Also probe the other expired tokens with a refresh (not saved), "
+                                 "and delete those whose refresh fails with invalid_grant")
+        parser.add_argument('--redirect-uri', default=None,
+                            help="Redirect URI sent with the refresh_token grant when verifying")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of rows deleted at a time (default: 500)")
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help="Seconds to sleep between chunks (default: 0.1)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many rows would be deleted")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        idle_cutoff = now - timedelta(days=options['idle_days'])
+        idle_tokens = CanvasOAuth2Token.objects.filter(expires__lt=idle_cutoff)
+        self.sweep("idle tokens", idle_tokens, options)
+
+        if options['verify']:
+            revoked = self.find_revoked_tokens(
+                CanvasOAuth2Token.objects.filter(expires__lt=now, expires__gte=idle_cutoff),
+                options['redirect_uri'])
+            self.sweep_pks("revoked tokens", CanvasOAuth2Token, revoked, options)
+
+        orphans = CanvasUser.objects.filter(
+            canvas_tokens__isnull=True, created_at__lt=now - timedelta(days=options['orphan_days']))
+        self.sweep("orphaned users", orphans, options)
+
+    def sweep(self, label, queryset, options):
+        if options['dry_run']:
+            self.stdout.write(f"{queryset.count()} {label} would be deleted")
+            return
+        self.delete_chunks(label, queryset.model, self.iter_pk_ranges(queryset, options['chunk_size']), options)
+
+    def sweep_pks(self, label, model, pks, options):
+        """Deletes the rows of `model` with the given pks, `chunk_size` at a time."""
+        if options['dry_run']:
+            self.stdout.write(f"{len(pks)} {label} would be deleted")
+            return
+        chunk_size = options['chunk_size']
+        chunks = (model.objects.filter(pk__in=pks[i:i + chunk_size]) for i in range(0, len(pks), chunk_size))
+        self.delete_chunks(label, model, chunks, options)
+
+    def delete_chunks(self, label, model, chunks, options):
+        started = time.monotonic()
+        deleted = 0
+        for chunk in chunks:
+            deleted += chunk.delete()[1].get(model._meta.label, 0)
+            time.sleep(options['sleep'])
+        elapsed = time.monotonic() - started
+        rate = deleted / elapsed if elapsed else 0
+        self.stdout.write(f"Deleted {deleted} {label} in {elapsed:.1f}s ({rate:.0f}/s)")
+
+    def iter_pk_ranges(self, queryset, chunk_size):
+        """
+        Yields `queryset` restricted to consecutive primary key ranges that
+        hold at most `chunk_size` of its rows, so each delete touches a
+        bounded number of rows.  Each range starts at the next remaining pk
+        (keyset pagination), so gaps between pks cost no queries or sleeps.
+        """
+        pks = queryset.order_by('pk').values_list('pk', flat=True)
+        low = pks.first()
+        while low is not None:
+            bound = list(pks.filter(pk__gte=low)[chunk_size:chunk_size + 1])
+            if not bound:
+                yield queryset.filter(pk__gte=low)
+                return
+            yield queryset.filter(pk__gte=low, pk__lt=bound[0])
+            low = bound[0]
+
+    def find_revoked_tokens(self, queryset, redirect_uri):
+        """
+        Returns the pks of tokens whose refresh token Canvas rejects.  Tokens
+        are probed with a refresh_token grant whose result is not saved, so
+        verifying a token does not extend its expiry and keep it from ever
+        becoming idle.
+        """
+        revoked = []
+        for oauth_token in queryset.iterator():
+            try:
+                canvas.get_access_token(
+                    domain=oauth_token.canvas_domain,
+                    grant_type='refresh_token',
+                    redirect_uri=redirect_uri,
+                    refresh_token=oauth_token.refresh_token)
+            except InvalidGrantError:
+                revoked.append(oauth_token.pk)
+            except Exception as e:
+                logger.warning("Failed to verify token %s: %s", oauth_token.pk, e)
+        return revoked
@@ -0,0 +1,242 @@
+"""
+Counters, gauges and histograms for the token lifecycle.
+
+Instrumented code records metrics through `increment`, `set_gauge`,
+`observe`, `timer` and `timed_view`, which hand them to the sink configured by
+CANVAS_OAUTH_METRICS_SINK.  With no sink configured (the default) they
+return after a settings lookup.  `PrometheusMetricsSink` keeps the metrics
+in process and `metrics_view` serves them in the Prometheus text format.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.http import Http404, HttpResponse
+
+from canvas_oauth import settings as oauth_settings
+
+TOKEN_LOOKUPS = 'canvas_oauth_token_lookups_total'
+TOKEN_REFRESH_SECONDS = 'canvas_oauth_token_refresh_seconds'
+TOKEN_GRANT_SECONDS = 'canvas_oauth_token_grant_seconds'
+CALLBACK_SECONDS = 'canvas_oauth_callback_seconds'
+MISSING_TOKENS = 'canvas_oauth_missing_tokens_total'
+OAUTH_ERRORS = 'canvas_oauth_errors_total'
+BREAKER_STATE = 'canvas_oauth_breaker_state'
+BREAKER_REJECTIONS = 'canvas_oauth_breaker_rejections_total'
+STALE_TOKENS = 'canvas_oauth_stale_tokens_total'
+HTTP_RETRIES = 'canvas_oauth_http_retries_total'
+HEDGED_REQUESTS = 'canvas_oauth_hedged_requests_total'
+COALESCED_AUTHORIZATIONS = 'canvas_oauth_coalesced_authorizations_total'
+
+# Type and help text of the metrics recorded by canvas_oauth
+METRICS = {
+    TOKEN_LOOKUPS: ('counter', "Token lookups by get_oauth_token, by source (cache or database) "
+                               "and result (hit or missing)"),
+    TOKEN_REFRESH_SECONDS: ('histogram', "Duration of token refreshes, by outcome"),
+    TOKEN_GRANT_SECONDS: ('histogram', "Duration of Canvas token endpoint requests, by grant type, "
+                                       "domain and outcome"),
+    CALLBACK_SECONDS: ('histogram', "Duration of the OAuth callback view, by outcome"),
+    MISSING_TOKENS: ('counter', "MissingTokenErrors handled by OAuthMiddleware"),
+    OAUTH_ERRORS: ('counter', "Other CanvasOAuthErrors handled by OAuthMiddleware, by error"),
+    BREAKER_STATE: ('gauge', "State of the token endpoint circuit breaker, by domain "
+                             "(0 closed, 1 half open, 2 open)"),
+    BREAKER_REJECTIONS: ('counter', "Token grants rejected by an open circuit breaker, by domain"),
+    STALE_TOKENS: ('counter', "Tokens due for a refresh returned unrefreshed because the "
+                              "circuit breaker of their domain was open, by domain"),
+    HTTP_RETRIES: ('counter', "Retried Canvas requests, by domain and reason"),
+    HEDGED_REQUESTS: ('counter', "Canvas requests sent a second time because the first was slow, by domain"),
+    COALESCED_AUTHORIZATIONS: ('counter', "Requests without a token that reused the session's pending "
+                                          "OAuth authorization instead of starting one"),
+}
+
+
+class MetricsSink(ABC):
+    """Receives the metrics recorded by canvas_oauth."""
+
+    @abstractmethod
+    def increment(self, name, value=1, labels=None):
+        """Adds `value` to the counter `name`."""
+
+    @abstractmethod
+    def observe(self, name, value, labels=None):
+        """Records `value` (in seconds for durations) in the histogram `name`."""
+
+    def set_gauge(self, name, value, labels=None):
+        """Sets the gauge `name` to `value`.  Sinks without gauges ignore it."""
+
+
+class PrometheusMetricsSink(MetricsSink):
+    """
+    Thread-safe in-process sink whose metrics `render` in the Prometheus
+    text exposition format.  Each process keeps its own metrics.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, labels=None):
+        key = _get_label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        key = _get_label_key(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, labels=None):
+        key = _get_label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                # Per-bucket counts (the last one is +Inf), sum and count
+                histogram = series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+            histograms = {name: {key: (list(h[0]), h[1], h[2]) for key, h in series.items()}
+                          for name, series in self._histograms.items()}
+
+        lines = []
+        for name, series in sorted(counters.items()):
+            lines.extend(_get_header(name, 'counter'))
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        for name, series in sorted(gauges.items()):
+            lines.extend(_get_header(name, 'gauge'))
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        for name, series in sorted(histograms.items()):
+            lines.extend(_get_header(name, 'histogram'))
+            for key, (bucket_counts, total, count) in sorted(series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _get_label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _get_header(name, metric_type):
+    metric_type, help_text = METRICS.get(name, (metric_type, None))
+    if help_text:
+        yield f"# HELP {name} {help_text}"
+    yield f"# TYPE {name} {metric_type}"
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape_label_value(value)}"' for label, value in key) + '}'
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def increment(name, value=1, **labels):
+    """Adds `value` to a counter in the configured sink, if any."""
+    sink = oauth_settings.get_metrics_sink()
+    if sink is not None:
+        sink.increment(name, value, labels)
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge in the configured sink, if any."""
+    sink = oauth_settings.get_metrics_sink()
+    if sink is not None:
+        sink.set_gauge(name, value, labels)
+
+
+def observe(name, value, **labels):
+    """Records `value` in a histogram in the configured sink, if any."""
+    sink = oauth_settings.get_metrics_sink()
+    if sink is not None:
+        sink.observe(name, value, labels)
+
+
+class timer(object):
+    """
+    Context manager that records the seconds spent in its block in the
+    histogram `name`.  The `outcome` label is 'success' unless set on the
+    timer, or the exception class name if the block raises.  The duration
+    is available as `elapsed` afterwards.
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.outcome = 'success'
+        self.elapsed = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self._started
+        outcome = exc_type.__name__ if exc_type is not None else self.outcome
+        observe(self.name, self.elapsed, outcome=outcome, **self.labels)
+        return False
+
+
+def timed_view(name):
+    """
+    Decorates a sync or async view to record its duration in the histogram
+    `name`, with the response's status class (e.g. '3xx') as outcome.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                with timer(name) as view_timer:
+                    response = await view(request, *args, **kwargs)
+                    view_timer.outcome = f"{response.status_code // 100}xx"
+                return response
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with timer(name) as view_timer:
+                response = view(request, *args, **kwargs)
+                view_timer.outcome = f"{response.status_code // 100}xx"
+            return response
+        return wrapper
+    return decorator
+
+
+def metrics_view(request):
+    """
+    Serves the metrics of the configured sink in the Prometheus text format,
+    or a 404 if the sink can't render them.  Not routed by canvas_oauth.urls:
+    add it to your own URLconf, behind whatever access control your metrics
+    endpoints use.
+    """
+    sink = oauth_settings.get_metrics_sink()
+    if not hasattr(sink, 'render'):
+        raise Http404("Metrics are not enabled")
+    return HttpResponse(sink.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
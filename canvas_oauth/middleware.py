@@ -1,22 +1,55 @@
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.functional import SimpleLazyObject
+
+from canvas_oauth import deadline, metrics, settings
 from canvas_oauth.exceptions import (MissingTokenError, CanvasOAuthError)
-from canvas_oauth.oauth import (handle_missing_token, render_oauth_error)
+from canvas_oauth.oauth import (
+    LazyCanvasToken, get_canvas_user, handle_missing_token, render_oauth_error)
 
 
 class OAuthMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        response = self.get_response(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # The request's Canvas calls share CANVAS_OAUTH_REQUEST_DEADLINE
+        with deadline.deadline(settings.CANVAS_OAUTH_REQUEST_DEADLINE):
+            self.process_request(request)
+            response = self.get_response(request)
         return response
 
+    async def __acall__(self, request):
+        with deadline.deadline(settings.CANVAS_OAUTH_REQUEST_DEADLINE):
+            response = await self.get_response(request)
+        return response
+
+    def process_request(self, request):
+        """
+        Attaches `request.canvas_token` and `request.canvas_user`, resolved
+        on first use and shared by every caller in the request.  Not set
+        for async requests, which should use `aget_oauth_token`.
+        """
+        request.canvas_token = LazyCanvasToken(request)
+        request.canvas_user = SimpleLazyObject(partial(get_canvas_user, request))
+
     """On catching a MissingTokenError - as is raised by the get_token function
     if there is no saved token for the user - this begins the oauth dance with
     canvas to get a new token.  For other CanvasOAuthErrors, an error page with
     the exception text is rendered."""
     def process_exception(self, request, exception):
         if isinstance(exception, MissingTokenError):
+            metrics.increment(metrics.MISSING_TOKENS)
             return handle_missing_token(request)
         elif isinstance(exception, CanvasOAuthError):
+            metrics.increment(metrics.OAUTH_ERRORS, error=type(exception).__name__)
             return render_oauth_error(str(exception))
         return
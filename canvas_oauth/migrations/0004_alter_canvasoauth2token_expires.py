@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_oauth', '0003_canvasoauth2token_canvas_domain_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='canvasoauth2token',
+            name='expires',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2 on 2026-10-17 10:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def delete_django_user_tokens(apps, schema_editor):
+    # Tokens were previously stored against Django users, which can't be
+    # mapped to Canvas users.  Their owners are sent through the OAuth flow
+    # again (see handle_missing_token) on their next Canvas API call.
+    CanvasOAuth2Token = apps.get_model('canvas_oauth', 'CanvasOAuth2Token')
+    CanvasOAuth2Token.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_oauth', '0004_alter_canvasoauth2token_expires'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CanvasUser',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('canvas_user_id', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('sortable_name', models.CharField(blank=True, max_length=255)),
+                ('short_name', models.CharField(blank=True, max_length=255)),
+                ('email', models.EmailField(blank=True, max_length=254, null=True)),
+                ('avatar_url', models.URLField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='canvasoauth2token',
+            name='canvas_domain',
+            field=models.CharField(help_text="canvas domain (e.g., 'canvas.school.edu')", max_length=255),
+        ),
+        migrations.RunPython(
+            code=delete_django_user_tokens,
+            reverse_code=migrations.RunPython.noop,
+        ),
+        migrations.AlterField(
+            model_name='canvasoauth2token',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='canvas_tokens', to='canvas_oauth.canvasuser'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2 on 2026-10-17 14:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_canvas_domain(apps, schema_editor):
+    # Users take the domain of their tokens.  A user with tokens on several
+    # domains was several people sharing a Canvas id, so each further domain
+    # gets its own copy of the user.
+    CanvasUser = apps.get_model('canvas_oauth', 'CanvasUser')
+    CanvasOAuth2Token = apps.get_model('canvas_oauth', 'CanvasOAuth2Token')
+    default_domain = getattr(settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', None) or ''
+    for canvas_user in CanvasUser.objects.all().iterator():
+        domains = list(CanvasOAuth2Token.objects.filter(user=canvas_user)
+                       .order_by('canvas_domain').values_list('canvas_domain', flat=True).distinct())
+        canvas_user.canvas_domain = domains[0] if domains else default_domain
+        canvas_user.save(update_fields=['canvas_domain'])
+        for domain in domains[1:]:
+            copy = CanvasUser.objects.create(
+                canvas_user_id=canvas_user.canvas_user_id, canvas_domain=domain, name=canvas_user.name)
+            CanvasOAuth2Token.objects.filter(user=canvas_user, canvas_domain=domain).update(user=copy)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_oauth', '0005_canvasuser_canvasoauth2token_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='canvasuser',
+            name='canvas_domain',
+            field=models.CharField(default='', help_text="canvas domain (e.g., 'canvas.school.edu')", max_length=255),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='canvasuser',
+            name='canvas_user_id',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.RunPython(
+            code=set_canvas_domain,
+            reverse_code=migrations.RunPython.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='canvasuser',
+            unique_together={('canvas_user_id', 'canvas_domain')},
+        ),
+    ]
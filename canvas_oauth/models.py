@@ -8,7 +8,9 @@ from django.utils import timezone
 
 # Create your models here.
 class CanvasUser(models.Model):
-    canvas_user_id = models.CharField(max_length=64, unique=True)
+    # Canvas user ids are only unique within a Canvas instance
+    canvas_user_id = models.CharField(max_length=64)
+    canvas_domain = models.CharField(max_length=255, help_text="canvas domain (e.g., 'canvas.school.edu')")
     name = models.CharField(max_length=255)
     sortable_name = models.CharField(max_length=255, blank=True)
     short_name = models.CharField(max_length=255, blank=True)
@@ -19,6 +21,9 @@ class CanvasUser(models.Model):
     def __str__(self):
         return f"{self.name} (Canvas ID: {self.canvas_user_id})"
 
+    class Meta:
+        unique_together = [('canvas_user_id', 'canvas_domain')]
+
 class CanvasOAuth2Token(models.Model):
     """
     A CanvasOAuth2Token instance represents the access token
@@ -45,12 +50,12 @@ class CanvasOAuth2Token(models.Model):
     )
     """
 
-    user = models.OneToOneField(CanvasUser, on_delete=models.CASCADE, related_name="canvas_oauth2_token")
+    user = models.ForeignKey(CanvasUser, on_delete=models.CASCADE, related_name="canvas_tokens")
     canvas_domain = models.CharField(max_length=255, help_text = "canvas domain (e.g., 'canvas.school.edu')")
 
     access_token = models.TextField()
     refresh_token = models.TextField()
-    expires = models.DateTimeField()
+    expires = models.DateTimeField(db_index=True)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
@@ -72,3 +77,6 @@ class CanvasOAuth2Token(models.Model):
     class Meta:
         verbose_name = "Canvas OAuth2 Token"
         verbose_name_plural = "Canvas OAuth2 Tokens"
+        # One token per user and Canvas domain; the unique index also serves
+        # token lookups by (user, canvas_domain)
+        unique_together = [('user', 'canvas_domain')]
@@ -1,20 +1,27 @@
 import logging
 import requests
-import os
+import time
+from collections import namedtuple
+from datetime import timedelta
 
+from asgiref.sync import sync_to_async
 from django.urls import reverse
-from django.http.response import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest
+from django.http.response import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect
 from django.template import loader
 from django.template.exceptions import TemplateDoesNotExist
 from django.utils.crypto import get_random_string
 
-import ipdb
-
-from canvas_oauth import (canvas, settings)
+from canvas_oauth import (canvas, early_refresh, metrics, settings, signals, state)
+from canvas_oauth.breaker import get_circuit_breaker
+from canvas_oauth.client import get_async_client, get_client
 from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.profile import get_profile_fields
+from canvas_oauth.response_cache import get_user_owner
 from canvas_oauth.exceptions import (
-    MissingTokenError, InvalidOAuthStateError)
+    CanvasDomainError, CircuitOpenError, MissingTokenError, InvalidOAuthStateError)
+from canvas_oauth.token_cache import (
+    ainvalidate_token, get_token_cache, invalidate_token)
 from django.core.cache import cache
 from django.utils import timezone
 from .models import CanvasUser
@@ -25,7 +32,6 @@ logger = logging.getLogger(__name__)
 
 
 def get_oauth_token(request):
-    print("IN: get_oauth_token")
     """Retrieve a stored Canvas OAuth2 access token from Canvas for the
     currently logged in user.  If the token has expired (or has exceeded an
     expiration threshold as defined by the consuming project), a fresh token
@@ -36,61 +42,339 @@ def get_oauth_token(request):
     will be handled by the middleware component of this library with a call to
     handle_missing_token.  If this happens outside of a view, then the user must
     be directed by other means to the Canvas site in order to authorize a token.
+
+    The token is kept on the request, so later calls in the same request
+    return it without another lookup until it reaches the expiration
+    buffer or is refreshed.
+
+    With CANVAS_OAUTH_EARLY_REFRESH_ENABLED, a token may be refreshed at
+    random ahead of the expiration buffer (see `canvas_oauth.early_refresh`).
+    While the circuit breaker of the token endpoint is open (see
+    `canvas_oauth.breaker`), a token that has not expired yet is returned
+    without a refresh.
     """
+    domain = get_canvas_domain(request)
+    request_token = _get_request_token(request, domain)
+    if request_token is not None:
+        return request_token.access_token, request_token.user_id
+    refresh_buffer = early_refresh.get_refresh_buffer(domain)
+    token_cache = None
+    user_id_value = None
     try:
-        if request.session.has_key('user_id'):
-            user_id_value = request.session['user_id']
-        else:
-            user_id_value = request.GET.get("user_id") or request.POST.get("user_id")
-        canvas_user = CanvasUser.objects.get(canvas_user_id=user_id_value)
-        oauth_token = canvas_user.canvas_oauth2_token
-        logger.info("Token found for user %s" % request.user.pk)
+        user_id_value = _get_request_user_id(request)
+        token_cache = get_token_cache()
+        if token_cache is not None and user_id_value:
+            cached = token_cache.get(user_id_value, domain)
+            if cached is not None and cached.missing:
+                _token_missing(user_id_value, domain, 'cache')
+                raise MissingTokenError("No token found for user %s" % user_id_value)
+            # A token due for an early refresh is looked up in the database
+            if cached is not None and not _expires_within(cached.expires, refresh_buffer):
+                _token_retrieved(user_id_value, domain, 'cache')
+                _set_request_token(request, domain, cached.access_token, user_id_value, cached.expires)
+                return cached.access_token, user_id_value
+        oauth_token = _get_stored_token(user_id_value, domain)
+        logger.debug("Token found for user %s", user_id_value)
+    except MissingTokenError:
+        raise
     #except CanvasOAuth2Token.DoesNotExist:
     except Exception as e:
         """ If this exception is raised by a view function and not caught,
         it is probably because the oauth_middleware is not installed, since it
         is supposed to catch this error."""
-        logger.info("No token found for user %s" % request.user.pk)
-        print("No token found for user %s" % request.user.pk)
-        raise MissingTokenError("No token found for user %s" % request.user.pk)
+        if token_cache is not None and user_id_value and isinstance(e, CanvasOAuth2Token.DoesNotExist):
+            token_cache.set_missing(user_id_value, domain)
+        logger.info("No token found for user %s", user_id_value)
+        _token_missing(user_id_value, domain, 'database')
+        raise MissingTokenError("No token found for user %s" % user_id_value)
+    _token_retrieved(user_id_value, domain, 'database')
 
     # Check to see if we're within the expiration threshold of the access token
-    if oauth_token.expires_within(settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER):
-        logger.info("Refreshing token for user %s" % request.user.pk)
-        oauth_token = refresh_oauth_token(request, oauth_token)
+    if oauth_token.expires_within(refresh_buffer):
+        logger.info("Refreshing token for user %s", user_id_value)
+        oauth_token = _refresh_or_keep_oauth_token(request, oauth_token, refresh_buffer)
 
+    if token_cache is not None:
+        token_cache.set(user_id_value, domain,
+                        oauth_token.access_token, oauth_token.expires)
+
+    _set_request_token(request, domain, oauth_token.access_token, user_id_value,
+                       oauth_token.expires, oauth_token.user)
     return oauth_token.access_token, user_id_value
 
-def get_assignment(course_id, assignment_id, access_token):
-    url = f"https://canvas.instructure.com/api/v1/courses/{course_id}/assignments/{assignment_id}"
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+def _refresh_or_keep_oauth_token(request, oauth_token, buffer):
+    """Refreshes the token, or returns it as is while it is still valid and
+    the circuit breaker of its domain is open."""
+    if _can_keep_oauth_token(oauth_token):
+        return _keep_oauth_token(oauth_token)
+    try:
+        return refresh_oauth_token(request, oauth_token, buffer=buffer)
+    except CircuitOpenError:
+        if oauth_token.expires_within(timedelta()):
+            raise
+        return _keep_oauth_token(oauth_token)
+
+
+async def _arefresh_or_keep_oauth_token(request, oauth_token, buffer):
+    """Async version of `_refresh_or_keep_oauth_token`."""
+    if _can_keep_oauth_token(oauth_token):
+        return _keep_oauth_token(oauth_token)
+    try:
+        return await arefresh_oauth_token(request, oauth_token, buffer=buffer)
+    except CircuitOpenError:
+        if oauth_token.expires_within(timedelta()):
+            raise
+        return _keep_oauth_token(oauth_token)
+
+
+def _can_keep_oauth_token(oauth_token):
+    return (not oauth_token.expires_within(timedelta())
+            and get_circuit_breaker(oauth_token.canvas_domain).is_open())
+
+
+def _keep_oauth_token(oauth_token):
+    logger.warning("Token endpoint of %s is unavailable, using token for user %s until it expires",
+                   oauth_token.canvas_domain, oauth_token.user_id)
+    metrics.increment(metrics.STALE_TOKENS, domain=oauth_token.canvas_domain)
+    return oauth_token
+
+
+def _expires_within(expires, buffer):
+    return expires is not None and expires - timezone.now() <= buffer
+
+
+def _token_retrieved(user_id, domain, source):
+    metrics.increment(metrics.TOKEN_LOOKUPS, source=source, result='hit')
+    signals.token_retrieved.send(sender=CanvasOAuth2Token, user_id=user_id, domain=domain, source=source)
+
+
+def _token_missing(user_id, domain, source):
+    metrics.increment(metrics.TOKEN_LOOKUPS, source=source, result='missing')
+    signals.token_missing.send(sender=CanvasOAuth2Token, user_id=user_id, domain=domain)
+
+
+async def aget_oauth_token(request):
+    """Async version of `get_oauth_token` for async views.  The cache and
+    database lookups use the async cache and ORM APIs; an expiring token is
+    refreshed through `arefresh_oauth_token`.
+    """
+    domain = await sync_to_async(get_canvas_domain)(request)
+    request_token = _get_request_token(request, domain)
+    if request_token is not None:
+        return request_token.access_token, request_token.user_id
+    refresh_buffer = early_refresh.get_refresh_buffer(domain)
+    user_id_value = await sync_to_async(_get_request_user_id)(request)
+    token_cache = get_token_cache()
+    if token_cache is not None and user_id_value:
+        cached = await token_cache.aget(user_id_value, domain)
+        if cached is not None and cached.missing:
+            _token_missing(user_id_value, domain, 'cache')
+            raise MissingTokenError("No token found for user %s" % user_id_value)
+        if cached is not None and not _expires_within(cached.expires, refresh_buffer):
+            _token_retrieved(user_id_value, domain, 'cache')
+            _set_request_token(request, domain, cached.access_token, user_id_value, cached.expires)
+            return cached.access_token, user_id_value
+
+    try:
+        oauth_token = await settings.get_token_store().aget(user_id_value, domain)
+    except CanvasOAuth2Token.DoesNotExist:
+        if token_cache is not None and user_id_value:
+            await token_cache.aset_missing(user_id_value, domain)
+        logger.info("No token found for user %s", user_id_value)
+        _token_missing(user_id_value, domain, 'database')
+        raise MissingTokenError("No token found for user %s" % user_id_value)
+    _token_retrieved(user_id_value, domain, 'database')
+
+    if oauth_token.expires_within(refresh_buffer):
+        logger.info("Refreshing token for user %s", user_id_value)
+        oauth_token = await _arefresh_or_keep_oauth_token(request, oauth_token, refresh_buffer)
+
+    if token_cache is not None:
+        await token_cache.aset(user_id_value, domain,
+                               oauth_token.access_token, oauth_token.expires)
+
+    _set_request_token(request, domain, oauth_token.access_token, user_id_value,
+                       oauth_token.expires, oauth_token.user)
+    return oauth_token.access_token, user_id_value
+
+
+class RequestToken(namedtuple('RequestToken', ['access_token', 'user_id', 'expires', 'user'])):
+    """A token resolved during a request.  `user` is None if it came from the token cache."""
+
+
+def _get_request_token(request, domain):
+    request_token = getattr(request, '_canvas_oauth_tokens', {}).get(domain)
+    if request_token is None or request_token.expires is None:
+        return None
+    # A long request may outlive the token
+    if request_token.expires - settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER <= timezone.now():
+        return None
+    return request_token
+
+
+def _set_request_token(request, domain, access_token, user_id, expires, user=None):
+    try:
+        request_tokens = request._canvas_oauth_tokens
+    except AttributeError:
+        request_tokens = request._canvas_oauth_tokens = {}
+    request_tokens[domain] = RequestToken(access_token, user_id, expires, user)
+
+
+def _clear_request_token(request, domain):
+    getattr(request, '_canvas_oauth_tokens', {}).pop(domain, None)
+
+
+def get_canvas_user(request):
+    """
+    Returns the CanvasUser whose token `get_oauth_token` returns for the
+    request, raising MissingTokenError if there is none.
+    """
+    domain = get_canvas_domain(request)
+    _, user_id = get_oauth_token(request)
+    request_token = _get_request_token(request, domain)
+    if request_token is not None and request_token.user is not None:
+        return request_token.user
+    return CanvasUser.objects.get(canvas_user_id=user_id, canvas_domain=domain)
+
+
+class LazyCanvasToken(object):
+    """
+    `request.canvas_token`, set by OAuthMiddleware.  Its attributes call
+    `get_oauth_token` when read, so a request that never uses the token
+    makes no lookup, and every read in the request shares one lookup (and
+    sees a token refreshed partway through the request).
+    """
+
+    def __init__(self, request):
+        self._request = request
+
+    @property
+    def access_token(self):
+        return get_oauth_token(self._request)[0]
+
+    @property
+    def user_id(self):
+        return get_oauth_token(self._request)[1]
+
+    def __str__(self):
+        return self.access_token
+
+
+def get_canvas_domain(request):
+    """
+    Returns the Canvas domain a request is for, as given by the configured
+    environment resolver (see CANVAS_OAUTH_ENVIRONMENT_RESOLVER), falling
+    back to CANVAS_OAUTH_CANVAS_DOMAIN.  Tokens are stored, cached and
+    refreshed per user and domain.
+    """
+    domain = settings.get_environment_resolver().resolve_domain(request)
+    if not domain:
+        domain = getattr(settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', None)
+    if not domain:
+        raise CanvasDomainError("Unable to resolve the Canvas domain for request %s" % request.get_full_path())
+    return domain
+
+
+def _get_stored_token(user_id, domain):
+    """Fetches the user's token for a Canvas domain from the token store."""
+    return settings.get_token_store().get(user_id, domain)
+
+
+def _get_request_user_id(request):
+    if request.session.has_key('user_id'):
+        return request.session['user_id']
+    return request.GET.get("user_id") or request.POST.get("user_id")
+
+
+def get_assignment(course_id, assignment_id, access_token, domain="canvas.instructure.com", owner=None,
+                   user_id=None):
+    if owner is None and user_id is not None:
+        owner = get_user_owner(user_id, domain)
+    return get_client().get_json(
+        domain,
+        f"/api/v1/courses/{course_id}/assignments/{assignment_id}",
+        access_token=access_token,
+        owner=owner)
+
+
+def paginate_canvas_api(request, path, params=None, per_page=100, prefetch=True, data_key=None):
+    """
+    Lazily yields the items of a paginated Canvas API list endpoint (e.g.
+    '/api/v1/courses/1/assignments') using the current user's stored token.
+    See `CanvasClient.paginate`.
+    """
+    access_token, _ = get_oauth_token(request)
+    return get_client().paginate(
+        get_canvas_domain(request), path, access_token=access_token, params=params,
+        per_page=per_page, prefetch=prefetch, data_key=data_key)
+
 
 def handle_missing_token(request):
     """
     Redirect user to canvas with a request for token.
+
+    Requests of a session that need a token while its authorization is still
+    pending (for CANVAS_OAUTH_PENDING_AUTHORIZATION_TIMEOUT seconds) reuse
+    its state, so several tabs or parallel XHRs don't invalidate each
+    other's state.  XHRs get an "authorization pending" response instead of
+    a redirect.
     """
-    # Store where the user came from so they can be redirected back there
-    # at the end.  https://canvas.instructure.com/doc/api/file.oauth.html
-    request.session["canvas_oauth_initial_uri"] = request.get_full_path()
+    domain = get_canvas_domain(request)
+    oauth_redirect_uri = request.build_absolute_uri(reverse('canvas-oauth-callback'))
+    if settings.CANVAS_OAUTH_STATELESS_STATE:
+        # Everything the callback needs travels in the signed state itself,
+        # and concurrent states are valid independently of each other.  The
+        # state is bound to this browser through a cookie.
+        binding = state.get_binding(request)
+        oauth_request_state = state.make_state(
+            redirect_uri=oauth_redirect_uri,
+            initial_uri=request.get_full_path(),
+            user_id=request.POST.get("user_id"),
+            course_id=request.POST.get("custom_canvas_course_id"),
+            canvas_domain=domain,
+            binding=binding)
+        response = _get_authorize_response(request, domain, oauth_redirect_uri, oauth_request_state)
+        state.set_binding_cookie(request, response, binding)
+        return response
+
+    oauth_request_state = _get_pending_state(request, domain)
+    if oauth_request_state is None:
+        oauth_request_state = _start_authorization(request, domain, oauth_redirect_uri)
+    else:
+        logger.debug("Reusing pending OAuth state for request: %s", request.get_full_path())
+        metrics.increment(metrics.COALESCED_AUTHORIZATIONS)
 
     # The request state is a recommended security check on the callback, so
     # store in session for later
-    oauth_request_state = get_random_string(12)
     request.session["canvas_oauth_request_state"] = oauth_request_state
 
     # The return URI is required to be the same when POSTing to generate
     # a token on callback, so also store it in session (although it could
     # be regenerated again via the same method call).
-    oauth_redirect_uri = request.build_absolute_uri(reverse('canvas-oauth-callback'))
     request.session["canvas_oauth_redirect_uri"] = oauth_redirect_uri
 
-    
+    return _get_authorize_response(request, domain, oauth_redirect_uri, oauth_request_state)
+
+
+def _start_authorization(request, domain, oauth_redirect_uri):
+    """Stores the data of a new OAuth state for the callback, and returns the state."""
+    oauth_request_state = get_random_string(12)
+    pending_key = _get_pending_key(request, domain)
+    if pending_key is not None:
+        if not cache.add(pending_key, oauth_request_state,
+                         settings.CANVAS_OAUTH_PENDING_AUTHORIZATION_TIMEOUT):
+            # A concurrent request of the session started one first
+            pending_state = cache.get(pending_key)
+            if pending_state is not None:
+                metrics.increment(metrics.COALESCED_AUTHORIZATIONS)
+                return pending_state
+
+    # Store where the user came from so they can be redirected back there
+    # at the end.  https://canvas.instructure.com/doc/api/file.oauth.html
+    request.session["canvas_oauth_initial_uri"] = request.get_full_path()
+    request.session["canvas_oauth_request_started"] = time.time()
+
     state_data = {
         "redirect_uri": oauth_redirect_uri,
         "initial_uri": request.get_full_path(),
@@ -98,40 +382,102 @@ def handle_missing_token(request):
         "user_id": request.POST.get("user_id"),
         "user": request.user,
         "course_id": request.POST.get("custom_canvas_course_id"),
+        "canvas_domain": domain,
+        "pending_key": pending_key,
     }
 
 
     # Store for 10 minutes (600 seconds)
     cache.set(f"oauth_state:{oauth_request_state}", state_data, timeout=600)
+    return oauth_request_state
 
 
+def _get_pending_state(request, domain):
+    """
+    Returns the state of the session's pending authorization on the domain,
+    or None if there is none.
+    """
+    timeout = settings.CANVAS_OAUTH_PENDING_AUTHORIZATION_TIMEOUT
+    if not timeout:
+        return None
+    oauth_request_state = request.session.get("canvas_oauth_request_state")
+    started = request.session.get("canvas_oauth_request_started")
+    if oauth_request_state and started and time.time() - started < timeout:
+        state_data = cache.get(f"oauth_state:{oauth_request_state}")
+        if state_data is not None and state_data.get("canvas_domain") == domain:
+            return oauth_request_state
+    # Concurrent requests don't see each other's session changes
+    pending_key = _get_pending_key(request, domain)
+    if pending_key is not None:
+        return cache.get(pending_key)
+    return None
+
+
+def _get_pending_key(request, domain):
+    session_key = getattr(request.session, 'session_key', None)
+    if not session_key or not settings.CANVAS_OAUTH_PENDING_AUTHORIZATION_TIMEOUT:
+        return None
+    return f"canvas_oauth:pending:{domain}:{session_key}"
+
+
+def _is_xhr(request):
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return True
+    accept = request.headers.get('accept', '')
+    return 'application/json' in accept and 'text/html' not in accept
+
+
+def _get_authorize_response(request, domain, oauth_redirect_uri, oauth_request_state):
     authorize_url = canvas.get_oauth_login_url(
-        settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+        domain,
         redirect_uri=oauth_redirect_uri,
         state=oauth_request_state,
         scopes=settings.CANVAS_OAUTH_SCOPES)
 
-    logger.info("Redirecting user to %s" % authorize_url)
+    if _is_xhr(request):
+        # Redirects to Canvas are of no use to scripts; the page can send the
+        # user to the authorize URL once, whatever number of XHRs failed
+        logger.info("Authorization pending for XHR: %s", request.get_full_path())
+        return JsonResponse(
+            {"error": "authorization_pending", "authorize_url": authorize_url}, status=401)
+
+    logger.info("Redirecting user to %s", authorize_url)
     return HttpResponseRedirect(authorize_url)
 
 
-def get_user_data(access_token):
+def get_user_data(access_token, domain=None, user_id=None):
     # Fetch Canvas user info using access token
+    domain = domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN
     try:
-        #TODO: Remove hard-coded url
-        user_response = requests.get(
-            "https://" + settings.CANVAS_OAUTH_CANVAS_DOMAIN + "/api/v1/users/self",
+        return get_client().get_json(
+            domain,
+            "/api/v1/users/self",
             #state_data.get("user_info_url", "https://canvas.local/api/v1/users/self"),
-            headers={"Authorization": f"Bearer {access_token}"},
-            timeout=10,
+            access_token=access_token,
+            owner=get_user_owner(user_id, domain) if user_id is not None else None,
         )
-        user_response.raise_for_status()
     except requests.RequestException as e:
         return HttpResponseBadRequest(f"Failed to fetch Canvas user: {e}")
 
+
+async def aget_user_data(access_token, domain=None):
+    """Async version of `get_user_data`."""
+    import httpx
+
+    try:
+        user_response = await get_async_client().get(
+            domain or settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+            "/api/v1/users/self",
+            access_token=access_token,
+        )
+        user_response.raise_for_status()
+    except httpx.HTTPError as e:
+        return HttpResponseBadRequest(f"Failed to fetch Canvas user: {e}")
+
     return user_response.json()
 
 
+@metrics.timed_view(metrics.CALLBACK_SECONDS)
 def oauth_callback(request):
     """ Receives the callback from canvas and saves the token to the database.
         Redirects user to the page they came from at the start of the oauth
@@ -140,67 +486,140 @@ def oauth_callback(request):
     if error:
         return render_oauth_error(error)
     code = request.GET.get('code')
-    state = request.GET.get('state')
+    oauth_request_state = request.GET.get('state')
 
-    state = request.GET.get("state")
+    if settings.CANVAS_OAUTH_STATELESS_STATE:
+        state_data = state.load_state(oauth_request_state, request.COOKIES.get(state.COOKIE_NAME))
+        if state_data is None:
+            return HttpResponseBadRequest("Invalid or expired OAuth state")
+    else:
+        state_data = cache.get(f"oauth_state:{oauth_request_state}")
+        if state_data is None:
+            return HttpResponseBadRequest("Invalid or expired OAuth state")
 
-    state_data = cache.get(f"oauth_state:{state}")
-    if state_data is None:
-        return HttpResponseBadRequest("Invalid or expired OAuth state")
+        if request.session.has_key('canvas_oauth_request_state'):
+            if (oauth_request_state != request.session['canvas_oauth_request_state']):
+                logger.warning("OAuth state mismatch for request: %s", request.get_full_path())
+                raise InvalidOAuthStateError("OAuth state mismatch!")
 
-    if request.session.has_key('canvas_oauth_request_state'):
-        if (state != request.session['canvas_oauth_request_state']):
-            logger.warning("OAuth state mismatch for request: %s" % request.get_full_path())
-            raise InvalidOAuthStateError("OAuth state mismatch!")
+    # States from before multi-domain support don't carry the domain
+    domain = state_data.get("canvas_domain") or get_canvas_domain(request)
 
     # Make the `authorization_code` grant type request to retrieve a
-    access_token, expires, refresh_token = canvas.get_access_token(
-        domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
+    access_token, expires, refresh_token, user_data = canvas.get_access_token(
+        domain=domain,
         grant_type='authorization_code',
         redirect_uri=state_data["redirect_uri"],
         #redirect_uri=request.session["canvas_oauth_redirect_uri"],
         #redirect_uri='https://localhost:8000/oauth/oauth-callback',
-        code=code)
+        code=code,
+        include_user=True)
+
+    # The token response identifies the user, so the full profile can be
+    # fetched after redirecting (see CANVAS_OAUTH_PROFILE_UPDATER).  If it
+    # doesn't, the profile is fetched now and saved with the user instead.
+    profile_fetched = not user_data or "id" not in user_data
+    if profile_fetched:
+        user_data = get_user_data(access_token, domain)
+
+    get_or_create = CanvasUser.objects.update_or_create if profile_fetched else CanvasUser.objects.get_or_create
+    canvas_user, _ = get_or_create(
+        canvas_user_id=user_data["id"],
+        canvas_domain=domain,
+        defaults=get_profile_fields(user_data),
+    )
+
+    obj = settings.get_token_store().save(canvas_user, domain, access_token, refresh_token, expires)
+    logger.info("CanvasOAuth2Token instance created: %s", obj.pk)
+    invalidate_token(canvas_user.canvas_user_id, domain)
+    signals.oauth_callback_completed.send(
+        sender=CanvasOAuth2Token, canvas_user=canvas_user, oauth_token=obj, domain=domain)
+    if not profile_fetched:
+        settings.get_profile_updater().schedule(
+            canvas_user.canvas_user_id, access_token, domain)
+
+    #initial_uri = request.session['canvas_oauth_initial_uri']
+    #initial_uri = '/canvas_plugin/'
+    
+    request.session['user_id'] = canvas_user.canvas_user_id
+    # Requests needing a token from now on start a new authorization
+    request.session.pop('canvas_oauth_request_started', None)
+    if state_data.get("pending_key"):
+        cache.delete(state_data["pending_key"])
+
+    return redirect(_get_callback_redirect_url(canvas_user, state_data))
+
+
+@metrics.timed_view(metrics.CALLBACK_SECONDS)
+async def aoauth_callback(request):
+    """ Async version of `oauth_callback`, routed by `canvas_oauth.async_urls`.
+        The token grant and profile fetch use the non-blocking Canvas client
+        and the database writes use the async ORM. """
+    error = request.GET.get('error')
+    if error:
+        return render_oauth_error(error)
+    code = request.GET.get('code')
+    oauth_request_state = request.GET.get('state')
+
+    if settings.CANVAS_OAUTH_STATELESS_STATE:
+        state_data = await state.aload_state(oauth_request_state, request.COOKIES.get(state.COOKIE_NAME))
+        if state_data is None:
+            return HttpResponseBadRequest("Invalid or expired OAuth state")
+    else:
+        state_data = await cache.aget(f"oauth_state:{oauth_request_state}")
+        if state_data is None:
+            return HttpResponseBadRequest("Invalid or expired OAuth state")
+
+        session_state = await sync_to_async(request.session.get)('canvas_oauth_request_state')
+        if session_state is not None and oauth_request_state != session_state:
+            logger.warning("OAuth state mismatch for request: %s", request.get_full_path())
+            raise InvalidOAuthStateError("OAuth state mismatch!")
 
+    domain = state_data.get("canvas_domain") or await sync_to_async(get_canvas_domain)(request)
 
-    user_data = get_user_data(access_token)
+    access_token, expires, refresh_token, user_data = await canvas.aget_access_token(
+        domain=domain,
+        grant_type='authorization_code',
+        redirect_uri=state_data["redirect_uri"],
+        code=code,
+        include_user=True)
 
+    profile_fetched = not user_data or "id" not in user_data
+    if profile_fetched:
+        user_data = await aget_user_data(access_token, domain)
 
-    canvas_user, _ = CanvasUser.objects.get_or_create(
+    aget_or_create = CanvasUser.objects.aupdate_or_create if profile_fetched else CanvasUser.objects.aget_or_create
+    canvas_user, _ = await aget_or_create(
         canvas_user_id=user_data["id"],
-        defaults={
-            "name": user_data.get("name", ""),
-            "sortable_name": user_data.get("sortable_name", ""),
-            "short_name": user_data.get("short_name", ""),
-            "email": user_data.get("email", ""),
-            "avatar_url": user_data.get("avatar_url", ""),
-        },
+        canvas_domain=domain,
+        defaults=get_profile_fields(user_data),
     )
 
-    obj, _ = CanvasOAuth2Token.objects.update_or_create(
-        user=canvas_user,
-        canvas_domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
-        defaults={
-        "access_token": access_token,
-        "expires": expires,
-        "refresh_token": refresh_token})
-    logger.info("CanvasOAuth2Token instance created: %s" % obj.pk)
+    obj = await settings.get_token_store().asave(canvas_user, domain, access_token, refresh_token, expires)
+    logger.info("CanvasOAuth2Token instance created: %s", obj.pk)
+    await ainvalidate_token(canvas_user.canvas_user_id, domain)
+    signals.oauth_callback_completed.send(
+        sender=CanvasOAuth2Token, canvas_user=canvas_user, oauth_token=obj, domain=domain)
+    if not profile_fetched:
+        await sync_to_async(settings.get_profile_updater().schedule)(
+            canvas_user.canvas_user_id, access_token, domain)
+
+    await sync_to_async(request.session.__setitem__)('user_id', canvas_user.canvas_user_id)
+    await sync_to_async(request.session.pop)('canvas_oauth_request_started', None)
+    if state_data.get("pending_key"):
+        await cache.adelete(state_data["pending_key"])
 
+    return redirect(_get_callback_redirect_url(canvas_user, state_data))
+
+
+def _get_callback_redirect_url(canvas_user, state_data):
     initial_uri = state_data['initial_uri']
-    #initial_uri = request.session['canvas_oauth_initial_uri']
-    #initial_uri = '/canvas_plugin/'
-    
-    request.session['user_id'] = canvas_user.canvas_user_id
-    
-    logger.info("Redirecting user back to initial uri %s" % initial_uri)
-    redirect_url = append_query_params(initial_uri, {
+    logger.info("Redirecting user back to initial uri %s", initial_uri)
+    return append_query_params(initial_uri, {
         "user_id": canvas_user.canvas_user_id,
         "custom_canvas_course_id": state_data.get("course_id", "default_course_id"),
     })
 
-
-    return redirect(redirect_url)
-
 def append_query_params(url, params):
     parsed = urlparse(url)
     query = parse_qs(parsed.query)
@@ -208,33 +627,96 @@ def append_query_params(url, params):
     encoded_query = urlencode(query, doseq=True)
     return urlunparse(parsed._replace(query=encoded_query))
 
-def refresh_oauth_token(request, oauth_token):
+def refresh_oauth_token(request, oauth_token, buffer=None):
     """ Makes refresh_token grant request with Canvas to get a fresh
     access token.  Update the oauth token model with the new token
     and new expiration date and return the saved model.
+
+    Concurrent refreshes of the same token are coalesced: requests wait on
+    the configured refresh lock, and those that lose the race return the
+    token saved by the winner instead of making their own grant request.
+    The database write is a compare-and-swap on `updated_on`, so a refresh
+    never overwrites a newer token.  `buffer` is passed on to
+    `refresh_access_token`.
     """
     #oauth_token = request.user.canvas_oauth2_token
+    _clear_request_token(request, oauth_token.canvas_domain)
+    return refresh_access_token(
+        oauth_token,
+        redirect_uri=request.build_absolute_uri(reverse('canvas-oauth-callback')),
+        buffer=buffer)
 
-    # Get the new access token and expiration date via
-    # a refresh token grant
-    oauth_token.access_token, oauth_token.expires, _ = canvas.get_access_token(
-        domain=settings.CANVAS_OAUTH_CANVAS_DOMAIN,
-        grant_type='refresh_token',
-        redirect_uri=request.build_absolute_uri(
-            reverse('canvas-oauth-callback')),
-        refresh_token=oauth_token.refresh_token)
 
-    # Update the model with new token and expiration
-    oauth_token.save()
+async def arefresh_oauth_token(request, oauth_token, buffer=None):
+    """ Async version of `refresh_oauth_token`.  The refresh runs in a worker
+    thread because the refresh lock and compare-and-swap are synchronous;
+    refreshes are rare and coalesced, so this stays off the hot path.
+    """
+    return await sync_to_async(refresh_oauth_token)(request, oauth_token, buffer=buffer)
+
 
+def refresh_access_token(oauth_token, redirect_uri=None, buffer=None):
+    """ Refreshes the given token outside of a request, as done by
+    `refresh_oauth_token`.  A token that no longer expires within `buffer`
+    (by default CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER) once the refresh lock
+    is held is assumed to have been refreshed by someone else and is
+    returned without a grant request.
+    """
+    if buffer is None:
+        buffer = settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
+
+    with metrics.timer(metrics.TOKEN_REFRESH_SECONDS) as refresh_timer:
+        oauth_token, refresh_timer.outcome = _refresh_access_token(oauth_token, redirect_uri, buffer)
+    if refresh_timer.outcome == 'refreshed':
+        early_refresh.record_refresh_latency(oauth_token.canvas_domain, refresh_timer.elapsed)
+    signals.token_refreshed.send(
+        sender=CanvasOAuth2Token, oauth_token=oauth_token,
+        outcome=refresh_timer.outcome, duration=refresh_timer.elapsed)
     return oauth_token
 
 
+def _refresh_access_token(oauth_token, redirect_uri, buffer):
+    """Returns the refreshed token, and 'refreshed' or 'coalesced'."""
+    token_store = settings.get_token_store()
+    with settings.get_refresh_lock().hold(oauth_token):
+        # Another request may have refreshed the token while we waited
+        current_token = token_store.reload(oauth_token)
+        if current_token is not None and not current_token.expires_within(buffer):
+            logger.info("Token for user %s was refreshed by another request", oauth_token.user_id)
+            return current_token, 'coalesced'
+
+        # Get the new access token and expiration date via
+        # a refresh token grant
+        access_token, expires, _ = canvas.get_access_token(
+            domain=oauth_token.canvas_domain,
+            grant_type='refresh_token',
+            redirect_uri=redirect_uri,
+            refresh_token=oauth_token.refresh_token)
+
+        # Save the new token and expiration, unless someone else has saved
+        # a newer token in the meantime
+        updated_on = timezone.now()
+        updated = token_store.update(oauth_token, access_token, expires, updated_on)
+
+    invalidate_token(oauth_token.user.canvas_user_id, oauth_token.canvas_domain)
+
+    if not updated:
+        current_token = token_store.reload(oauth_token)
+        if current_token is not None:
+            logger.info("Token for user %s was saved by a concurrent refresh", oauth_token.user_id)
+            return current_token, 'coalesced'
+
+    oauth_token.access_token = access_token
+    oauth_token.expires = expires
+    oauth_token.updated_on = updated_on
+    return oauth_token, 'refreshed'
+
+
 def render_oauth_error(error_message):
     """ If there is an error in the oauth callback, attempts to render it in a
         template that can be styled; otherwise, if OAUTH_ERROR_TEMPLATE not
         found, this will return a HttpResponse with status 403 """
-    logger.error("OAuth error %s" % error_message)
+    logger.error("OAuth error %s", error_message)
     try:
         template = loader.render_to_string(settings.CANVAS_OAUTH_ERROR_TEMPLATE,
                                            {"message": error_message})
@@ -0,0 +1,114 @@
+"""
+Canvas user profile updates.
+
+``oauth_callback`` creates the ``CanvasUser`` from the ``user`` object of the
+token response (id and name) and hands the full profile fetch
+(``/api/v1/users/self``) to the updater configured with
+``CANVAS_OAUTH_PROFILE_UPDATER``.  ``InlineProfileUpdater`` fetches it before
+the callback returns; ``ThreadPoolProfileUpdater`` fetches it in the
+background, updating the profiles queued meanwhile with a single
+``bulk_update``.  Subclass `ProfileUpdater` to hand the work to a task queue
+instead.
+"""
+import logging
+import operator
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+
+import requests
+from django.db import close_old_connections
+from django.db.models import Q
+
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.client import get_client
+from canvas_oauth.models import CanvasUser
+from canvas_oauth.response_cache import get_user_owner
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FIELDS = ('name', 'sortable_name', 'short_name', 'email', 'avatar_url')
+
+
+def get_profile_fields(user_data):
+    """Maps a Canvas user object to `CanvasUser` fields."""
+    return {field: user_data.get(field) or "" for field in PROFILE_FIELDS}
+
+
+class ProfileUpdater(ABC):
+    """
+    Abstract base class for updating `CanvasUser` profiles from Canvas.
+    """
+
+    @abstractmethod
+    def schedule(self, canvas_user_id, access_token, domain):
+        """Arranges for the user's profile to be fetched and saved"""
+        pass
+
+    def fetch_profile(self, access_token, domain, canvas_user_id=None):
+        owner = get_user_owner(canvas_user_id, domain) if canvas_user_id is not None else None
+        return get_client().get_json(domain, "/api/v1/users/self", access_token=access_token, owner=owner)
+
+    def update_profiles(self, pending):
+        """
+        Fetches the profiles of `pending`, a dict of (canvas_user_id, domain)
+        to access token, and saves them with one bulk update.
+        """
+        profiles = {}
+        for (canvas_user_id, domain), access_token in pending.items():
+            try:
+                profiles[(str(canvas_user_id), domain)] = self.fetch_profile(access_token, domain, canvas_user_id)
+            except requests.RequestException as e:
+                logger.warning("Failed to fetch Canvas profile for user %s: %s", canvas_user_id, e)
+        if not profiles:
+            return []
+
+        users = list(CanvasUser.objects.filter(reduce(operator.or_, (
+            Q(canvas_user_id=canvas_user_id, canvas_domain=domain) for canvas_user_id, domain in profiles))))
+        for canvas_user in users:
+            profile = profiles[(canvas_user.canvas_user_id, canvas_user.canvas_domain)]
+            for field, value in get_profile_fields(profile).items():
+                setattr(canvas_user, field, value)
+        if users:
+            CanvasUser.objects.bulk_update(users, PROFILE_FIELDS)
+        return users
+
+
+class InlineProfileUpdater(ProfileUpdater):
+    """Fetches the profile immediately, in the calling thread."""
+
+    def schedule(self, canvas_user_id, access_token, domain):
+        self.update_profiles({(canvas_user_id, domain): access_token})
+
+
+class ThreadPoolProfileUpdater(ProfileUpdater):
+    """
+    Fetches profiles on a background thread pool.  Profiles scheduled while
+    an update is waiting to run are fetched and saved together.
+    """
+
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or oauth_settings.CANVAS_OAUTH_PROFILE_UPDATE_WORKERS,
+            thread_name_prefix='canvas-oauth-profile')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, canvas_user_id, access_token, domain):
+        with self._lock:
+            submit = not self._pending
+            self._pending[(canvas_user_id, domain)] = access_token
+        if submit:
+            self.executor.submit(self.flush)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        try:
+            if pending:
+                self.update_profiles(pending)
+        except Exception:
+            logger.exception("Failed to update %s Canvas profiles", len(pending))
+        finally:
+            close_old_connections()
@@ -0,0 +1,210 @@
+"""
+Adaptive scheduler for Canvas API rate limits.
+
+Canvas throttles API requests per access token with a leaky bucket, and
+reports what is left of it on every response in ``X-Rate-Limit-Remaining``
+(along with the cost of the request in ``X-Request-Cost``).  The scheduler
+tracks these headers per token and Canvas domain, paces requests when the
+bucket runs low, and adjusts how many requests may run concurrently for a
+token: halving it when Canvas throttles a request and raising it again while
+there is plenty of quota left.  Waiting for a slot or pacing never runs past
+the current deadline (see ``canvas_oauth.deadline``).
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from canvas_oauth import deadline
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.exceptions import DeadlineExceededError
+
+logger = logging.getLogger(__name__)
+
+
+class _TokenState(object):
+
+    def __init__(self, concurrency):
+        self.condition = threading.Condition()
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.waiting = 0
+        self.remaining = None
+        self.cost = None
+
+    @property
+    def idle(self):
+        return not self.in_flight and not self.waiting
+
+
+class RateLimitScheduler(object):
+    """
+    Per-token, per-domain request scheduler driven by Canvas rate limit
+    headers.  Use `slot()` around a request and `record()` with its response.
+    """
+
+    def __init__(self, max_concurrency=None, min_concurrency=1, low_watermark=None,
+                 high_watermark=None, leak_rate=10.0, max_delay=5.0, max_tokens=10000):
+        self.max_concurrency = max_concurrency or oauth_settings.CANVAS_OAUTH_RATE_LIMIT_MAX_CONCURRENCY
+        self.min_concurrency = min_concurrency
+        self.low_watermark = low_watermark or oauth_settings.CANVAS_OAUTH_RATE_LIMIT_LOW_WATERMARK
+        self.high_watermark = high_watermark or self.low_watermark * 3
+        # Rate (units per second) at which Canvas refills the bucket
+        self.leak_rate = leak_rate
+        self.max_delay = max_delay
+        self.max_tokens = max_tokens
+        self.throttle_events = 0
+        self.paced_requests = 0
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, domain, access_token):
+        # Don't keep access tokens in memory longer than needed
+        return (domain, hashlib.sha256(access_token.encode()).hexdigest()[:16])
+
+    def _get_state(self, domain, access_token):
+        key = self.get_key(domain, access_token)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = _TokenState(self.max_concurrency)
+                self._evict()
+            else:
+                self._states.move_to_end(key)
+            return state
+
+    def _evict(self):
+        # Tokens rotate hourly, so forget the least recently used idle ones
+        for key in list(self._states):
+            if len(self._states) <= self.max_tokens:
+                break
+            if self._states[key].idle:
+                del self._states[key]
+
+    @contextmanager
+    def slot(self, domain, access_token):
+        """
+        Waits until a request may be sent with the given token, pacing it if
+        the token's remaining quota is low.  Raises DeadlineExceededError if
+        the current deadline runs out first.
+        """
+        state = self._get_state(domain, access_token)
+        with state.condition:
+            state.waiting += 1
+            try:
+                while state.in_flight >= state.concurrency:
+                    state.condition.wait(_get_wait_timeout(None))
+            finally:
+                state.waiting -= 1
+            state.in_flight += 1
+            delay = self._get_delay(state)
+
+        try:
+            if delay > 0:
+                # Fail now rather than sleep through the rest of the deadline
+                delay = _get_wait_timeout(delay, delay)
+                with self._lock:
+                    self.paced_requests += 1
+                time.sleep(delay)
+            yield
+        finally:
+            with state.condition:
+                state.in_flight -= 1
+                state.condition.notify()
+
+    def _get_delay(self, state):
+        """
+        Seconds to wait so that the bucket (less what the requests already in
+        flight are expected to cost) stays above the low watermark.
+        """
+        if state.remaining is None:
+            return 0
+        expected = state.remaining - (state.cost or 0) * (state.in_flight - 1)
+        if expected >= self.low_watermark:
+            return 0
+        return min(self.max_delay, (self.low_watermark - expected) / self.leak_rate)
+
+    def record(self, domain, access_token, response):
+        """Updates the token's quota and concurrency from a Canvas response."""
+        state = self._get_state(domain, access_token)
+        remaining = _get_float_header(response, 'X-Rate-Limit-Remaining')
+        cost = _get_float_header(response, 'X-Request-Cost')
+
+        with state.condition:
+            if remaining is not None:
+                state.remaining = remaining
+            if cost is not None:
+                state.cost = cost if state.cost is None else 0.8 * state.cost + 0.2 * cost
+
+            if is_throttled(response):
+                with self._lock:
+                    self.throttle_events += 1
+                state.concurrency = max(self.min_concurrency, state.concurrency // 2)
+                logger.warning("Canvas rate limit exceeded on %s; concurrency lowered to %s",
+                               domain, state.concurrency)
+            elif state.remaining is not None and state.remaining >= self.high_watermark:
+                if state.concurrency < self.max_concurrency:
+                    state.concurrency += 1
+                    state.condition.notify()
+            elif state.remaining is not None and state.remaining < self.low_watermark:
+                state.concurrency = max(self.min_concurrency, state.concurrency - 1)
+
+    def get_metrics(self):
+        with self._lock:
+            states = list(self._states.values())
+            throttle_events, paced_requests = self.throttle_events, self.paced_requests
+        return {
+            'queue_depth': sum(state.waiting for state in states),
+            'in_flight': sum(state.in_flight for state in states),
+            'throttle_events': throttle_events,
+            'paced_requests': paced_requests,
+            'tracked_tokens': len(states),
+        }
+
+
+def _get_wait_timeout(timeout, needed=0):
+    """
+    Returns `timeout` capped by the time left before the current deadline.
+    Raises DeadlineExceededError if less than `needed` seconds are left.
+    """
+    remaining = deadline.get_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= needed:
+        raise DeadlineExceededError("No time left to wait for a Canvas rate limit slot")
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def is_throttled(response):
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and 'Rate Limit Exceeded' in response.text
+
+
+def _get_float_header(response, name):
+    value = response.headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_rate_limit_scheduler():
+    """
+    Returns the shared RateLimitScheduler, or None if rate limit scheduling
+    is disabled with CANVAS_OAUTH_RATE_LIMIT_ENABLED.
+    """
+    global _scheduler
+    if not oauth_settings.CANVAS_OAUTH_RATE_LIMIT_ENABLED:
+        return None
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RateLimitScheduler()
+    return _scheduler
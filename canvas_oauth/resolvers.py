@@ -1,5 +1,7 @@
 import logging
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from urllib.parse import urlparse
 
 from django.conf import settings
@@ -26,16 +28,28 @@ class LtiBasedResolver(EnvironmentResolver):
       - Direct from LTI custom fields (api_domain=$Canvas.api.domain)
       - From request session storage
       - From Canvas URLs in LTI claims (fallback)
+
+    Resolved domains are memoized per LTI issuer and deployment_id, since a
+    deployment always belongs to a single Canvas instance, so repeat launches
+    skip claim parsing.  The memo holds at most `memo_maxsize` entries.
     """
 
+    memo_maxsize = 1024
+
+    def __init__(self):
+        self._domain_memo = OrderedDict()
+        self._domain_memo_lock = threading.Lock()
+
     def resolve_domain(self, request, **kwargs):
         # Always check LTI data first if available to ensure fresh launches use correct domain
         lti_data = kwargs.get('lti_data')
         if lti_data:
-            canvas_domain = self.extract_domain_from_lti_data(lti_data)
+            canvas_domain = self.get_domain_for_launch(lti_data)
             if canvas_domain:
-                # Update both session and request cache with fresh domain
-                request.session['canvas_domain'] = canvas_domain
+                # Update both session and request cache with fresh domain,
+                # without marking the session as modified if it is unchanged
+                if request.session.get('canvas_domain') != canvas_domain:
+                    request.session['canvas_domain'] = canvas_domain
                 request._canvas_domain = canvas_domain
                 return canvas_domain
 
@@ -49,6 +63,30 @@ class LtiBasedResolver(EnvironmentResolver):
 
         return None
 
+    def get_domain_for_launch(self, lti_data):
+        """
+        Extract the Canvas domain from LTI launch data, using the memo for
+        launches from a known issuer and deployment.
+        """
+        memo_key = (lti_data.get('iss'),
+                    lti_data.get('https://purl.imsglobal.org/spec/lti/claim/deployment_id'))
+        if not all(memo_key):
+            return self.extract_domain_from_lti_data(lti_data)
+
+        with self._domain_memo_lock:
+            canvas_domain = self._domain_memo.get(memo_key)
+            if canvas_domain is not None:
+                self._domain_memo.move_to_end(memo_key)
+                return canvas_domain
+
+        canvas_domain = self.extract_domain_from_lti_data(lti_data)
+        if canvas_domain:
+            with self._domain_memo_lock:
+                self._domain_memo[memo_key] = canvas_domain
+                while len(self._domain_memo) > self.memo_maxsize:
+                    self._domain_memo.popitem(last=False)
+        return canvas_domain
+
     def extract_domain_from_lti_data(self, lti_data):
         """
         Extract Canvas domain from LTI launch data.
@@ -0,0 +1,146 @@
+"""
+Conditional-request cache for Canvas API GET responses.
+
+Canvas returns an ``ETag`` (and often ``Last-Modified``) with API responses.
+With the response cache enabled, ``CanvasClient.get_json`` keeps the body of
+such responses per token owner and URL, and revalidates it with
+``If-None-Match``/``If-Modified-Since`` on the next call, so an unchanged
+resource comes back from Canvas as an empty 304.  Entries are stored by a
+pluggable backend (``CANVAS_OAUTH_RESPONSE_CACHE_BACKEND``): the in-process
+``LocalResponseCache`` or the Django cache based ``DjangoResponseCache``.
+"""
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+
+from django.core.cache import caches
+
+from canvas_oauth import settings as oauth_settings
+
+
+CachedResponse = namedtuple('CachedResponse', ['etag', 'last_modified', 'content'])
+
+
+class ResponseCache(ABC):
+    """
+    Abstract base class for response cache backends.  Keys are built by
+    `make_key` from the owner of the token and the full request URL.
+    """
+
+    key_prefix = 'canvas_oauth:response'
+
+    @abstractmethod
+    def get(self, key):
+        """Returns the CachedResponse stored under key, or None"""
+        pass
+
+    @abstractmethod
+    def set(self, key, entry):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    def make_key(self, owner, url):
+        return f"{self.key_prefix}:{owner}:{hashlib.sha256(url.encode()).hexdigest()}"
+
+
+class LocalResponseCache(ResponseCache):
+    """
+    Thread-safe, in-process LRU bounded both by number of entries and by
+    the total size of the cached bodies.
+    """
+
+    def __init__(self, maxsize=None, max_bytes=None):
+        self.maxsize = maxsize or oauth_settings.CANVAS_OAUTH_RESPONSE_CACHE_MAXSIZE
+        self.max_bytes = max_bytes or oauth_settings.CANVAS_OAUTH_RESPONSE_CACHE_MAX_BYTES
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        if len(entry.content) > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.content)
+            self._data[key] = entry
+            self.size += len(entry.content)
+            while len(self._data) > self.maxsize or self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted.content)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry.content)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class DjangoResponseCache(ResponseCache):
+    """
+    Stores responses in a Django cache, shared between worker processes.
+    Eviction is left to the cache backend; bodies larger than
+    CANVAS_OAUTH_RESPONSE_CACHE_MAX_BYTES are not stored.
+    """
+
+    def __init__(self, alias=None, timeout=None, max_bytes=None):
+        self.alias = alias or oauth_settings.CANVAS_OAUTH_RESPONSE_CACHE_ALIAS
+        self.timeout = timeout or oauth_settings.CANVAS_OAUTH_RESPONSE_CACHE_TIMEOUT
+        self.max_bytes = max_bytes or oauth_settings.CANVAS_OAUTH_RESPONSE_CACHE_MAX_BYTES
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        return CachedResponse(*entry) if entry is not None else None
+
+    def set(self, key, entry):
+        if len(entry.content) > self.max_bytes:
+            self.delete(key)
+            return
+        self.cache.set(key, tuple(entry), self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+def get_response_cache():
+    """
+    Returns the configured response cache backend, or None if response
+    caching is disabled with CANVAS_OAUTH_RESPONSE_CACHE_ENABLED.
+    """
+    if not oauth_settings.CANVAS_OAUTH_RESPONSE_CACHE_ENABLED:
+        return None
+    return oauth_settings.get_response_cache_backend()
+
+
+def get_owner(access_token):
+    """Default cache owner for a token, so tokens never appear in cache keys"""
+    return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+
+def get_user_owner(canvas_user_id, domain):
+    """
+    Cache owner for a Canvas user.  Unlike the default token hash, it
+    survives token refreshes, so cached entries stay usable across them.
+    """
+    return f"{domain}:{canvas_user_id}"
@@ -0,0 +1,100 @@
+"""
+Database router for the canvas_oauth tables.
+
+Add ``canvas_oauth.routers.CanvasOAuthRouter`` to ``DATABASE_ROUTERS`` to
+send writes to ``CanvasUser`` and ``CanvasOAuth2Token`` to
+CANVAS_OAUTH_DATABASE (which may be a small database of their own) and
+reads to one of CANVAS_OAUTH_READ_DATABASES.  Reads that must see a token
+just saved by a refresh or callback go to the write database instead: for
+CANVAS_OAUTH_DATABASE_STICKY_SECONDS after a write, the user's token
+lookups in any process (see `stick` and `is_sticky`), and reads in the
+same thread or task.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.core.cache import caches
+
+from canvas_oauth import settings as oauth_settings
+
+APP_LABEL = 'canvas_oauth'
+
+# Monotonic time until which reads in this context go to the write database
+_primary_until = ContextVar('canvas_oauth_primary_until', default=0.0)
+
+
+class CanvasOAuthRouter(object):
+    """Routes the canvas_oauth models, and leaves the others to the next router."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        read_databases = oauth_settings.CANVAS_OAUTH_READ_DATABASES
+        if not read_databases or _primary_until.get() > time.monotonic():
+            return oauth_settings.CANVAS_OAUTH_DATABASE
+        return random.choice(read_databases)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        return oauth_settings.CANVAS_OAUTH_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == APP_LABEL and obj2._meta.app_label == APP_LABEL:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != APP_LABEL:
+            return None
+        # Read databases are replicas of the write database
+        return db == oauth_settings.CANVAS_OAUTH_DATABASE
+
+
+@contextmanager
+def use_primary(enabled=True):
+    """Sends the reads made inside the block to the write database."""
+    if not enabled:
+        yield
+        return
+    reset_token = _primary_until.set(float('inf'))
+    try:
+        yield
+    finally:
+        _primary_until.reset(reset_token)
+
+
+def stick(user_id, domain):
+    """
+    Records a write of the user's token, so reads of it go to the write
+    database until replicas have caught up.  A no-op without read databases.
+    """
+    if not oauth_settings.CANVAS_OAUTH_READ_DATABASES:
+        return
+    sticky_seconds = oauth_settings.CANVAS_OAUTH_DATABASE_STICKY_SECONDS
+    _primary_until.set(max(_primary_until.get(), time.monotonic() + sticky_seconds))
+    _get_sticky_cache().set(_get_sticky_key(user_id, domain), 1, sticky_seconds)
+
+
+def is_sticky(user_id, domain):
+    """Returns True if reads of the user's token must go to the write database."""
+    if not oauth_settings.CANVAS_OAUTH_READ_DATABASES:
+        return False
+    return _get_sticky_cache().get(_get_sticky_key(user_id, domain)) is not None
+
+
+async def ais_sticky(user_id, domain):
+    """Async version of `is_sticky`."""
+    if not oauth_settings.CANVAS_OAUTH_READ_DATABASES:
+        return False
+    return await _get_sticky_cache().aget(_get_sticky_key(user_id, domain)) is not None
+
+
+def _get_sticky_cache():
+    return caches[oauth_settings.CANVAS_OAUTH_DATABASE_STICKY_CACHE_ALIAS]
+
+
+def _get_sticky_key(user_id, domain):
+    return f"canvas_oauth:sticky:{domain}:{user_id}"
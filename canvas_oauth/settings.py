@@ -4,12 +4,11 @@ canvas_oauth specific settings
 """
 
 from datetime import timedelta
+from types import MappingProxyType
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
-from canvas_oauth import settings as oauth_settings
-
 
 def get_required_setting(setting_name):
     """
@@ -24,31 +23,72 @@ def get_required_setting(setting_name):
 
 def get_environment_resolver():
     """Get the configured environment resolver"""
-    resolver_path = getattr(settings, 'CANVAS_OAUTH_ENVIRONMENT_RESOLVER',
-                           'canvas_oauth.resolvers.SingleEnvironmentResolver')
+    return _get_configured_instance('CANVAS_OAUTH_ENVIRONMENT_RESOLVER',
+                                    'canvas_oauth.resolvers.SingleEnvironmentResolver')
+
+
+def get_response_cache_backend():
+    """Get the configured backend of the Canvas API response cache"""
+    return _get_configured_instance('CANVAS_OAUTH_RESPONSE_CACHE_BACKEND',
+                                    'canvas_oauth.response_cache.LocalResponseCache')
+
+
+def get_profile_updater():
+    """Get the configured updater that fetches Canvas user profiles"""
+    return _get_configured_instance('CANVAS_OAUTH_PROFILE_UPDATER',
+                                    'canvas_oauth.profile.ThreadPoolProfileUpdater')
+
+
+def get_refresh_lock():
+    """Get the configured lock used to serialize token refreshes"""
+    return _get_configured_instance('CANVAS_OAUTH_REFRESH_LOCK',
+                                    'canvas_oauth.locks.CacheLock')
+
+
+def get_token_store():
+    """Get the configured store that keeps Canvas OAuth2 tokens"""
+    return _get_configured_instance('CANVAS_OAUTH_TOKEN_STORE',
+                                    'canvas_oauth.stores.ModelTokenStore')
+
+
+def get_metrics_sink():
+    """Get the configured metrics sink, or None if metrics are disabled"""
+    if not getattr(settings, 'CANVAS_OAUTH_METRICS_SINK', None):
+        return None
+    return _get_configured_instance('CANVAS_OAUTH_METRICS_SINK', None)
+
 
-    module_path, class_name = resolver_path.rsplit('.', 1)
-    module = __import__(module_path, fromlist=[class_name])
-    resolver_class = getattr(module, class_name)
+# Instances of configured classes, keyed by class path.  They are created
+# once and shared between requests and threads.
+_configured_instances = {}
 
-    return resolver_class()
+
+def _get_configured_instance(setting_name, default_path):
+    class_path = getattr(settings, setting_name, default_path)
+    instance = _configured_instances.get(class_path)
+    if instance is None:
+        module_path, class_name = class_path.rsplit('.', 1)
+        module = __import__(module_path, fromlist=[class_name])
+        instance = _configured_instances.setdefault(class_path, getattr(module, class_name)())
+    return instance
 
 
 def get_canvas_credentials(domain):
     """
     Get Canvas OAuth credentials for a specific domain.
+
+    Credentials are looked up in the index compiled by
+    `build_credentials_index`, so the cost does not grow with the number of
+    configured environments.
     """
-    # Check for multi-environment config
-    environments_config = getattr(settings, 'CANVAS_OAUTH_ENVIRONMENTS', {})
-    for env_key, env_config in environments_config.items():
-        if env_config.get('domain') == domain:
-            client_id = env_config.get('client_id')
-            client_secret = env_config.get('client_secret')
-            if client_id and client_secret:
-                return client_id, client_secret, f"https://{domain}"
+    credentials = get_credentials_index().get(domain)
+    if credentials is not None:
+        return credentials
 
-    client_id = oauth_settings.get_client_id_for_domain(domain)
-    client_secret = oauth_settings.get_client_secret_for_domain(domain)
+    client_id = _domain_settings.get(_get_domain_setting_name(domain, 'CLIENT_ID'),
+                                     getattr(settings, 'CANVAS_OAUTH_CLIENT_ID', ''))
+    client_secret = _domain_settings.get(_get_domain_setting_name(domain, 'CLIENT_SECRET'),
+                                         getattr(settings, 'CANVAS_OAUTH_CLIENT_SECRET', ''))
 
     if not client_id or not client_secret:
         raise ImproperlyConfigured(
@@ -59,42 +99,304 @@ def get_canvas_credentials(domain):
     return client_id, client_secret, f"https://{domain}"
 
 
-# Single environment support - check if new multi-environment config exists
-if hasattr(settings, 'CANVAS_OAUTH_ENVIRONMENTS') and settings.CANVAS_OAUTH_ENVIRONMENTS:
-    pass
-else:
-    CANVAS_OAUTH_CLIENT_ID = get_required_setting('CANVAS_OAUTH_CLIENT_ID')
-    CANVAS_OAUTH_CLIENT_SECRET = get_required_setting('CANVAS_OAUTH_CLIENT_SECRET')
-    CANVAS_OAUTH_CANVAS_DOMAIN = get_required_setting('CANVAS_OAUTH_CANVAS_DOMAIN')
+_credentials_index = None
+_domain_settings = {}
+
+
+def get_credentials_index():
+    """
+    Returns the immutable mapping of Canvas domain to
+    (client_id, client_secret, base_url), compiling it on first use.
+    """
+    if _credentials_index is None:
+        return build_credentials_index()
+    return _credentials_index
+
+
+def build_credentials_index():
+    """
+    Compiles the credentials index from CANVAS_OAUTH_ENVIRONMENTS, the
+    domain-specific CANVAS_OAUTH_<DOMAIN>_CLIENT_ID/_CLIENT_SECRET settings
+    and the single-environment settings.  Runs when the app is ready and
+    again whenever a CANVAS_OAUTH_* setting changes.
+    """
+    global _credentials_index, _domain_settings
+
+    # Domain-specific settings, keyed by setting name since domain names
+    # can't be recovered from them
+    domain_settings = {}
+    for setting_name in dir(settings):
+        if (setting_name.startswith('CANVAS_OAUTH_')
+                and setting_name.endswith(('_CLIENT_ID', '_CLIENT_SECRET'))
+                and setting_name not in ('CANVAS_OAUTH_CLIENT_ID', 'CANVAS_OAUTH_CLIENT_SECRET')):
+            value = getattr(settings, setting_name, None)
+            if value:
+                domain_settings[setting_name] = value
+
+    index = {}
+    environments_config = getattr(settings, 'CANVAS_OAUTH_ENVIRONMENTS', None) or {}
+    for env_key, env_config in environments_config.items():
+        domain = env_config.get('canvas_domain') or env_config.get('domain')
+        client_id = env_config.get('client_id')
+        client_secret = env_config.get('client_secret')
+        if domain and client_id and client_secret:
+            index.setdefault(domain, (client_id, client_secret, f"https://{domain}"))
+
+    default_domain = getattr(settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', None)
+    if default_domain and default_domain not in index:
+        client_id = domain_settings.get(_get_domain_setting_name(default_domain, 'CLIENT_ID'),
+                                        getattr(settings, 'CANVAS_OAUTH_CLIENT_ID', ''))
+        client_secret = domain_settings.get(_get_domain_setting_name(default_domain, 'CLIENT_SECRET'),
+                                            getattr(settings, 'CANVAS_OAUTH_CLIENT_SECRET', ''))
+        if client_id and client_secret:
+            index[default_domain] = (client_id, client_secret, f"https://{default_domain}")
+
+    _domain_settings = domain_settings
+    _credentials_index = MappingProxyType(index)
+    return _credentials_index
+
+
+def reset_caches(setting, **kwargs):
+    """
+    `setting_changed` receiver that recompiles the credentials index and
+    drops cached resolver and lock instances and the changed setting.
+    """
+    if setting.startswith('CANVAS_OAUTH_'):
+        _configured_instances.clear()
+        _clear_settings(_REQUIRED_SETTINGS if setting == 'CANVAS_OAUTH_ENVIRONMENTS' else (setting,))
+        build_credentials_index()
+
+
+def _get_domain_setting_name(domain, suffix):
+    return f'CANVAS_OAUTH_{domain.upper().replace(".", "_")}_{suffix}'
 
 
 # Optional settings
 # -----------------
+#
+# Defaults of the optional settings.  Like the required settings below, they
+# are read from the Django settings on first access (see `__getattr__`).
 
-# Buffer for refreshing a token when retrieving via `get_token`, expressed
-# as a timedelta. Tokens are refreshed this amount of time before they expire.
-# Canvas tokens expire after 1 hour, so setting this to timedelta(minutes=5)
-# means tokens refresh at the 55-minute mark.
-CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER = getattr(
-    settings,
-    'CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER',
-    timedelta(),
-)
+_DEFAULTS = {
+    # Buffer for refreshing a token when retrieving via `get_token`, expressed
+    # as a timedelta. Tokens are refreshed this amount of time before they expire.
+    # Canvas tokens expire after 1 hour, so setting this to timedelta(minutes=5)
+    # means tokens refresh at the 55-minute mark.
+    'CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER': timedelta(),
+
+    # Probabilistic early refresh (see `canvas_oauth.early_refresh`): tokens are
+    # refreshed at random ahead of CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER, on
+    # average CANVAS_OAUTH_EARLY_REFRESH_BETA times the observed refresh
+    # duration ahead of it, and never more than CANVAS_OAUTH_EARLY_REFRESH_MAX_AHEAD
+    # (a timedelta) ahead of it.
+    'CANVAS_OAUTH_EARLY_REFRESH_ENABLED': False,
+
+    'CANVAS_OAUTH_EARLY_REFRESH_BETA': 60.0,
+
+    'CANVAS_OAUTH_EARLY_REFRESH_MAX_AHEAD': timedelta(minutes=10),
+
+    # Circuit breaker around each Canvas domain's token endpoint (see
+    # `canvas_oauth.breaker`): after CANVAS_OAUTH_BREAKER_FAILURE_THRESHOLD
+    # failures in a row, token grants fail fast for
+    # CANVAS_OAUTH_BREAKER_RESET_TIMEOUT seconds, then a single probe is let
+    # through.
+    'CANVAS_OAUTH_BREAKER_ENABLED': True,
+
+    'CANVAS_OAUTH_BREAKER_FAILURE_THRESHOLD': 5,
+
+    'CANVAS_OAUTH_BREAKER_RESET_TIMEOUT': 30,
+
+    'CANVAS_OAUTH_ERROR_TEMPLATE': 'oauth_error.html',
+
+    # Refreshes of the same token are coalesced behind a lock (see
+    # CANVAS_OAUTH_REFRESH_LOCK).  The lock expires after
+    # CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT seconds, and other requests wait up to
+    # CANVAS_OAUTH_REFRESH_LOCK_WAIT seconds for the winner before refreshing
+    # on their own.
+    'CANVAS_OAUTH_REFRESH_LOCK_TIMEOUT': 30,
+
+    'CANVAS_OAUTH_REFRESH_LOCK_WAIT': 10,
+
+    # Connection pooling for requests made to Canvas.  Each Canvas domain gets a
+    # keep-alive session with up to CANVAS_OAUTH_HTTP_POOL_MAXSIZE connections.
+    # CANVAS_OAUTH_HTTP_TIMEOUT is the default timeout in seconds, either a
+    # number or a (connect, read) tuple as accepted by requests.
+    'CANVAS_OAUTH_HTTP_POOL_MAXSIZE': 10,
+
+    'CANVAS_OAUTH_HTTP_TIMEOUT': 10,
 
-CANVAS_OAUTH_ERROR_TEMPLATE = getattr(
-    settings,
-    'CANVAS_OAUTH_ERROR_TEMPLATE',
-    'oauth_error.html'
+    'CANVAS_OAUTH_HTTP_KEEP_ALIVE': True,
+
+    # Retries of idempotent Canvas requests that fail with a connection error
+    # or a 502, 503 or 504: up to CANVAS_OAUTH_HTTP_RETRIES, after a random
+    # delay of up to CANVAS_OAUTH_HTTP_BACKOFF seconds, doubled for each
+    # retry.  With CANVAS_OAUTH_HTTP_HEDGE_DELAY (in seconds), a refresh token
+    # grant that has not been answered after that long is sent again, and
+    # the first response is used.
+    'CANVAS_OAUTH_HTTP_RETRIES': 2,
+
+    'CANVAS_OAUTH_HTTP_BACKOFF': 0.1,
+
+    'CANVAS_OAUTH_HTTP_HEDGE_DELAY': None,
+
+    # Total seconds that OAuthMiddleware gives the Canvas calls of a request,
+    # including retries (see `canvas_oauth.deadline`).  None for no budget.
+    'CANVAS_OAUTH_REQUEST_DEADLINE': None,
+
+    # Scheme used for Canvas requests.  Only meant to be changed to 'http' for
+    # local test doubles of Canvas, such as the benchmark suite's fake server.
+    'CANVAS_OAUTH_HTTP_SCHEME': 'https',
+
+    # Canvas API requests made with an access token are paced and their
+    # concurrency adjusted from the X-Rate-Limit-Remaining response header.
+    # Requests for a token are slowed down once its remaining quota falls below
+    # CANVAS_OAUTH_RATE_LIMIT_LOW_WATERMARK, and at most
+    # CANVAS_OAUTH_RATE_LIMIT_MAX_CONCURRENCY run at once.
+    'CANVAS_OAUTH_RATE_LIMIT_ENABLED': True,
+
+    'CANVAS_OAUTH_RATE_LIMIT_MAX_CONCURRENCY': 8,
+
+    'CANVAS_OAUTH_RATE_LIMIT_LOW_WATERMARK': 100,
+
+    # Stateless OAuth state: the state parameter is a signed token carrying the
+    # callback data instead of a key into the session and cache.  States are
+    # valid for CANVAS_OAUTH_STATE_MAX_AGE seconds and, with
+    # CANVAS_OAUTH_STATE_SINGLE_USE, accepted only once (their nonces are kept
+    # in the CANVAS_OAUTH_STATE_CACHE_ALIAS cache until they expire).
+    'CANVAS_OAUTH_STATELESS_STATE': False,
+
+    'CANVAS_OAUTH_STATE_MAX_AGE': 600,
+
+    'CANVAS_OAUTH_STATE_SINGLE_USE': True,
+
+    'CANVAS_OAUTH_STATE_CACHE_ALIAS': 'default',
+
+    # Seconds during which requests of a session that has started an OAuth
+    # authorization reuse its state instead of starting another one, so that
+    # concurrent requests needing a token (several tabs, parallel XHRs) don't
+    # invalidate each other's state.  0 or None starts one per request.
+    'CANVAS_OAUTH_PENDING_AUTHORIZATION_TIMEOUT': 60,
+
+    # Number of threads used by `canvas_oauth.profile.ThreadPoolProfileUpdater`
+    # (see CANVAS_OAUTH_PROFILE_UPDATER) to fetch user profiles after login.
+    'CANVAS_OAUTH_PROFILE_UPDATE_WORKERS': 2,
+
+    # Cache of Canvas API GET responses, revalidated with If-None-Match /
+    # If-Modified-Since (see CANVAS_OAUTH_RESPONSE_CACHE_BACKEND).  The local
+    # backend keeps at most CANVAS_OAUTH_RESPONSE_CACHE_MAXSIZE responses and
+    # CANVAS_OAUTH_RESPONSE_CACHE_MAX_BYTES of response bodies; the Django cache
+    # backend stores responses in CANVAS_OAUTH_RESPONSE_CACHE_ALIAS for up to
+    # CANVAS_OAUTH_RESPONSE_CACHE_TIMEOUT seconds.
+    'CANVAS_OAUTH_RESPONSE_CACHE_ENABLED': False,
+
+    'CANVAS_OAUTH_RESPONSE_CACHE_MAXSIZE': 1024,
+
+    'CANVAS_OAUTH_RESPONSE_CACHE_MAX_BYTES': 16 * 1024 * 1024,
+
+    'CANVAS_OAUTH_RESPONSE_CACHE_ALIAS': 'default',
+
+    'CANVAS_OAUTH_RESPONSE_CACHE_TIMEOUT': 3600,
+
+    # Token cache used by `get_oauth_token`: an in-process LRU in front of the
+    # Django cache named by CANVAS_OAUTH_TOKEN_CACHE_ALIAS.  Timeouts are in
+    # seconds and are always capped by the token's expiration minus
+    # CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER.  Negative entries (users without a
+    # token) use CANVAS_OAUTH_TOKEN_CACHE_NEGATIVE_TIMEOUT.
+    'CANVAS_OAUTH_TOKEN_CACHE_ENABLED': False,
+
+    'CANVAS_OAUTH_TOKEN_CACHE_ALIAS': 'default',
+
+    'CANVAS_OAUTH_TOKEN_CACHE_TIMEOUT': 300,
+
+    'CANVAS_OAUTH_TOKEN_CACHE_NEGATIVE_TIMEOUT': 30,
+
+    'CANVAS_OAUTH_TOKEN_CACHE_LOCAL_MAXSIZE': 1024,
+
+    'CANVAS_OAUTH_TOKEN_CACHE_LOCAL_TIMEOUT': 30,
+
+    # Settings of `canvas_oauth.stores.CacheTokenStore`, when it is the
+    # CANVAS_OAUTH_TOKEN_STORE: the Django cache it keeps tokens in, for how
+    # many seconds, and every how many seconds refreshed tokens are written
+    # to the database.
+    'CANVAS_OAUTH_TOKEN_STORE_CACHE_ALIAS': 'default',
+
+    'CANVAS_OAUTH_TOKEN_STORE_CACHE_TIMEOUT': 24 * 60 * 60,
+
+    'CANVAS_OAUTH_TOKEN_STORE_FLUSH_INTERVAL': 1.0,
+
+    # Databases used by `canvas_oauth.routers.CanvasOAuthRouter`.  Writes go to
+    # CANVAS_OAUTH_DATABASE and reads to a random one of
+    # CANVAS_OAUTH_READ_DATABASES, except for CANVAS_OAUTH_DATABASE_STICKY_SECONDS
+    # after a user's token was written, when that user's reads go to
+    # CANVAS_OAUTH_DATABASE.  Sticky users are shared across processes through
+    # the Django cache named by CANVAS_OAUTH_DATABASE_STICKY_CACHE_ALIAS.
+    'CANVAS_OAUTH_DATABASE': 'default',
+
+    'CANVAS_OAUTH_READ_DATABASES': [],
+
+    'CANVAS_OAUTH_DATABASE_STICKY_SECONDS': 10,
+
+    'CANVAS_OAUTH_DATABASE_STICKY_CACHE_ALIAS': 'default',
+
+    # A list of Canvas API scopes that the access token will provide access to.
+    #
+    # This is only required if the Canvas API developer key requires scopes
+    # (e.g. enforces scopes). Otherwise, the access token will have access to
+    # all scopes.
+    #
+    # Note that Canvas API scopes may be found beneath their corresponding
+    # endpoints in the "resources" documentation pages.
+    'CANVAS_OAUTH_SCOPES': [],
+}
+
+
+# Settings required for single-environment setups, i.e. without
+# CANVAS_OAUTH_ENVIRONMENTS
+_REQUIRED_SETTINGS = (
+    'CANVAS_OAUTH_CLIENT_ID',
+    'CANVAS_OAUTH_CLIENT_SECRET',
+    'CANVAS_OAUTH_CANVAS_DOMAIN',
 )
 
 
+def __getattr__(name):
+    """
+    Reads a CANVAS_OAUTH_* setting on first access instead of when this
+    module is imported, and keeps it as a module attribute so later reads
+    are plain attribute lookups.  `reset_caches` drops a setting when it
+    changes.
+    """
+    if name in _DEFAULTS:
+        value = getattr(settings, name, _DEFAULTS[name])
+    elif name in _REQUIRED_SETTINGS:
+        if getattr(settings, 'CANVAS_OAUTH_ENVIRONMENTS', None):
+            # Optional with multiple environments
+            value = getattr(settings, name, None)
+        else:
+            value = get_required_setting(name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def _clear_settings(names):
+    for name in names:
+        globals().pop(name, None)
+
+
+# Settings read before the module was (re)loaded are read again
+_clear_settings(_DEFAULTS)
+_clear_settings(_REQUIRED_SETTINGS)
+
+
 # Environment-specific credential helpers
 # =======================================
 
 def get_client_id_for_domain(domain):
     """Get client ID for a specific Canvas domain from settings"""
     # Check for domain-specific setting first
-    domain_setting = f'CANVAS_OAUTH_{domain.upper().replace(".", "_")}_CLIENT_ID'
+    domain_setting = _get_domain_setting_name(domain, 'CLIENT_ID')
     domain_client_id = getattr(settings, domain_setting, None)
     if domain_client_id:
         return domain_client_id
@@ -106,24 +408,10 @@ def get_client_id_for_domain(domain):
 def get_client_secret_for_domain(domain):
     """Get client secret for a specific Canvas domain from settings"""
     # Check for domain-specific setting first
-    domain_setting = f'CANVAS_OAUTH_{domain.upper().replace(".", "_")}_CLIENT_SECRET'
+    domain_setting = _get_domain_setting_name(domain, 'CLIENT_SECRET')
     domain_client_secret = getattr(settings, domain_setting, None)
     if domain_client_secret:
         return domain_client_secret
 
     # Fall back to main setting
     return getattr(settings, 'CANVAS_OAUTH_CLIENT_SECRET', '')
-
-# A list of Canvas API scopes that the access token will provide access to.
-#
-# This is only required if the Canvas API developer key requires scopes
-# (e.g. enforces scopes). Otherwise, the access token will have access to
-# all scopes.
-#
-# Note that Canvas API scopes may be found beneath their corresponding
-# endpoints in the "resources" documentation pages.
-CANVAS_OAUTH_SCOPES = getattr(
-    settings,
-    'CANVAS_OAUTH_SCOPES',
-    []
-)
@@ -0,0 +1,27 @@
+"""
+Signals sent across the token lifecycle.  All are sent with
+``sender=CanvasOAuth2Token``; sending a signal with no receivers connected
+costs next to nothing.
+"""
+from django.dispatch import Signal
+
+# A token was found for the user; `source` is 'cache' or 'database'.
+# Arguments: user_id, domain, source
+token_retrieved = Signal()
+
+# No token was found for the user, so a MissingTokenError is raised.
+# Arguments: user_id, domain
+token_missing = Signal()
+
+# A token was refreshed; `outcome` is 'refreshed', or 'coalesced' when
+# another request had already refreshed it.
+# Arguments: oauth_token, outcome, duration
+token_refreshed = Signal()
+
+# Canvas granted an access token.
+# Arguments: domain, grant_type, duration
+access_token_granted = Signal()
+
+# The OAuth callback saved a token for the user.
+# Arguments: canvas_user, oauth_token, domain
+oauth_callback_completed = Signal()
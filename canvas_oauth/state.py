@@ -0,0 +1,135 @@
+"""
+Stateless OAuth ``state`` parameter.
+
+With ``CANVAS_OAUTH_STATELESS_STATE`` enabled, the state sent to Canvas is
+itself a compact, signed and timestamped token carrying what the callback
+needs (redirect_uri, initial_uri, user_id, course_id and the Canvas
+domain), so neither ``handle_missing_token`` nor ``oauth_callback`` touch the
+session or store state data in the cache.  A state is accepted only once: its random nonce
+is recorded with an atomic ``cache.add`` until the state expires.
+
+A state is also bound to the browser that started the flow: it carries a
+hash of a random value kept in that browser's ``canvas_oauth_state`` cookie,
+and is rejected by a callback without the same cookie, so an attacker can't
+complete their own authorization in a victim's browser (login CSRF).
+"""
+import logging
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare, get_random_string, salted_hmac
+
+from canvas_oauth import settings as oauth_settings
+
+logger = logging.getLogger(__name__)
+
+SALT = 'canvas_oauth.state'
+
+# Cookie holding the value states are bound to (see `get_binding`)
+COOKIE_NAME = 'canvas_oauth_state'
+
+# Short keys keep the signed token (and the authorize URL) small
+_FIELDS = {
+    'redirect_uri': 'r',
+    'initial_uri': 'i',
+    'user_id': 'u',
+    'course_id': 'c',
+    'canvas_domain': 'd',
+}
+
+
+def get_binding(request):
+    """
+    Returns the value the request's states are bound to: the one in its
+    cookie, or a new one to be set with `set_binding_cookie`.
+    """
+    return request.COOKIES.get(COOKIE_NAME) or get_random_string(32)
+
+
+def set_binding_cookie(request, response, binding):
+    # Sent like the session cookie, which the callback also needs
+    response.set_cookie(
+        COOKIE_NAME, binding, max_age=oauth_settings.CANVAS_OAUTH_STATE_MAX_AGE,
+        secure=settings.SESSION_COOKIE_SECURE or request.is_secure(), httponly=True,
+        samesite=settings.SESSION_COOKIE_SAMESITE)
+
+
+def _hash_binding(binding):
+    return salted_hmac(SALT + '.binding', binding).hexdigest()[:16]
+
+
+def make_state(redirect_uri, initial_uri, user_id=None, course_id=None, canvas_domain=None, binding=None):
+    """
+    Returns a signed state token for the OAuth authorize request, bound to
+    `binding` (see `get_binding`) if given.
+    """
+    values = {
+        'redirect_uri': redirect_uri,
+        'initial_uri': initial_uri,
+        'user_id': user_id,
+        'course_id': course_id,
+        'canvas_domain': canvas_domain,
+    }
+    payload = {_FIELDS[name]: value for name, value in values.items() if value is not None}
+    payload['n'] = get_random_string(12)
+    if binding is not None:
+        payload['b'] = _hash_binding(binding)
+    return signing.dumps(payload, salt=SALT, compress=True)
+
+
+def _load_payload(state):
+    try:
+        return signing.loads(state or '', salt=SALT, max_age=oauth_settings.CANVAS_OAUTH_STATE_MAX_AGE)
+    except signing.SignatureExpired:
+        logger.warning("Expired OAuth state")
+    except signing.BadSignature:
+        logger.warning("Invalid OAuth state signature")
+    return None
+
+
+def _get_state_data(payload):
+    return {name: payload.get(key) for name, key in _FIELDS.items()}
+
+
+def _get_nonce_key(payload):
+    return f"canvas_oauth:state-nonce:{payload['n']}"
+
+
+def _check_binding(payload, binding):
+    if 'b' not in payload:
+        return True
+    if binding is None or not constant_time_compare(payload['b'], _hash_binding(binding)):
+        logger.warning("OAuth state used by another browser")
+        return False
+    return True
+
+
+def load_state(state, binding=None):
+    """
+    Verifies a signed state token and returns its data, or None if the
+    state is invalid, expired, bound to another `binding` or has already
+    been used.
+    """
+    payload = _load_payload(state)
+    if payload is None or not _check_binding(payload, binding):
+        return None
+    if oauth_settings.CANVAS_OAUTH_STATE_SINGLE_USE:
+        cache = caches[oauth_settings.CANVAS_OAUTH_STATE_CACHE_ALIAS]
+        if not cache.add(_get_nonce_key(payload), 1, oauth_settings.CANVAS_OAUTH_STATE_MAX_AGE):
+            logger.warning("OAuth state reused")
+            return None
+    return _get_state_data(payload)
+
+
+async def aload_state(state, binding=None):
+    """Async version of `load_state`."""
+    payload = _load_payload(state)
+    if payload is None or not _check_binding(payload, binding):
+        return None
+    if oauth_settings.CANVAS_OAUTH_STATE_SINGLE_USE:
+        cache = caches[oauth_settings.CANVAS_OAUTH_STATE_CACHE_ALIAS]
+        if not await cache.aadd(_get_nonce_key(payload), 1, oauth_settings.CANVAS_OAUTH_STATE_MAX_AGE):
+            logger.warning("OAuth state reused")
+            return None
+    return _get_state_data(payload)
@@ -0,0 +1,301 @@
+"""
+Token store backends.
+
+`get_oauth_token`, `oauth_callback` and `refresh_oauth_token` read and write
+tokens through the store configured by CANVAS_OAUTH_TOKEN_STORE:
+
+- `ModelTokenStore` (the default) keeps tokens in the `CanvasOAuth2Token`
+  table, reading and writing it on every lookup and refresh.
+- `CacheTokenStore` keeps tokens in a Django cache, reads the table only on
+  a cache miss, and writes refreshed tokens back to it in the background.
+- `InMemoryTokenStore` keeps tokens in process, for tests and benchmarks.
+
+Tokens are `CanvasOAuth2Token` instances with their `user`, whether or not
+the store saves them to the database.  Canvas users are always saved in the
+database by the OAuth callback.
+"""
+import atexit
+import copy
+import itertools
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.utils import timezone
+
+from canvas_oauth import routers
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.models import CanvasOAuth2Token
+
+logger = logging.getLogger(__name__)
+
+
+class TokenStore(ABC):
+    """Reads and writes the Canvas OAuth2 tokens of Canvas users."""
+
+    @abstractmethod
+    def get(self, user_id, domain):
+        """
+        Returns the token of the Canvas user for the domain, or raises
+        CanvasOAuth2Token.DoesNotExist.
+        """
+
+    async def aget(self, user_id, domain):
+        """Async version of `get`."""
+        return await sync_to_async(self.get)(user_id, domain)
+
+    @abstractmethod
+    def save(self, canvas_user, domain, access_token, refresh_token, expires):
+        """Creates or replaces the token of the Canvas user for the domain, and returns it."""
+
+    async def asave(self, canvas_user, domain, access_token, refresh_token, expires):
+        """Async version of `save`."""
+        return await sync_to_async(self.save)(canvas_user, domain, access_token, refresh_token, expires)
+
+    @abstractmethod
+    def reload(self, oauth_token):
+        """Returns the current version of the token, or None if it was deleted."""
+
+    @abstractmethod
+    def update(self, oauth_token, access_token, expires, updated_on):
+        """
+        Saves a refreshed access token, unless the token was saved by
+        someone else since `oauth_token` was read (a compare-and-swap on
+        `updated_on`).  Returns True if it was saved.
+        """
+
+
+class ModelTokenStore(TokenStore):
+    """Keeps tokens in the CanvasOAuth2Token table."""
+
+    def get(self, user_id, domain):
+        # A token saved moments ago may not have reached the read replicas yet
+        with routers.use_primary(routers.is_sticky(user_id, domain)):
+            return _get_stored_tokens(domain).get(user__canvas_user_id=user_id)
+
+    async def aget(self, user_id, domain):
+        with routers.use_primary(await routers.ais_sticky(user_id, domain)):
+            return await _get_stored_tokens(domain).aget(user__canvas_user_id=user_id)
+
+    def save(self, canvas_user, domain, access_token, refresh_token, expires):
+        oauth_token, _ = CanvasOAuth2Token.objects.update_or_create(
+            user=canvas_user,
+            canvas_domain=domain,
+            defaults={
+                "access_token": access_token,
+                "expires": expires,
+                "refresh_token": refresh_token})
+        routers.stick(canvas_user.canvas_user_id, domain)
+        return oauth_token
+
+    async def asave(self, canvas_user, domain, access_token, refresh_token, expires):
+        oauth_token, _ = await CanvasOAuth2Token.objects.aupdate_or_create(
+            user=canvas_user,
+            canvas_domain=domain,
+            defaults={
+                "access_token": access_token,
+                "expires": expires,
+                "refresh_token": refresh_token})
+        await sync_to_async(routers.stick)(canvas_user.canvas_user_id, domain)
+        return oauth_token
+
+    def reload(self, oauth_token):
+        # Must not come from a lagging replica
+        with routers.use_primary():
+            return CanvasOAuth2Token.objects.select_related('user').filter(pk=oauth_token.pk).first()
+
+    def update(self, oauth_token, access_token, expires, updated_on):
+        updated = CanvasOAuth2Token.objects.filter(
+            pk=oauth_token.pk, updated_on=oauth_token.updated_on,
+        ).update(access_token=access_token, expires=expires, updated_on=updated_on)
+        routers.stick(oauth_token.user.canvas_user_id, oauth_token.canvas_domain)
+        return bool(updated)
+
+
+def _get_stored_tokens(domain):
+    # Joined with the user, so the lookup and any refresh need no further
+    # queries for it
+    return CanvasOAuth2Token.objects.select_related('user').filter(canvas_domain=domain)
+
+
+class InMemoryTokenStore(TokenStore):
+    """
+    Keeps tokens in a dict of this process, and never touches the token
+    table.  Tokens are lost when the process exits.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._pks = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get(self, user_id, domain):
+        oauth_token = self._tokens.get((str(user_id), domain))
+        if oauth_token is None:
+            raise CanvasOAuth2Token.DoesNotExist("No token for user %s on %s" % (user_id, domain))
+        # Callers may change the token they get
+        return copy.copy(oauth_token)
+
+    async def aget(self, user_id, domain):
+        return self.get(user_id, domain)
+
+    def save(self, canvas_user, domain, access_token, refresh_token, expires):
+        key = (str(canvas_user.canvas_user_id), domain)
+        with self._lock:
+            previous = self._tokens.get(key)
+            oauth_token = CanvasOAuth2Token(
+                pk=previous.pk if previous is not None else next(self._pks),
+                user=canvas_user, canvas_domain=domain, access_token=access_token,
+                refresh_token=refresh_token, expires=expires, updated_on=timezone.now())
+            self._tokens[key] = oauth_token
+        return copy.copy(oauth_token)
+
+    async def asave(self, canvas_user, domain, access_token, refresh_token, expires):
+        return self.save(canvas_user, domain, access_token, refresh_token, expires)
+
+    def reload(self, oauth_token):
+        try:
+            return self.get(oauth_token.user.canvas_user_id, oauth_token.canvas_domain)
+        except CanvasOAuth2Token.DoesNotExist:
+            return None
+
+    def update(self, oauth_token, access_token, expires, updated_on):
+        key = (str(oauth_token.user.canvas_user_id), oauth_token.canvas_domain)
+        with self._lock:
+            current = self._tokens.get(key)
+            if current is None or current.updated_on != oauth_token.updated_on:
+                return False
+            current = copy.copy(current)
+            current.access_token = access_token
+            current.expires = expires
+            current.updated_on = updated_on
+            self._tokens[key] = current
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+class CacheTokenStore(TokenStore):
+    """
+    Keeps tokens in the Django cache named by CANVAS_OAUTH_TOKEN_STORE_CACHE_ALIAS,
+    in front of the CanvasOAuth2Token table.
+
+    Lookups read the table only when the cache has no entry for the token.
+    New tokens from the OAuth callback are saved to the table right away,
+    while refreshed tokens are saved to the cache and queued, and a
+    background thread writes the queued tokens to the table every
+    CANVAS_OAUTH_TOKEN_STORE_FLUSH_INTERVAL seconds (see `flush`).  The table
+    may therefore lag behind the cache by that long; a token evicted from
+    the cache in the meantime is read back from the table, with an older
+    access token that is still valid.
+
+    The cache has no compare-and-swap, so `update` relies on the refresh
+    lock to serialize refreshes of a token (see CANVAS_OAUTH_REFRESH_LOCK,
+    whose CacheLock must then share this cache between processes).
+    """
+
+    def __init__(self, alias=None, timeout=None, flush_interval=None):
+        self.alias = alias or oauth_settings.CANVAS_OAUTH_TOKEN_STORE_CACHE_ALIAS
+        self.timeout = timeout or oauth_settings.CANVAS_OAUTH_TOKEN_STORE_CACHE_TIMEOUT
+        self.flush_interval = flush_interval or oauth_settings.CANVAS_OAUTH_TOKEN_STORE_FLUSH_INTERVAL
+        self.model_store = ModelTokenStore()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flusher = None
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_key(self, user_id, domain):
+        return f"canvas_oauth:token_store:{domain}:{user_id}"
+
+    def get(self, user_id, domain):
+        key = self.get_key(user_id, domain)
+        oauth_token = self.cache.get(key)
+        if oauth_token is None:
+            oauth_token = self.model_store.get(user_id, domain)
+            self.cache.add(key, oauth_token, self.timeout)
+        return oauth_token
+
+    async def aget(self, user_id, domain):
+        key = self.get_key(user_id, domain)
+        oauth_token = await self.cache.aget(key)
+        if oauth_token is None:
+            oauth_token = await self.model_store.aget(user_id, domain)
+            await self.cache.aadd(key, oauth_token, self.timeout)
+        return oauth_token
+
+    def save(self, canvas_user, domain, access_token, refresh_token, expires):
+        oauth_token = self.model_store.save(canvas_user, domain, access_token, refresh_token, expires)
+        # A queued refresh of the replaced token must not overwrite it
+        with self._pending_lock:
+            self._pending.pop(oauth_token.pk, None)
+        self.cache.set(self.get_key(canvas_user.canvas_user_id, domain), oauth_token, self.timeout)
+        return oauth_token
+
+    def reload(self, oauth_token):
+        try:
+            return self.get(oauth_token.user.canvas_user_id, oauth_token.canvas_domain)
+        except CanvasOAuth2Token.DoesNotExist:
+            return None
+
+    def update(self, oauth_token, access_token, expires, updated_on):
+        current = self.reload(oauth_token)
+        if current is None or current.updated_on != oauth_token.updated_on:
+            return False
+        current.access_token = access_token
+        current.expires = expires
+        current.updated_on = updated_on
+        self.cache.set(self.get_key(oauth_token.user.canvas_user_id, oauth_token.canvas_domain),
+                       current, self.timeout)
+        with self._pending_lock:
+            self._pending[current.pk] = (access_token, expires, updated_on)
+        self._start_flusher()
+        return True
+
+    def flush(self):
+        """Writes the queued refreshed tokens to the table, and returns how many were written."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        written = 0
+        try:
+            for pk, (access_token, expires, updated_on) in pending.items():
+                # Never overwrite a newer token, e.g. one saved by the callback
+                CanvasOAuth2Token.objects.filter(pk=pk, updated_on__lt=updated_on).update(
+                    access_token=access_token, expires=expires, updated_on=updated_on)
+                written += 1
+        except Exception:
+            # Queue the tokens that were not written again, unless they were
+            # refreshed again in the meantime
+            with self._pending_lock:
+                for pk, pending_token in list(pending.items())[written:]:
+                    self._pending.setdefault(pk, pending_token)
+            raise
+        return written
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._pending_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._run_flusher, name='canvas-oauth-token-store', daemon=True)
+                self._flusher.start()
+                atexit.register(self.flush)
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write refreshed tokens to the database")
+            finally:
+                close_old_connections()
@@ -0,0 +1,124 @@
+import asyncio
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from django.conf import settings
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.canvas import aget_access_token
+from canvas_oauth.client import AsyncCanvasClient
+from canvas_oauth.exceptions import InvalidOAuthReturnError, MissingTokenError
+from canvas_oauth.oauth import aget_oauth_token
+from canvas_oauth.token_cache import TokenCache
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class TestAsyncGetAccessToken(TestCase):
+
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_refresh_token(self, mock_get_async_client):
+        mock_post = mock_get_async_client.return_value.post = AsyncMock(return_value=MagicMock())
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {
+            "access_token": "access-token", "expires_in": 3600, "refresh_token": "refresh-token"}
+
+        access_token, expires, refresh_token = await aget_access_token(
+            settings.CANVAS_OAUTH_CANVAS_DOMAIN, 'refresh_token', None, refresh_token='refresh-token')
+
+        self.assertEqual(("access-token", "refresh-token"), (access_token, refresh_token))
+        self.assertAlmostEqual(3600, (expires - timezone.now()).total_seconds(), delta=5)
+        post_params = mock_post.call_args.kwargs['data']
+        self.assertEqual('refresh_token', post_params['grant_type'])
+        self.assertNotIn('redirect_uri', post_params)
+
+    @patch('canvas_oauth.canvas.get_async_client')
+    async def test_error(self, mock_get_async_client):
+        mock_post = mock_get_async_client.return_value.post = AsyncMock(return_value=MagicMock())
+        mock_post.return_value.status_code = 401
+        with self.assertRaises(InvalidOAuthReturnError):
+            await aget_access_token(
+                settings.CANVAS_OAUTH_CANVAS_DOMAIN, 'authorization_code', '/oauth/oauth-callback', code='code')
+
+
+@skipUnless(httpx, "httpx is not installed")
+class TestAsyncCanvasClient(TestCase):
+
+    async def test_request(self):
+        def handler(request):
+            return httpx.Response(200, json={"authorization": request.headers['Authorization']})
+
+        client = AsyncCanvasClient()
+        session = client.get_session('canvas.localhost')
+        session._transport = httpx.MockTransport(handler)
+        self.assertIs(session, client.get_session('canvas.localhost'))
+
+        response = await client.get('canvas.localhost', '/api/v1/users/self', access_token='token-123')
+        self.assertEqual({"authorization": "Bearer token-123"}, response.json())
+        await client.aclose()
+
+    @patch('canvas_oauth.client.asyncio.sleep', new_callable=AsyncMock)
+    async def test_retries(self, mock_sleep):
+        statuses = [503, 200]
+
+        def handler(request):
+            return httpx.Response(statuses.pop(0))
+
+        client = AsyncCanvasClient(retries=2)
+        client.get_session('canvas.localhost')._transport = httpx.MockTransport(handler)
+        response = await client.get('canvas.localhost', '/api/v1/users/self')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, mock_sleep.call_count)
+        await client.aclose()
+
+    async def test_hedged_request(self):
+        requests_made = []
+
+        async def handler(request):
+            requests_made.append(request)
+            if len(requests_made) == 1:
+                await asyncio.sleep(5)
+            return httpx.Response(200, json={"request": len(requests_made)})
+
+        client = AsyncCanvasClient(hedge_delay=0.01)
+        client.get_session('canvas.localhost')._transport = httpx.MockTransport(handler)
+        response = await client.post('canvas.localhost', '/login/oauth2/token', idempotent=True, hedge=True)
+        self.assertEqual({"request": 2}, response.json())
+        await client.aclose()
+
+
+class TestAsyncGetOauthToken(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.token_cache = TokenCache()
+        patcher = patch('canvas_oauth.oauth.get_token_cache', return_value=self.token_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_request(self):
+        request = RequestFactory().get('/index')
+        request.user = MagicMock()
+        request.session = SessionStore()
+        request.session['user_id'] = '42'
+        return request
+
+    async def test_cache_hit(self):
+        expires = timezone.now() + timedelta(hours=1)
+        await self.token_cache.aset('42', oauth_settings.CANVAS_OAUTH_CANVAS_DOMAIN, 'cached-token', expires)
+        self.token_cache.local.clear()
+        self.assertEqual(('cached-token', '42'), await aget_oauth_token(self.get_request()))
+
+    async def test_negative_cache_hit(self):
+        await self.token_cache.aset_missing('42', oauth_settings.CANVAS_OAUTH_CANVAS_DOMAIN)
+        with self.assertRaises(MissingTokenError):
+            await aget_oauth_token(self.get_request())
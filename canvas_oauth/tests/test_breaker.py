@@ -0,0 +1,180 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.test import SimpleTestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import breaker, canvas
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.exceptions import CircuitOpenError, InvalidGrantError, InvalidOAuthReturnError
+from canvas_oauth.oauth import get_oauth_token
+
+DOMAIN = 'canvas.localhost'
+SINK = 'canvas_oauth.metrics.PrometheusMetricsSink'
+
+
+def get_response(status_code, json=None):
+    response = MagicMock(status_code=status_code, text='')
+    response.json.return_value = json or {}
+    return response
+
+
+class TestCircuitBreaker(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = breaker.CircuitBreaker(DOMAIN, failure_threshold=3, reset_timeout=30)
+
+    def fail(self, times=1):
+        for _ in range(times):
+            with self.assertRaises(requests.ConnectionError):
+                with self.breaker.guard():
+                    raise requests.ConnectionError()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        with self.breaker.guard():
+            pass
+        self.fail(2)
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+        self.fail()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.is_open())
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_unavailable_responses_fail(self):
+        for _ in range(3):
+            with self.breaker.guard() as guard:
+                guard.failed = breaker.is_unavailable(get_response(503))
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+
+    def test_oauth_errors_succeed(self):
+        # Canvas answered, so the endpoint is available
+        for _ in range(3):
+            with self.assertRaises(InvalidGrantError):
+                with self.breaker.guard():
+                    raise InvalidGrantError()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    @patch('canvas_oauth.breaker.time.monotonic')
+    def test_half_open_probe(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        self.fail(3)
+        mock_monotonic.return_value = 131.0
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.is_open())
+
+        # A single probe is let through; a failed probe opens the circuit again
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertEqual(30.0, self.breaker.get_state()['retry_in'])
+
+        mock_monotonic.return_value = 162.0
+        with self.breaker.guard():
+            pass
+        self.assertEqual({'state': breaker.CLOSED, 'failures': 0, 'retry_in': None},
+                         self.breaker.get_state())
+
+    @patch('canvas_oauth.breaker.time.monotonic')
+    def test_abandoned_probe(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        self.fail(3)
+        mock_monotonic.return_value = 131.0
+        with self.assertRaises(KeyboardInterrupt):
+            with self.breaker.guard():
+                raise KeyboardInterrupt()
+        # The next request may probe
+        self.breaker.before_call()
+
+
+@override_settings(CANVAS_OAUTH_BREAKER_FAILURE_THRESHOLD=2, CANVAS_OAUTH_METRICS_SINK=SINK)
+@patch('canvas_oauth.canvas.get_canvas_credentials', return_value=(101, 'fake-secret', f"https://{DOMAIN}"))
+@patch('canvas_oauth.canvas.get_client')
+class TestGetAccessTokenBreaker(SimpleTestCase):
+
+    def setUp(self):
+        breaker.reset_breakers()
+        self.addCleanup(breaker.reset_breakers)
+        oauth_settings.reset_caches('CANVAS_OAUTH_METRICS_SINK')
+
+    def test_fails_fast_when_open(self, mock_get_client, mock_credentials):
+        mock_get_client.return_value.post.return_value = get_response(502)
+        for _ in range(2):
+            with self.assertRaises(InvalidOAuthReturnError):
+                canvas.get_access_token(DOMAIN, 'refresh_token', None, refresh_token='refresh')
+
+        with self.assertRaises(CircuitOpenError):
+            canvas.get_access_token(DOMAIN, 'refresh_token', None, refresh_token='refresh')
+        self.assertEqual(2, mock_get_client.return_value.post.call_count)
+
+        self.assertEqual(breaker.OPEN, breaker.get_breaker_states()[DOMAIN]['state'])
+        text = oauth_settings.get_metrics_sink().render()
+        self.assertIn("# TYPE canvas_oauth_breaker_state gauge", text)
+        self.assertIn('canvas_oauth_breaker_state{domain="canvas.localhost"} 2', text)
+        self.assertIn('canvas_oauth_breaker_rejections_total{domain="canvas.localhost"} 1', text)
+
+    @override_settings(CANVAS_OAUTH_BREAKER_ENABLED=False)
+    def test_disabled(self, mock_get_client, mock_credentials):
+        mock_get_client.return_value.post.side_effect = requests.Timeout()
+        for _ in range(3):
+            with self.assertRaises(requests.Timeout):
+                canvas.get_access_token(DOMAIN, 'refresh_token', None, refresh_token='refresh')
+        self.assertEqual({}, breaker.get_breaker_states())
+
+
+@override_settings(CANVAS_OAUTH_METRICS_SINK=SINK)
+@patch('canvas_oauth.oauth._get_stored_token')
+@patch('canvas_oauth.oauth.refresh_oauth_token')
+class TestStaleTokenGrace(SimpleTestCase):
+
+    def setUp(self):
+        breaker.reset_breakers()
+        self.addCleanup(breaker.reset_breakers)
+        oauth_settings.reset_caches('CANVAS_OAUTH_METRICS_SINK')
+        self.oauth_token = MagicMock(access_token='stored-token', canvas_domain=DOMAIN)
+        self.oauth_token.expires_within.side_effect = (
+            lambda delta: self.oauth_token.expires - timezone.now() <= delta)
+
+    def get_request(self):
+        request = RequestFactory().get('/index')
+        request.user = MagicMock()
+        request.session = SessionStore()
+        request.session['user_id'] = '42'
+        return request
+
+    def open_circuit(self):
+        circuit_breaker = breaker.get_circuit_breaker(DOMAIN)
+        for _ in range(circuit_breaker.failure_threshold):
+            circuit_breaker.record_failure()
+
+    @override_settings(CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER=timedelta(minutes=5))
+    def test_keeps_valid_token(self, mock_refresh, mock_get):
+        self.oauth_token.expires = timezone.now() + timedelta(minutes=2)
+        mock_get.return_value = self.oauth_token
+        self.open_circuit()
+
+        self.assertEqual(('stored-token', '42'), get_oauth_token(self.get_request()))
+        self.assertFalse(mock_refresh.called)
+        self.assertIn('canvas_oauth_stale_tokens_total{domain="canvas.localhost"} 1',
+                      oauth_settings.get_metrics_sink().render())
+
+    @override_settings(CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER=timedelta(minutes=5))
+    def test_keeps_valid_token_when_circuit_opens(self, mock_refresh, mock_get):
+        self.oauth_token.expires = timezone.now() + timedelta(minutes=2)
+        mock_get.return_value = self.oauth_token
+        mock_refresh.side_effect = CircuitOpenError()
+        self.assertEqual(('stored-token', '42'), get_oauth_token(self.get_request()))
+
+    def test_expired_token(self, mock_refresh, mock_get):
+        self.oauth_token.expires = timezone.now() - timedelta(minutes=1)
+        mock_get.return_value = self.oauth_token
+        mock_refresh.side_effect = CircuitOpenError()
+        self.open_circuit()
+        with self.assertRaises(CircuitOpenError):
+            get_oauth_token(self.get_request())
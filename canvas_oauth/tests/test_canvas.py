@@ -8,7 +8,7 @@ from django.conf import settings
 from django.test import TestCase
 from django.utils import timezone
 
-from canvas_oauth.exceptions import InvalidOAuthReturnError
+from canvas_oauth.exceptions import InvalidGrantError, InvalidOAuthReturnError
 from canvas_oauth.canvas import get_oauth_login_url, get_access_token
 
 
@@ -161,3 +161,28 @@ class TestGetAccessToken(TestCase):
             get_access_token(**params)
 
         mock_post.assert_called_with(self.get_token_url(), params)
+
+
+class TestInvalidGrant(TestCase):
+
+    @patch('canvas_oauth.canvas.get_client')
+    def test_revoked_refresh_token(self, mock_get_client):
+        mock_post = mock_get_client.return_value.post
+        mock_post.return_value.status_code = 400
+        mock_post.return_value.json.return_value = {
+            "error": "invalid_grant", "error_description": "refresh_token not found"}
+
+        with self.assertRaises(InvalidGrantError):
+            get_access_token(settings.CANVAS_OAUTH_CANVAS_DOMAIN, 'refresh_token', None,
+                             refresh_token='revoked')
+
+    @patch('canvas_oauth.canvas.get_client')
+    def test_other_errors(self, mock_get_client):
+        mock_post = mock_get_client.return_value.post
+        mock_post.return_value.status_code = 500
+        mock_post.return_value.json.side_effect = ValueError("No JSON")
+
+        with self.assertRaises(InvalidOAuthReturnError) as cm:
+            get_access_token(settings.CANVAS_OAUTH_CANVAS_DOMAIN, 'refresh_token', None,
+                             refresh_token='refresh')
+        self.assertNotIsInstance(cm.exception, InvalidGrantError)
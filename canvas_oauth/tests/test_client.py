@@ -0,0 +1,234 @@
+import json
+import threading
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.test import TestCase
+
+from canvas_oauth import deadline
+from canvas_oauth.client import CanvasClient, get_client, iter_json_array
+from canvas_oauth.exceptions import DeadlineExceededError
+from canvas_oauth.ratelimit import RateLimitScheduler
+
+
+class TestCanvasClient(TestCase):
+
+    def test_session_is_reused_per_domain(self):
+        client = CanvasClient()
+        self.assertIs(client.get_session('canvas.localhost'), client.get_session('canvas.localhost'))
+        self.assertIsNot(client.get_session('canvas.localhost'), client.get_session('canvas.test.localhost'))
+
+    def test_pool_size(self):
+        client = CanvasClient(pool_maxsize=25)
+        adapter = client.get_session('canvas.localhost').get_adapter('https://canvas.localhost/')
+        self.assertEqual(25, adapter._pool_maxsize)
+
+    def test_keep_alive_disabled(self):
+        client = CanvasClient(keep_alive=False)
+        self.assertEqual('close', client.get_session('canvas.localhost').headers['Connection'])
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_request_defaults(self, mock_request):
+        client = CanvasClient(timeout=(3, 7))
+        client.get('canvas.localhost', '/api/v1/users/self', access_token='token-123')
+        mock_request.assert_called_with(
+            'GET', 'https://canvas.localhost/api/v1/users/self',
+            timeout=(3, 7), headers={'Authorization': 'Bearer token-123'})
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_full_url_and_explicit_timeout(self, mock_request):
+        client = CanvasClient()
+        client.post('canvas.localhost', 'https://canvas.localhost/login/oauth2/token', data={'a': 1}, timeout=2)
+        mock_request.assert_called_with(
+            'POST', 'https://canvas.localhost/login/oauth2/token', data={'a': 1}, timeout=2)
+
+    def test_get_client_is_shared(self):
+        self.assertIs(get_client(), get_client())
+
+
+@patch('canvas_oauth.client.time.sleep')
+@patch('canvas_oauth.client.requests.Session.request')
+class TestRetries(TestCase):
+
+    def test_retries_idempotent_requests(self, mock_request, mock_sleep):
+        mock_request.side_effect = [requests.ConnectionError(), MagicMock(status_code=503),
+                                    MagicMock(status_code=200)]
+        client = CanvasClient(retries=2, backoff=0.5)
+        self.assertEqual(200, client.get('canvas.localhost', '/api/v1/users/self').status_code)
+        self.assertEqual(3, mock_request.call_count)
+        # Full jitter: up to 0.5s, then up to 1s
+        self.assertLessEqual(mock_sleep.call_args_list[0].args[0], 0.5)
+        self.assertLessEqual(mock_sleep.call_args_list[1].args[0], 1.0)
+
+    def test_gives_up(self, mock_request, mock_sleep):
+        mock_request.return_value = MagicMock(status_code=504)
+        client = CanvasClient(retries=2)
+        self.assertEqual(504, client.get('canvas.localhost', '/api/v1/users/self').status_code)
+        self.assertEqual(3, mock_request.call_count)
+
+        mock_request.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            client.get('canvas.localhost', '/api/v1/users/self')
+
+    def test_does_not_retry_non_idempotent_requests(self, mock_request, mock_sleep):
+        mock_request.return_value = MagicMock(status_code=503)
+        client = CanvasClient(retries=2)
+        client.post('canvas.localhost', '/login/oauth2/token')
+        self.assertEqual(1, mock_request.call_count)
+        client.post('canvas.localhost', '/login/oauth2/token', idempotent=True)
+        self.assertEqual(4, mock_request.call_count)
+
+    def test_does_not_retry_client_errors(self, mock_request, mock_sleep):
+        mock_request.return_value = MagicMock(status_code=404)
+        CanvasClient(retries=2).get('canvas.localhost', '/api/v1/users/self')
+        self.assertEqual(1, mock_request.call_count)
+
+
+@patch('canvas_oauth.client.requests.Session.request')
+class TestDeadline(TestCase):
+
+    @patch('canvas_oauth.deadline.time.monotonic', return_value=100.0)
+    def test_caps_timeout(self, mock_monotonic, mock_request):
+        client = CanvasClient(timeout=(3, 7))
+        with deadline.deadline(5):
+            client.get('canvas.localhost', '/api/v1/users/self')
+            mock_request.assert_called_with(
+                'GET', 'https://canvas.localhost/api/v1/users/self', timeout=(3, 5.0))
+            # Nested deadlines can't extend the enclosing one
+            with deadline.deadline(10):
+                self.assertEqual(5.0, deadline.get_remaining())
+        self.assertIsNone(deadline.get_remaining())
+
+    @patch('canvas_oauth.client.random.uniform', return_value=2.0)
+    @patch('canvas_oauth.client.time.sleep')
+    @patch('canvas_oauth.deadline.time.monotonic')
+    def test_no_retries_past_deadline(self, mock_monotonic, mock_sleep, mock_uniform, mock_request):
+        clock = [100.0]
+        mock_monotonic.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        mock_request.return_value = MagicMock(status_code=503)
+        client = CanvasClient(retries=5, backoff=10)
+        with deadline.deadline(3):
+            client.get('canvas.localhost', '/api/v1/users/self')
+        # Retried after 2s, but a second retry could not start before the deadline
+        self.assertEqual(2, mock_request.call_count)
+
+    def test_deadline_exceeded(self, mock_request):
+        with deadline.deadline(0), self.assertRaises(DeadlineExceededError):
+            CanvasClient().get('canvas.localhost', '/api/v1/users/self')
+        self.assertFalse(mock_request.called)
+
+
+@patch('canvas_oauth.client.requests.Session.request')
+class TestHedging(TestCase):
+
+    def test_fast_request_is_not_hedged(self, mock_request):
+        client = CanvasClient(hedge_delay=5)
+        client.post('canvas.localhost', '/login/oauth2/token', idempotent=True, hedge=True)
+        self.assertEqual(1, mock_request.call_count)
+
+    def test_slow_request_is_hedged(self, mock_request):
+        release = threading.Event()
+        slow_response, fast_response = MagicMock(status_code=200), MagicMock(status_code=200)
+
+        def request(*args, **kwargs):
+            if mock_request.call_count == 1:
+                release.wait(5)
+                return slow_response
+            return fast_response
+        mock_request.side_effect = request
+
+        client = CanvasClient(hedge_delay=0.01)
+        response = client.post('canvas.localhost', '/login/oauth2/token', idempotent=True, hedge=True)
+        release.set()
+        self.assertIs(fast_response, response)
+        self.assertEqual(2, mock_request.call_count)
+        client.close()
+
+    def test_non_idempotent_request_is_not_hedged(self, mock_request):
+        client = CanvasClient(hedge_delay=0.01)
+        client.post('canvas.localhost', '/login/oauth2/token', hedge=True)
+        self.assertIsNone(client._hedge_executor)
+
+
+class TestIterJsonArray(TestCase):
+
+    def test_items(self):
+        text = ' [ {"id": 1, "tags": [1, 2]} ,{"id": 2}, "three" ,4] '
+        self.assertEqual([{"id": 1, "tags": [1, 2]}, {"id": 2}, "three", 4], list(iter_json_array(text)))
+
+    def test_empty_array(self):
+        self.assertEqual([], list(iter_json_array('[ ]')))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array('{"id": 1}'))
+
+
+class TestPaginate(TestCase):
+
+    def get_client(self):
+        # Not paced by the state other tests leave in the shared scheduler
+        return CanvasClient(rate_limiter=RateLimitScheduler())
+
+    def get_page(self, items, next_url=None):
+        response = MagicMock()
+        response.text = json.dumps(items)
+        response.json.return_value = {'items': items}
+        response.links = {'next': {'url': next_url}} if next_url else {}
+        response.headers = {}
+        return response
+
+    def get_pages(self):
+        return {
+            'https://canvas.localhost/api/v1/courses/1/assignments': self.get_page(
+                [{'id': 1}, {'id': 2}], 'https://canvas.localhost/api/v1/courses/1/assignments?page=2&per_page=2'),
+            'https://canvas.localhost/api/v1/courses/1/assignments?page=2&per_page=2': self.get_page([{'id': 3}]),
+        }
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_follows_next_links(self, mock_request):
+        pages = self.get_pages()
+        mock_request.side_effect = lambda method, url, **kwargs: pages[url]
+        for prefetch in (True, False):
+            items = self.get_client().paginate(
+                'canvas.localhost', '/api/v1/courses/1/assignments', access_token='token-123',
+                per_page=2, prefetch=prefetch)
+            self.assertEqual([{'id': 1}, {'id': 2}, {'id': 3}], list(items))
+
+        first_call = mock_request.call_args_list[0]
+        self.assertEqual({'per_page': 2}, first_call.kwargs['params'])
+        self.assertEqual('Bearer token-123', first_call.kwargs['headers']['Authorization'])
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_next_links_off_domain_are_refused(self, mock_request):
+        for next_url in ('https://evil.localhost/api/v1/courses/1/assignments?page=2',
+                         'http://canvas.localhost/api/v1/courses/1/assignments?page=2'):
+            mock_request.reset_mock()
+            mock_request.return_value = self.get_page([{'id': 1}], next_url)
+            for prefetch in (True, False):
+                items = self.get_client().paginate(
+                    'canvas.localhost', '/api/v1/courses/1/assignments', access_token='token-123',
+                    prefetch=prefetch)
+                with self.assertRaises(ValueError):
+                    list(items)
+            # The token was only sent to the Canvas domain
+            self.assertEqual({'https://canvas.localhost/api/v1/courses/1/assignments'},
+                             {call.args[1] for call in mock_request.call_args_list})
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_is_lazy(self, mock_request):
+        pages = self.get_pages()
+        mock_request.side_effect = lambda method, url, **kwargs: pages[url]
+        items = self.get_client().paginate('canvas.localhost', '/api/v1/courses/1/assignments', prefetch=False)
+        self.assertFalse(mock_request.called)
+        self.assertEqual({'id': 1}, next(items))
+        self.assertEqual(1, mock_request.call_count)
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_data_key(self, mock_request):
+        pages = self.get_pages()
+        mock_request.side_effect = lambda method, url, **kwargs: pages[url]
+        items = self.get_client().paginate(
+            'canvas.localhost', '/api/v1/courses/1/assignments', data_key='items')
+        self.assertEqual([{'id': 1}, {'id': 2}, {'id': 3}], list(items))
@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from canvas_oauth.exceptions import InvalidGrantError, InvalidOAuthReturnError
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.management.commands.refresh_canvas_tokens import Command as RefreshCommand
+from canvas_oauth.management.commands.sweep_canvas_tokens import Command as SweepCommand
+
+
+def get_stub_tokens(*domains):
+    tokens = []
+    for pk, domain in enumerate(domains, start=1):
+        oauth_token = MagicMock()
+        oauth_token.pk = pk
+        oauth_token.canvas_domain = domain
+        tokens.append(oauth_token)
+    return tokens
+
+
+class TestRefreshCanvasTokens(TestCase):
+
+    @patch('canvas_oauth.management.commands.refresh_canvas_tokens.refresh_access_token')
+    @patch.object(RefreshCommand, 'iter_expiring_tokens')
+    def test_refreshes_expiring_tokens(self, mock_iter_expiring_tokens, mock_refresh_access_token):
+        tokens = get_stub_tokens('canvas.localhost', 'canvas.localhost', 'canvas.test.localhost')
+        mock_iter_expiring_tokens.return_value = iter(tokens)
+        mock_refresh_access_token.side_effect = [None, InvalidOAuthReturnError("invalid_grant"), None]
+
+        out = StringIO()
+        call_command('refresh_canvas_tokens', '--window=300', '--workers=1', stdout=out)
+
+        self.assertEqual(3, mock_refresh_access_token.call_count)
+        for call in mock_refresh_access_token.call_args_list:
+            self.assertEqual(timedelta(seconds=300), call.kwargs['buffer'])
+        self.assertIn("Refreshed 2 tokens (1 failed)", out.getvalue())
+
+    @patch('canvas_oauth.management.commands.refresh_canvas_tokens.refresh_access_token')
+    @patch.object(RefreshCommand, 'expiring_per_minute')
+    def test_dry_run_reports_per_minute(self, mock_expiring_per_minute, mock_refresh_access_token):
+        mock_expiring_per_minute.return_value = [
+            {'minute': datetime(2026, 1, 1, 9, 0), 'count': 300},
+            {'minute': datetime(2026, 1, 1, 9, 1), 'count': 12},
+        ]
+
+        out = StringIO()
+        call_command('refresh_canvas_tokens', '--dry-run', stdout=out)
+
+        self.assertFalse(mock_refresh_access_token.called)
+        self.assertIn("2026-01-01 09:00  300", out.getvalue())
+        self.assertIn("312 tokens would be refreshed", out.getvalue())
+
+    def test_skips_long_expired_tokens(self):
+        now = timezone.now()
+        for canvas_user_id, expires in (('1', now + timedelta(minutes=5)), ('2', now - timedelta(minutes=30)),
+                                        ('3', now - timedelta(days=30)), ('4', now + timedelta(hours=1))):
+            canvas_user = CanvasUser.objects.create(canvas_user_id=canvas_user_id, canvas_domain='canvas.localhost')
+            CanvasOAuth2Token.objects.create(
+                user=canvas_user, canvas_domain='canvas.localhost', access_token=f'token-{canvas_user_id}',
+                refresh_token='refresh', expires=expires)
+
+        tokens = RefreshCommand().iter_expiring_tokens(timedelta(minutes=10), timedelta(hours=1), 500)
+        self.assertEqual(['token-2', 'token-1'], [oauth_token.access_token for oauth_token in tokens])
+
+
+class TestSweepCanvasTokens(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.users = [CanvasUser.objects.create(canvas_user_id=str(i), name=f"User {i}") for i in range(5)]
+        self.idle = CanvasOAuth2Token.objects.create(
+            user=self.users[0], canvas_domain='canvas.localhost', access_token='a', refresh_token='r',
+            expires=now - timedelta(days=100))
+        self.expired = CanvasOAuth2Token.objects.create(
+            user=self.users[1], canvas_domain='canvas.localhost', access_token='a', refresh_token='r',
+            expires=now - timedelta(hours=2))
+        self.active = CanvasOAuth2Token.objects.create(
+            user=self.users[2], canvas_domain='canvas.localhost', access_token='a', refresh_token='r',
+            expires=now + timedelta(hours=1))
+        # users[3] and users[4] never finished the OAuth flow
+        CanvasUser.objects.filter(pk__in=[self.users[3].pk, self.users[4].pk]).update(
+            created_at=now - timedelta(days=2))
+
+    def call_command(self, *args):
+        out = StringIO()
+        call_command('sweep_canvas_tokens', '--sleep=0', '--chunk-size=1', *args, stdout=out)
+        return out.getvalue()
+
+    def test_deletes_idle_tokens_and_orphans(self):
+        out = self.call_command()
+
+        self.assertEqual({self.expired.pk, self.active.pk},
+                         set(CanvasOAuth2Token.objects.values_list('pk', flat=True)))
+        # users[0] lost its only token but was created just now
+        self.assertEqual(3, CanvasUser.objects.count())
+        self.assertIn("Deleted 1 idle tokens", out)
+        self.assertIn("Deleted 2 orphaned users", out)
+
+    @patch('canvas_oauth.management.commands.sweep_canvas_tokens.canvas.get_access_token')
+    def test_verify_deletes_revoked_tokens(self, mock_get_access_token):
+        mock_get_access_token.side_effect = InvalidGrantError("invalid_grant")
+
+        out = self.call_command('--verify')
+
+        mock_get_access_token.assert_called_once_with(
+            domain='canvas.localhost', grant_type='refresh_token', redirect_uri=None, refresh_token='r')
+        self.assertEqual([self.active.pk], list(CanvasOAuth2Token.objects.values_list('pk', flat=True)))
+        self.assertIn("Deleted 1 revoked tokens", out)
+
+    @patch('canvas_oauth.management.commands.sweep_canvas_tokens.canvas.get_access_token')
+    def test_verify_does_not_save_refreshed_tokens(self, mock_get_access_token):
+        mock_get_access_token.return_value = ('new', timezone.now() + timedelta(hours=1), None)
+
+        self.call_command('--verify')
+
+        self.expired.refresh_from_db()
+        self.assertEqual('a', self.expired.access_token)
+        self.assertLess(self.expired.expires, timezone.now())
+
+    def test_ranges_skip_gaps_between_pks(self):
+        CanvasOAuth2Token.objects.filter(pk=self.idle.pk).update(id=self.idle.pk + 100000)
+        command = SweepCommand()
+        with self.assertNumQueries(5):
+            ranges = [set(chunk.values_list('pk', flat=True))
+                      for chunk in command.iter_pk_ranges(CanvasOAuth2Token.objects.all(), 2)]
+        self.assertEqual([{self.expired.pk, self.active.pk}, {self.idle.pk + 100000}], ranges)
+
+    def test_dry_run(self):
+        out = self.call_command('--dry-run')
+
+        self.assertEqual(3, CanvasOAuth2Token.objects.count())
+        self.assertIn("1 idle tokens would be deleted", out)
+        self.assertIn("2 orphaned users would be deleted", out)
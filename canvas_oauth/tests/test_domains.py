@@ -0,0 +1,112 @@
+from datetime import timedelta
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.exceptions import CanvasDomainError, MissingTokenError
+from canvas_oauth.locks import CacheLock
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.oauth import (
+    get_canvas_domain, get_canvas_user, get_oauth_token, handle_missing_token, oauth_callback)
+from canvas_oauth.token_cache import TokenCache
+
+ENVIRONMENTS = {
+    'production': {'client_id': 'prod-id', 'client_secret': 'prod-secret', 'canvas_domain': 'canvas.school.edu'},
+    'test': {'client_id': 'test-id', 'client_secret': 'test-secret', 'canvas_domain': 'canvas.test.school.edu'},
+}
+
+
+@override_settings(CANVAS_OAUTH_ENVIRONMENTS=ENVIRONMENTS,
+                   CANVAS_OAUTH_ENVIRONMENT_RESOLVER='canvas_oauth.resolvers.LtiBasedResolver')
+@patch('canvas_oauth.oauth.settings.get_refresh_lock', return_value=CacheLock(wait=0))
+class TestMultiDomainTokens(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for domain, access_token in (('canvas.school.edu', 'prod-token'), ('canvas.test.school.edu', 'test-token')):
+            canvas_user = CanvasUser.objects.create(canvas_user_id='42', canvas_domain=domain, name='Jane')
+            CanvasOAuth2Token.objects.create(
+                user=canvas_user, canvas_domain=domain, access_token=access_token,
+                refresh_token=f'{access_token}-refresh', expires=timezone.now() + timedelta(hours=1))
+
+    def get_request(self, canvas_domain, path='/index', **params):
+        request = RequestFactory().get(path, params)
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request.session['user_id'] = '42'
+        if canvas_domain:
+            request.session['canvas_domain'] = canvas_domain
+        return request
+
+    def test_token_per_domain(self, mock_lock):
+        self.assertEqual(('prod-token', '42'), get_oauth_token(self.get_request('canvas.school.edu')))
+        self.assertEqual(('test-token', '42'), get_oauth_token(self.get_request('canvas.test.school.edu')))
+        with self.assertRaises(MissingTokenError):
+            get_oauth_token(self.get_request('canvas.other.edu'))
+
+    def test_cache_is_keyed_by_domain(self, mock_lock):
+        with patch('canvas_oauth.oauth.get_token_cache', return_value=TokenCache()):
+            get_oauth_token(self.get_request('canvas.school.edu'))
+            self.assertEqual(('test-token', '42'), get_oauth_token(self.get_request('canvas.test.school.edu')))
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_refresh_uses_token_domain(self, mock_get_access_token, mock_lock):
+        CanvasOAuth2Token.objects.update(expires=timezone.now() - timedelta(minutes=1))
+        mock_get_access_token.return_value = ('new-test-token', timezone.now() + timedelta(hours=1), None)
+
+        get_oauth_token(self.get_request('canvas.test.school.edu'))
+
+        self.assertEqual('canvas.test.school.edu', mock_get_access_token.call_args.kwargs['domain'])
+        self.assertEqual('prod-token', CanvasOAuth2Token.objects.get(canvas_domain='canvas.school.edu').access_token)
+
+    def test_unresolved_domain(self, mock_lock):
+        with patch.object(oauth_settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', None):
+            with self.assertRaises(CanvasDomainError):
+                get_canvas_domain(self.get_request(None))
+
+    @patch('canvas_oauth.oauth.settings.get_profile_updater')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_oauth_flow_keeps_domain(self, mock_get_access_token, mock_get_profile_updater, mock_lock):
+        response = handle_missing_token(self.get_request('canvas.test.school.edu'))
+        authorize_url = urlparse(response.url)
+        self.assertEqual('canvas.test.school.edu', authorize_url.netloc)
+        self.assertEqual(['test-id'], parse_qs(authorize_url.query)['client_id'])
+
+        mock_get_access_token.return_value = (
+            'new-test-token', timezone.now() + timedelta(hours=1), 'refresh', {'id': 42, 'name': 'Jane'})
+        state = parse_qs(authorize_url.query)['state'][0]
+        request = self.get_request(None, '/oauth/oauth-callback', code='code', state=state)
+        request.session['canvas_oauth_request_state'] = state
+        oauth_callback(request)
+
+        self.assertEqual('canvas.test.school.edu', mock_get_access_token.call_args.kwargs['domain'])
+        self.assertEqual('new-test-token',
+                         CanvasOAuth2Token.objects.get(canvas_domain='canvas.test.school.edu').access_token)
+
+    @patch('canvas_oauth.oauth.settings.get_profile_updater')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_users_are_per_domain(self, mock_get_access_token, mock_get_profile_updater, mock_lock):
+        CanvasUser.objects.all().delete()
+        for domain, name in (('canvas.school.edu', 'Jane'), ('canvas.test.school.edu', 'John')):
+            response = handle_missing_token(self.get_request(domain))
+            state = parse_qs(urlparse(response.url).query)['state'][0]
+            mock_get_access_token.return_value = (
+                f'{name}-token', timezone.now() + timedelta(hours=1), 'refresh', {'id': 42, 'name': name})
+            request = self.get_request(None, '/oauth/oauth-callback', code='code', state=state)
+            request.session['canvas_oauth_request_state'] = state
+            oauth_callback(request)
+
+        self.assertEqual(2, CanvasUser.objects.filter(canvas_user_id='42').count())
+        self.assertEqual('Jane', get_canvas_user(self.get_request('canvas.school.edu')).name)
+        self.assertEqual('John', get_canvas_user(self.get_request('canvas.test.school.edu')).name)
+        self.assertEqual(
+            ('canvas.test.school.edu', 'John'),
+            (mock_get_profile_updater.return_value.schedule.call_args.args[2],
+             CanvasOAuth2Token.objects.get(access_token='John-token').user.name))
@@ -0,0 +1,101 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import early_refresh
+from canvas_oauth.oauth import get_oauth_token
+from canvas_oauth.token_cache import TokenCache
+
+DOMAIN = 'canvas.localhost'
+
+
+class TestRefreshBuffer(SimpleTestCase):
+
+    def setUp(self):
+        early_refresh._clear_latencies()
+        self.addCleanup(early_refresh._clear_latencies)
+
+    @override_settings(CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER=timedelta(minutes=5))
+    def test_disabled(self):
+        self.assertEqual(timedelta(minutes=5), early_refresh.get_refresh_buffer(DOMAIN))
+
+    @override_settings(CANVAS_OAUTH_EARLY_REFRESH_ENABLED=True, CANVAS_OAUTH_EARLY_REFRESH_BETA=60.0,
+                       CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER=timedelta(minutes=5))
+    @patch('canvas_oauth.early_refresh.random.random')
+    def test_enabled(self, mock_random):
+        early_refresh.record_refresh_latency(DOMAIN, 0.5)
+        # -0.5 * 60 * ln(1 - (1 - 1/e)) = 30 seconds
+        mock_random.return_value = 1 - 1 / 2.718281828459045
+        buffer = early_refresh.get_refresh_buffer(DOMAIN)
+        self.assertAlmostEqual(330, buffer.total_seconds(), places=3)
+        # The most likely draws add little to the buffer
+        mock_random.return_value = 0.0
+        self.assertEqual(timedelta(minutes=5), early_refresh.get_refresh_buffer(DOMAIN))
+
+    @override_settings(CANVAS_OAUTH_EARLY_REFRESH_ENABLED=True,
+                       CANVAS_OAUTH_EARLY_REFRESH_MAX_AHEAD=timedelta(minutes=2))
+    @patch('canvas_oauth.early_refresh.random.random', return_value=0.999999999)
+    def test_max_ahead(self, mock_random):
+        self.assertEqual(timedelta(minutes=2), early_refresh.get_refresh_buffer(DOMAIN))
+
+    @override_settings(CANVAS_OAUTH_EARLY_REFRESH_ENABLED=True)
+    def test_spreads_refreshes(self):
+        # Early refreshes of tokens expiring together are spread over time
+        buffers = [early_refresh.get_refresh_buffer(DOMAIN).total_seconds() for _ in range(1000)]
+        self.assertLess(min(buffers), 5)
+        self.assertGreater(max(buffers), 120)
+        self.assertLess(abs(sum(buffers) / len(buffers) - 60), 15)
+
+    def test_refresh_latency(self):
+        self.assertEqual(early_refresh.DEFAULT_LATENCY, early_refresh.get_refresh_latency(DOMAIN))
+        early_refresh.record_refresh_latency(DOMAIN, 1.0)
+        early_refresh.record_refresh_latency(DOMAIN, 2.0)
+        self.assertAlmostEqual(1.2, early_refresh.get_refresh_latency(DOMAIN))
+        self.assertEqual(early_refresh.DEFAULT_LATENCY, early_refresh.get_refresh_latency('other.localhost'))
+
+
+@override_settings(CANVAS_OAUTH_EARLY_REFRESH_ENABLED=True)
+class TestGetOauthTokenEarlyRefresh(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.token_cache = TokenCache()
+        patcher = patch('canvas_oauth.oauth.get_token_cache', return_value=self.token_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.oauth_token = MagicMock(access_token='stored-token', expires=timezone.now() + timedelta(minutes=2))
+        self.oauth_token.expires_within.side_effect = (
+            lambda delta: self.oauth_token.expires - timezone.now() <= delta)
+
+    def get_request(self):
+        request = RequestFactory().get('/index')
+        request.user = MagicMock()
+        request.session = SessionStore()
+        request.session['user_id'] = '42'
+        return request
+
+    @patch('canvas_oauth.oauth.refresh_oauth_token')
+    @patch('canvas_oauth.oauth._get_stored_token')
+    @patch('canvas_oauth.oauth.early_refresh.get_refresh_buffer', return_value=timedelta(minutes=5))
+    def test_early_refresh(self, mock_buffer, mock_get, mock_refresh):
+        self.token_cache.set('42', DOMAIN, 'cached-token', self.oauth_token.expires)
+        mock_get.return_value = self.oauth_token
+        mock_refresh.return_value = MagicMock(access_token='new-token', expires=timezone.now() + timedelta(hours=1))
+
+        self.assertEqual(('new-token', '42'), get_oauth_token(self.get_request()))
+        # The refresh is not coalesced away by the expiration buffer
+        self.assertEqual(timedelta(minutes=5), mock_refresh.call_args.kwargs['buffer'])
+
+    @patch('canvas_oauth.oauth.refresh_oauth_token')
+    @patch('canvas_oauth.oauth._get_stored_token')
+    @patch('canvas_oauth.oauth.early_refresh.get_refresh_buffer', return_value=timedelta(seconds=30))
+    def test_no_early_refresh(self, mock_buffer, mock_get, mock_refresh):
+        self.token_cache.set('42', DOMAIN, 'cached-token', self.oauth_token.expires)
+        self.assertEqual(('cached-token', '42'), get_oauth_token(self.get_request()))
+        self.assertFalse(mock_get.called)
+        self.assertFalse(mock_refresh.called)
@@ -0,0 +1,70 @@
+"""
+Import-time budget.  Importing the middleware and views must not pull in
+debuggers or optional dependencies, canvas_oauth's own modules must import
+quickly, and importing the settings module must not read Django settings.
+"""
+import os
+import subprocess
+import sys
+
+from django.test import SimpleTestCase
+
+import canvas_oauth
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(canvas_oauth.__file__)))
+
+# Total self import time of canvas_oauth modules, in microseconds.  Generous,
+# so that only a heavy import at module level exceeds it.
+IMPORT_BUDGET = 50000
+
+FORBIDDEN_MODULES = ('ipdb', 'IPython', 'httpx')
+
+
+def get_import_times(code, settings_module='canvas_oauth.tests.django_settings'):
+    """
+    Runs `code` in a fresh interpreter with `-X importtime` and returns the
+    self import time in microseconds of every module it imported.
+    """
+    env = dict(os.environ)
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    if settings_module:
+        env['DJANGO_SETTINGS_MODULE'] = settings_module
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise AssertionError(result.stderr)
+
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, _, module = line[len('import time:'):].split('|')
+        if self_time.strip().isdigit():
+            import_times[module.strip()] = int(self_time)
+    return import_times
+
+
+class TestImportTime(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.import_times = get_import_times(
+            "import django; django.setup(); import canvas_oauth.middleware, canvas_oauth.oauth")
+
+    def test_no_debugger_or_optional_imports(self):
+        imported = {module.split('.')[0] for module in self.import_times}
+        for module in FORBIDDEN_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_import_budget(self):
+        own_time = sum(self_time for module, self_time in self.import_times.items()
+                       if module.split('.')[0] == 'canvas_oauth')
+        self.assertLess(own_time, IMPORT_BUDGET)
+
+    def test_settings_import_reads_no_settings(self):
+        # Without DJANGO_SETTINGS_MODULE, reading any Django setting raises
+        get_import_times(
+            "import canvas_oauth.settings; from django.conf import settings; assert not settings.configured",
+            settings_module=None)
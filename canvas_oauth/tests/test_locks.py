@@ -0,0 +1,118 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from canvas_oauth.locks import CacheLock, DatabaseLock
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.oauth import refresh_oauth_token
+
+
+def get_stub_token(expires, pk=1):
+    oauth_token = MagicMock()
+    oauth_token.pk = pk
+    oauth_token.user_id = 7
+    oauth_token.canvas_domain = 'canvas.localhost'
+    oauth_token.refresh_token = 'refresh-token'
+    oauth_token.access_token = 'old-access-token'
+    oauth_token.expires = expires
+    oauth_token.updated_on = timezone.now() - timedelta(hours=1)
+    oauth_token.expires_within.side_effect = lambda delta: expires - timezone.now() <= delta
+    return oauth_token
+
+
+class TestCacheLock(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_lock_is_exclusive(self):
+        oauth_token = get_stub_token(timezone.now())
+        lock = CacheLock(wait=0)
+        with lock.hold(oauth_token) as acquired:
+            self.assertTrue(acquired)
+            with lock.hold(oauth_token) as acquired_again:
+                self.assertFalse(acquired_again)
+        with lock.hold(oauth_token) as acquired:
+            self.assertTrue(acquired)
+
+    def test_lock_is_per_user_and_domain(self):
+        lock = CacheLock(wait=0)
+        first, second = get_stub_token(timezone.now()), get_stub_token(timezone.now())
+        second.canvas_domain = 'canvas.test.localhost'
+        with lock.hold(first) as acquired:
+            self.assertTrue(acquired)
+            with lock.hold(second) as acquired:
+                self.assertTrue(acquired)
+
+
+@override_settings(DATABASE_ROUTERS=['canvas_oauth.routers.CanvasOAuthRouter'],
+                   CANVAS_OAUTH_READ_DATABASES=['replica'])
+class TestDatabaseLock(TestCase):
+
+    def test_locks_on_write_database(self):
+        canvas_user = CanvasUser.objects.create(canvas_user_id='7', canvas_domain='canvas.localhost')
+        oauth_token = CanvasOAuth2Token.objects.create(
+            user=canvas_user, canvas_domain='canvas.localhost', access_token='access-token',
+            refresh_token='refresh-token', expires=timezone.now())
+        # As if the token had been read from the replica
+        oauth_token._state.db = 'replica'
+
+        with patch('canvas_oauth.locks.transaction.atomic', wraps=transaction.atomic) as mock_atomic:
+            with CaptureQueriesContext(connections['default']) as queries:
+                with DatabaseLock().hold(oauth_token) as acquired:
+                    self.assertTrue(acquired)
+        mock_atomic.assert_called_once_with(using='default')
+        self.assertTrue(any('canvas_oauth_canvasoauth2token' in query['sql'] for query in queries))
+
+
+@patch('canvas_oauth.oauth.settings.get_refresh_lock', return_value=CacheLock(wait=0))
+class TestSingleFlightRefresh(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/index')
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects')
+    def test_waiter_returns_winners_token(self, mock_objects, mock_get_access_token, mock_lock):
+        stale_token = get_stub_token(timezone.now() - timedelta(minutes=1))
+        fresh_token = get_stub_token(timezone.now() + timedelta(hours=1))
+        mock_objects.select_related.return_value.filter.return_value.first.return_value = fresh_token
+
+        self.assertIs(fresh_token, refresh_oauth_token(self.request, stale_token))
+        self.assertFalse(mock_get_access_token.called)
+        self.assertFalse(mock_objects.filter.return_value.update.called)
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects')
+    def test_refresh_is_compare_and_swap(self, mock_objects, mock_get_access_token, mock_lock):
+        stale_token = get_stub_token(timezone.now() - timedelta(minutes=1))
+        previous_updated_on = stale_token.updated_on
+        new_expires = timezone.now() + timedelta(hours=1)
+        mock_get_access_token.return_value = ('new-access-token', new_expires, None)
+        mock_objects.select_related.return_value.filter.return_value.first.return_value = stale_token
+        mock_objects.filter.return_value.update.return_value = 1
+
+        oauth_token = refresh_oauth_token(self.request, stale_token)
+
+        self.assertEqual('new-access-token', oauth_token.access_token)
+        self.assertEqual(new_expires, oauth_token.expires)
+        mock_objects.filter.assert_any_call(pk=stale_token.pk, updated_on=previous_updated_on)
+        self.assertEqual(1, mock_get_access_token.call_count)
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects')
+    def test_lost_compare_and_swap_returns_saved_token(self, mock_objects, mock_get_access_token, mock_lock):
+        stale_token = get_stub_token(timezone.now() - timedelta(minutes=1))
+        saved_token = get_stub_token(timezone.now() + timedelta(hours=1))
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        mock_objects.select_related.return_value.filter.return_value.first.side_effect = [stale_token, saved_token]
+        mock_objects.filter.return_value.update.return_value = 0
+
+        self.assertIs(saved_token, refresh_oauth_token(self.request, stale_token))
@@ -0,0 +1,186 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import canvas, metrics, signals
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.exceptions import InvalidOAuthReturnError, MissingTokenError
+from canvas_oauth.locks import CacheLock
+from canvas_oauth.middleware import OAuthMiddleware
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.oauth import get_oauth_token, refresh_oauth_token
+
+DOMAIN = 'canvas.localhost'
+SINK = 'canvas_oauth.metrics.PrometheusMetricsSink'
+
+
+class TestPrometheusMetricsSink(SimpleTestCase):
+
+    def test_render_counters(self):
+        sink = metrics.PrometheusMetricsSink()
+        sink.increment(metrics.TOKEN_LOOKUPS, labels={'source': 'cache', 'result': 'hit'})
+        sink.increment(metrics.TOKEN_LOOKUPS, 2, labels={'source': 'cache', 'result': 'hit'})
+        sink.increment(metrics.MISSING_TOKENS)
+        text = sink.render()
+        self.assertIn("# TYPE canvas_oauth_token_lookups_total counter", text)
+        self.assertIn('canvas_oauth_token_lookups_total{result="hit",source="cache"} 3', text)
+        self.assertIn("canvas_oauth_missing_tokens_total 1", text)
+
+    def test_render_histograms(self):
+        sink = metrics.PrometheusMetricsSink()
+        sink.observe(metrics.CALLBACK_SECONDS, 0.02, labels={'outcome': '3xx'})
+        sink.observe(metrics.CALLBACK_SECONDS, 0.3, labels={'outcome': '3xx'})
+        sink.observe(metrics.CALLBACK_SECONDS, 20, labels={'outcome': '3xx'})
+        text = sink.render()
+        self.assertIn("# TYPE canvas_oauth_callback_seconds histogram", text)
+        self.assertIn('canvas_oauth_callback_seconds_bucket{outcome="3xx",le="0.01"} 0', text)
+        self.assertIn('canvas_oauth_callback_seconds_bucket{outcome="3xx",le="0.025"} 1', text)
+        self.assertIn('canvas_oauth_callback_seconds_bucket{outcome="3xx",le="0.5"} 2', text)
+        self.assertIn('canvas_oauth_callback_seconds_bucket{outcome="3xx",le="10.0"} 2', text)
+        self.assertIn('canvas_oauth_callback_seconds_bucket{outcome="3xx",le="+Inf"} 3', text)
+        self.assertIn('canvas_oauth_callback_seconds_sum{outcome="3xx"} 20.32', text)
+        self.assertIn('canvas_oauth_callback_seconds_count{outcome="3xx"} 3', text)
+
+    def test_render_escapes_label_values(self):
+        sink = metrics.PrometheusMetricsSink()
+        sink.increment('custom_total', labels={'error': 'a "quoted"\\value\n'})
+        self.assertIn('custom_total{error="a \\"quoted\\"\\\\value\\n"} 1', sink.render())
+
+
+class TestMetricsDisabled(SimpleTestCase):
+
+    def test_no_sink_by_default(self):
+        self.assertIsNone(oauth_settings.get_metrics_sink())
+        metrics.increment(metrics.MISSING_TOKENS)
+        with metrics.timer(metrics.CALLBACK_SECONDS) as timer:
+            pass
+        self.assertIsNotNone(timer.elapsed)
+
+    def test_metrics_view_not_found(self):
+        with self.assertRaises(Http404):
+            metrics.metrics_view(RequestFactory().get('/metrics'))
+
+
+@override_settings(CANVAS_OAUTH_METRICS_SINK=SINK)
+class TestMetricsHelpers(SimpleTestCase):
+
+    def setUp(self):
+        # Start each test with a fresh sink
+        oauth_settings.reset_caches('CANVAS_OAUTH_METRICS_SINK')
+
+    def test_timer_outcome(self):
+        with metrics.timer(metrics.TOKEN_REFRESH_SECONDS) as timer:
+            timer.outcome = 'coalesced'
+        with self.assertRaises(ValueError):
+            with metrics.timer(metrics.TOKEN_REFRESH_SECONDS):
+                raise ValueError()
+        text = oauth_settings.get_metrics_sink().render()
+        self.assertIn('canvas_oauth_token_refresh_seconds_count{outcome="coalesced"} 1', text)
+        self.assertIn('canvas_oauth_token_refresh_seconds_count{outcome="ValueError"} 1', text)
+
+    def test_timed_view(self):
+        view = metrics.timed_view(metrics.CALLBACK_SECONDS)(lambda request: HttpResponse(status=302))
+        self.assertEqual(302, view(RequestFactory().get('/')).status_code)
+        self.assertIn('canvas_oauth_callback_seconds_count{outcome="3xx"} 1',
+                      oauth_settings.get_metrics_sink().render())
+
+    def test_metrics_view(self):
+        metrics.increment(metrics.MISSING_TOKENS)
+        response = metrics.metrics_view(RequestFactory().get('/metrics'))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b"canvas_oauth_missing_tokens_total 1", response.content)
+
+    @patch('canvas_oauth.middleware.handle_missing_token')
+    def test_middleware_counts_missing_tokens(self, mock_handle_missing_token):
+        OAuthMiddleware(lambda request: HttpResponse()).process_exception(
+            RequestFactory().get('/index'), MissingTokenError())
+        self.assertIn("canvas_oauth_missing_tokens_total 1", oauth_settings.get_metrics_sink().render())
+
+    @patch('canvas_oauth.canvas.get_canvas_credentials', return_value=(101, 'fake-secret', f"https://{DOMAIN}"))
+    @patch('canvas_oauth.canvas.get_client')
+    def test_access_token_grant(self, mock_get_client, mock_credentials):
+        response = MagicMock(status_code=200, text='')
+        response.json.return_value = {'access_token': 'token', 'expires_in': 3600}
+        mock_get_client.return_value.post.return_value = response
+        receiver = MagicMock()
+        signals.access_token_granted.connect(receiver)
+        self.addCleanup(signals.access_token_granted.disconnect, receiver)
+
+        canvas.get_access_token(DOMAIN, 'refresh_token', None, refresh_token='refresh')
+        response.status_code = 400
+        with self.assertRaises(InvalidOAuthReturnError):
+            canvas.get_access_token(DOMAIN, 'refresh_token', None, refresh_token='refresh')
+
+        text = oauth_settings.get_metrics_sink().render()
+        self.assertIn('canvas_oauth_token_grant_seconds_count{domain="canvas.localhost",'
+                      'grant_type="refresh_token",outcome="success"} 1', text)
+        self.assertIn('canvas_oauth_token_grant_seconds_count{domain="canvas.localhost",'
+                      'grant_type="refresh_token",outcome="InvalidOAuthReturnError"} 1', text)
+        receiver.assert_called_once()
+        self.assertEqual('refresh_token', receiver.call_args.kwargs['grant_type'])
+
+
+@override_settings(CANVAS_OAUTH_CLIENT_ID=101, CANVAS_OAUTH_CLIENT_SECRET='fake-secret',
+                   CANVAS_OAUTH_CANVAS_DOMAIN=DOMAIN, CANVAS_OAUTH_METRICS_SINK=SINK)
+@patch.object(oauth_settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', DOMAIN)
+@patch('canvas_oauth.oauth.settings.get_refresh_lock', return_value=CacheLock(wait=0))
+class TestTokenLifecycleMetrics(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        oauth_settings.reset_caches('CANVAS_OAUTH_METRICS_SINK')
+        self.canvas_user = CanvasUser.objects.create(canvas_user_id='42', canvas_domain=DOMAIN, name='Jane')
+        self.oauth_token = CanvasOAuth2Token.objects.create(
+            user=self.canvas_user, canvas_domain=DOMAIN, access_token='access-token',
+            refresh_token='refresh-token', expires=timezone.now() + timedelta(hours=1))
+
+    def get_request(self, user_id='42'):
+        request = RequestFactory().get('/index')
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request.session['user_id'] = user_id
+        return request
+
+    def connect(self, signal):
+        receiver = MagicMock()
+        signal.connect(receiver)
+        self.addCleanup(signal.disconnect, receiver)
+        return receiver
+
+    def test_token_lookups(self, mock_lock):
+        retrieved = self.connect(signals.token_retrieved)
+        missing = self.connect(signals.token_missing)
+
+        get_oauth_token(self.get_request())
+        with self.assertRaises(MissingTokenError):
+            get_oauth_token(self.get_request(user_id='43'))
+
+        text = oauth_settings.get_metrics_sink().render()
+        self.assertIn('canvas_oauth_token_lookups_total{result="hit",source="database"} 1', text)
+        self.assertIn('canvas_oauth_token_lookups_total{result="missing",source="database"} 1', text)
+        self.assertEqual('42', retrieved.call_args.kwargs['user_id'])
+        self.assertEqual(DOMAIN, retrieved.call_args.kwargs['domain'])
+        self.assertEqual('43', missing.call_args.kwargs['user_id'])
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_token_refresh(self, mock_get_access_token, mock_lock):
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        refreshed = self.connect(signals.token_refreshed)
+        oauth_token = CanvasOAuth2Token.objects.select_related('user').get(pk=self.oauth_token.pk)
+        CanvasOAuth2Token.objects.update(expires=timezone.now())
+        oauth_token.expires = timezone.now()
+
+        refresh_oauth_token(self.get_request(), oauth_token)
+
+        self.assertIn('canvas_oauth_token_refresh_seconds_count{outcome="refreshed"} 1',
+                      oauth_settings.get_metrics_sink().render())
+        self.assertEqual('refreshed', refreshed.call_args.kwargs['outcome'])
+        self.assertEqual('new-access-token', refreshed.call_args.kwargs['oauth_token'].access_token)
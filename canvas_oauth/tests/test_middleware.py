@@ -1,9 +1,21 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+
+from asgiref.sync import iscoroutinefunction
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.http import HttpResponse
+from django.utils import timezone
 from unittest.mock import patch
 
+from canvas_oauth import deadline
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.locks import CacheLock
 from canvas_oauth.middleware import OAuthMiddleware
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.oauth import get_oauth_token, refresh_oauth_token
 from canvas_oauth.exceptions import MissingTokenError, CanvasOAuthError
 
 
@@ -11,6 +23,10 @@ def dummy_response(request):
     return HttpResponse("Dummy")
 
 
+async def async_dummy_response(request):
+    return HttpResponse("Dummy")
+
+
 class TestOAuthMiddleware(TestCase):
 
     def test_without_triggering_oauth_flow(self):
@@ -21,6 +37,29 @@ class TestOAuthMiddleware(TestCase):
         self.assertEqual(expected_response.status_code, response.status_code)
         self.assertEqual(expected_response.content, response.content)
 
+    def test_async_without_triggering_oauth_flow(self):
+        request = RequestFactory().get('/index')
+        middleware = OAuthMiddleware(async_dummy_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = asyncio.run(middleware(request))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b"Dummy", response.content)
+
+    def test_sync_middleware_is_not_a_coroutine_function(self):
+        self.assertFalse(iscoroutinefunction(OAuthMiddleware(dummy_response)))
+
+    @override_settings(CANVAS_OAUTH_REQUEST_DEADLINE=30)
+    def test_request_deadline(self):
+        remaining = []
+
+        def get_response(request):
+            remaining.append(deadline.get_remaining())
+            return dummy_response(request)
+
+        OAuthMiddleware(get_response)(RequestFactory().get('/index'))
+        self.assertTrue(0 < remaining[0] <= 30)
+        self.assertIsNone(deadline.get_remaining())
+
     @patch('canvas_oauth.middleware.handle_missing_token')
     def test_missing_token_error(self, mock_handle_missing_token):
         request = RequestFactory().get('/index')
@@ -36,3 +75,63 @@ class TestOAuthMiddleware(TestCase):
         middleware = OAuthMiddleware(dummy_response)
         middleware.process_exception(request, exception)
         mock_render_oauth_error.assert_called_with(str(exception))
+
+
+@override_settings(CANVAS_OAUTH_CLIENT_ID=101, CANVAS_OAUTH_CLIENT_SECRET='fake-secret',
+                   CANVAS_OAUTH_CANVAS_DOMAIN='canvas.localhost')
+@patch.object(oauth_settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', 'canvas.localhost')
+@patch('canvas_oauth.oauth.settings.get_refresh_lock', return_value=CacheLock(wait=0))
+class TestRequestToken(TestCase):
+
+    def setUp(self):
+        self.canvas_user = CanvasUser.objects.create(
+            canvas_user_id='42', canvas_domain='canvas.localhost', name='Jane')
+        self.oauth_token = CanvasOAuth2Token.objects.create(
+            user=self.canvas_user, canvas_domain='canvas.localhost', access_token='access-token',
+            refresh_token='refresh-token', expires=timezone.now() + timedelta(hours=1))
+
+    def get_request(self, user_id='42'):
+        request = RequestFactory().get('/index')
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request.session['user_id'] = user_id
+        OAuthMiddleware(dummy_response).process_request(request)
+        return request
+
+    def test_attributes_are_lazy(self, mock_lock):
+        with self.assertNumQueries(0):
+            self.get_request()
+
+    def test_token_is_resolved_once_per_request(self, mock_lock):
+        request = self.get_request()
+        with self.assertNumQueries(1):
+            self.assertEqual('access-token', request.canvas_token.access_token)
+            self.assertEqual('42', request.canvas_token.user_id)
+            self.assertEqual(('access-token', '42'), get_oauth_token(request))
+            self.assertEqual(self.canvas_user.pk, request.canvas_user.pk)
+
+    def test_missing_token(self, mock_lock):
+        request = self.get_request(user_id='43')
+        with self.assertRaises(MissingTokenError):
+            request.canvas_token.access_token
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_refresh_partway_through_request(self, mock_get_access_token, mock_lock):
+        request = self.get_request()
+        self.assertEqual('access-token', request.canvas_token.access_token)
+
+        # e.g. after Canvas rejected the token
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        CanvasOAuth2Token.objects.update(expires=timezone.now())
+        oauth_token = CanvasOAuth2Token.objects.select_related('user').get(pk=self.oauth_token.pk)
+        refresh_oauth_token(request, oauth_token)
+
+        self.assertEqual('new-access-token', request.canvas_token.access_token)
+
+    def test_token_past_expiration_buffer_is_looked_up_again(self, mock_lock):
+        request = self.get_request()
+        self.assertEqual('access-token', request.canvas_token.access_token)
+        request._canvas_oauth_tokens['canvas.localhost'] = request._canvas_oauth_tokens[
+            'canvas.localhost']._replace(access_token='stale-token', expires=timezone.now())
+        with self.assertNumQueries(1):
+            self.assertEqual('access-token', request.canvas_token.access_token)
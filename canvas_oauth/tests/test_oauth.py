@@ -1,11 +1,16 @@
+import json
 import logging
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.utils import timezone
 from django.urls import reverse
 from django.http import HttpResponseRedirect
 from datetime import datetime, timedelta
 from unittest.mock import MagicMock, PropertyMock, patch
+from urllib.parse import parse_qs, urlparse
 
 from canvas_oauth import settings
 from canvas_oauth.models import CanvasOAuth2Token
@@ -197,6 +202,82 @@ class TestHandleMissingToken(TestCase):
         self.assertEqual(redirect_uri, request.session["canvas_oauth_redirect_uri"])
 
 
+class TestCoalescedAuthorizations(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.session = CacheSessionStore()
+        self.session.create()
+
+    def get_request(self, path='/index', **headers):
+        request = RequestFactory().get(path, **headers)
+        request.user = AnonymousUser()
+        # Concurrent requests of a session load it separately
+        request.session = CacheSessionStore(self.session.session_key)
+        return request
+
+    def get_state(self, response):
+        return parse_qs(urlparse(response.url).query)['state'][0]
+
+    def test_concurrent_requests_share_state(self):
+        first, second = self.get_request('/a'), self.get_request('/b')
+        state = self.get_state(handle_missing_token(first))
+        self.assertEqual(state, self.get_state(handle_missing_token(second)))
+        self.assertEqual(state, second.session['canvas_oauth_request_state'])
+        self.assertEqual('/a', cache.get(f"oauth_state:{state}")['initial_uri'])
+
+    def test_later_request_reuses_session_state(self):
+        request = self.get_request()
+        state = self.get_state(handle_missing_token(request))
+        request.session.save()
+        cache.delete(f"canvas_oauth:pending:{settings.CANVAS_OAUTH_CANVAS_DOMAIN}:{request.session.session_key}")
+        self.assertEqual(state, self.get_state(handle_missing_token(self.get_request())))
+
+    @patch('canvas_oauth.oauth.time.time')
+    def test_expired_pending_authorization(self, mock_time):
+        mock_time.return_value = 1000.0
+        request = self.get_request()
+        state = self.get_state(handle_missing_token(request))
+        request.session.save()
+        cache.clear()
+        cache.set(f"oauth_state:{state}", {"canvas_domain": settings.CANVAS_OAUTH_CANVAS_DOMAIN})
+
+        mock_time.return_value = 1000.0 + settings.CANVAS_OAUTH_PENDING_AUTHORIZATION_TIMEOUT
+        self.assertNotEqual(state, self.get_state(handle_missing_token(self.get_request())))
+
+    @override_settings(CANVAS_OAUTH_PENDING_AUTHORIZATION_TIMEOUT=0)
+    def test_disabled(self):
+        first = self.get_state(handle_missing_token(self.get_request()))
+        self.assertNotEqual(first, self.get_state(handle_missing_token(self.get_request())))
+
+    def test_xhr_gets_pending_response(self):
+        response = handle_missing_token(self.get_request(HTTP_X_REQUESTED_WITH='XMLHttpRequest'))
+        self.assertEqual(401, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual('authorization_pending', data['error'])
+
+        response = handle_missing_token(self.get_request(HTTP_ACCEPT='application/json'))
+        self.assertEqual(data['authorize_url'], json.loads(response.content)['authorize_url'])
+        response = handle_missing_token(self.get_request(HTTP_ACCEPT='text/html,application/json'))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(data['authorize_url'], response.url)
+
+    @patch('canvas_oauth.oauth.settings.get_profile_updater')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_callback_ends_pending_authorization(self, mock_get_access_token, mock_get_profile_updater):
+        request = self.get_request()
+        state = self.get_state(handle_missing_token(request))
+        request.session.save()
+
+        mock_get_access_token.return_value = (
+            'access-token', timezone.now() + timedelta(hours=1), 'refresh-token', {'id': 42, 'name': 'Jane'})
+        callback_request = self.get_request('/oauth/oauth-callback', data={'code': 'code', 'state': state})
+        oauth_callback(callback_request)
+        callback_request.session.save()
+
+        self.assertNotEqual(state, self.get_state(handle_missing_token(self.get_request())))
+
+
 class TestGetOauthToken(TestCase):
 
     def get_mock_request_with_token(self, expired=False, **kwargs):
@@ -0,0 +1,145 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.conf import settings
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth.canvas import get_access_token
+from canvas_oauth.models import CanvasUser
+from canvas_oauth.oauth import oauth_callback
+from canvas_oauth.profile import InlineProfileUpdater, ThreadPoolProfileUpdater, get_profile_fields
+
+
+class TestTokenResponseUser(TestCase):
+
+    @patch('canvas_oauth.canvas.get_client')
+    def test_include_user(self, mock_get_client):
+        mock_post = mock_get_client.return_value.post
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {
+            "access_token": "access-token", "expires_in": 3600, "refresh_token": "refresh-token",
+            "user": {"id": 123, "name": "John Smith"}}
+
+        access_token, expires, refresh_token, user = get_access_token(
+            settings.CANVAS_OAUTH_CANVAS_DOMAIN, 'authorization_code', '/oauth/oauth-callback',
+            code='code', include_user=True)
+
+        self.assertEqual({"id": 123, "name": "John Smith"}, user)
+
+
+class TestProfileUpdaters(TestCase):
+
+    def get_updater(self, updater_class, **kwargs):
+        updater = updater_class(**kwargs)
+        updater.fetch_profile = MagicMock(side_effect=lambda access_token, domain, canvas_user_id: {
+            "id": access_token, "name": f"User {access_token}", "email": f"{access_token}@example.edu"})
+        return updater
+
+    @patch('canvas_oauth.profile.CanvasUser.objects')
+    def test_update_profiles_bulk_updates(self, mock_objects):
+        users = [MagicMock(canvas_user_id=user_id, canvas_domain='canvas.localhost') for user_id in '12']
+        mock_objects.filter.return_value = users
+        updater = self.get_updater(InlineProfileUpdater)
+
+        updater.update_profiles({('1', 'canvas.localhost'): '1', ('2', 'canvas.localhost'): '2'})
+
+        self.assertEqual(1, mock_objects.filter.call_count)
+        self.assertEqual('2@example.edu', users[1].email)
+        self.assertEqual("", users[1].avatar_url)
+        self.assertEqual(1, mock_objects.bulk_update.call_count)
+
+    @patch('canvas_oauth.profile.CanvasUser.objects')
+    def test_failed_fetch_is_skipped(self, mock_objects):
+        updater = self.get_updater(InlineProfileUpdater)
+        updater.fetch_profile.side_effect = requests.ConnectionError("down")
+
+        updater.schedule('1', 'token', 'canvas.localhost')
+
+        self.assertFalse(mock_objects.filter.called)
+        self.assertFalse(mock_objects.bulk_update.called)
+
+    def test_profiles_are_per_domain(self):
+        CanvasUser.objects.create(canvas_user_id='1', canvas_domain='canvas.localhost', name='One')
+        CanvasUser.objects.create(canvas_user_id='1', canvas_domain='canvas.test.localhost', name='Other one')
+        updater = self.get_updater(InlineProfileUpdater)
+
+        updater.schedule('1', 'token', 'canvas.test.localhost')
+
+        self.assertEqual('One', CanvasUser.objects.get(canvas_domain='canvas.localhost').name)
+        self.assertEqual('User token', CanvasUser.objects.get(canvas_domain='canvas.test.localhost').name)
+
+    def test_thread_pool_coalesces_pending_profiles(self):
+        updater = self.get_updater(ThreadPoolProfileUpdater, max_workers=1)
+        updater.executor = MagicMock()
+        updater.update_profiles = MagicMock()
+
+        updater.schedule('1', 'token-1', 'canvas.localhost')
+        updater.schedule('2', 'token-2', 'canvas.localhost')
+        self.assertEqual(1, updater.executor.submit.call_count)
+
+        updater.flush()
+        updater.update_profiles.assert_called_once_with({
+            ('1', 'canvas.localhost'): 'token-1', ('2', 'canvas.localhost'): 'token-2'})
+
+    def test_get_profile_fields(self):
+        self.assertEqual(
+            {'name': 'Jane', 'sortable_name': '', 'short_name': '', 'email': '', 'avatar_url': ''},
+            get_profile_fields({'id': 7, 'name': 'Jane', 'email': None}))
+
+
+class TestDeferredProfileCallback(TestCase):
+
+    @patch('canvas_oauth.oauth.settings.get_profile_updater')
+    @patch('canvas_oauth.oauth.get_user_data')
+    @patch('canvas_oauth.oauth.invalidate_token')
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects')
+    @patch('canvas_oauth.oauth.CanvasUser.objects')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    @patch('canvas_oauth.oauth.cache')
+    def test_callback_uses_token_response_user(self, mock_cache, mock_get_access_token, mock_users, mock_tokens,
+                                               mock_invalidate, mock_get_user_data, mock_get_profile_updater):
+        mock_cache.get.return_value = {'redirect_uri': '/oauth/oauth-callback', 'initial_uri': '/index'}
+        mock_get_access_token.return_value = (
+            'access-token', timezone.now() + timedelta(hours=1), 'refresh-token', {'id': 7, 'name': 'Jane'})
+        mock_users.get_or_create.return_value = (MagicMock(canvas_user_id='7'), True)
+        mock_tokens.update_or_create.return_value = (MagicMock(pk=1), True)
+
+        request = RequestFactory().get('/oauth/oauth-callback', {'code': 'code', 'state': 'state'})
+        request.session = MagicMock()
+        request.session.has_key.return_value = False
+        response = oauth_callback(request)
+
+        self.assertEqual(302, response.status_code)
+        self.assertFalse(mock_get_user_data.called)
+        self.assertEqual('Jane', mock_users.get_or_create.call_args.kwargs['defaults']['name'])
+        mock_get_profile_updater.return_value.schedule.assert_called_once_with(
+            '7', 'access-token', settings.CANVAS_OAUTH_CANVAS_DOMAIN)
+
+    @patch('canvas_oauth.oauth.settings.get_profile_updater')
+    @patch('canvas_oauth.oauth.get_user_data')
+    @patch('canvas_oauth.oauth.invalidate_token')
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects')
+    @patch('canvas_oauth.oauth.CanvasUser.objects')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    @patch('canvas_oauth.oauth.cache')
+    def test_callback_saves_fetched_profile(self, mock_cache, mock_get_access_token, mock_users, mock_tokens,
+                                            mock_invalidate, mock_get_user_data, mock_get_profile_updater):
+        mock_cache.get.return_value = {'redirect_uri': '/oauth/oauth-callback', 'initial_uri': '/index'}
+        mock_get_access_token.return_value = (
+            'access-token', timezone.now() + timedelta(hours=1), 'refresh-token', None)
+        mock_get_user_data.return_value = {'id': 7, 'name': 'Jane Doe', 'email': 'jane@example.edu'}
+        mock_users.update_or_create.return_value = (MagicMock(canvas_user_id='7'), False)
+        mock_tokens.update_or_create.return_value = (MagicMock(pk=1), True)
+
+        request = RequestFactory().get('/oauth/oauth-callback', {'code': 'code', 'state': 'state'})
+        request.session = MagicMock()
+        request.session.has_key.return_value = False
+        response = oauth_callback(request)
+
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, mock_get_user_data.call_count)
+        self.assertEqual('jane@example.edu', mock_users.update_or_create.call_args.kwargs['defaults']['email'])
+        self.assertFalse(mock_get_profile_updater.return_value.schedule.called)
@@ -0,0 +1,92 @@
+"""
+Query budgets for the token lookup, refresh and callback paths.  A change
+that adds queries to any of them should fail here.
+"""
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.locks import CacheLock
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.oauth import get_oauth_token, oauth_callback, refresh_oauth_token
+from canvas_oauth.profile import InlineProfileUpdater
+from canvas_oauth.stores import ModelTokenStore
+
+DOMAIN = 'canvas.localhost'
+
+
+@override_settings(CANVAS_OAUTH_CLIENT_ID=101, CANVAS_OAUTH_CLIENT_SECRET='fake-secret',
+                   CANVAS_OAUTH_CANVAS_DOMAIN=DOMAIN)
+@patch.object(oauth_settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', DOMAIN)
+@patch('canvas_oauth.oauth.settings.get_refresh_lock', return_value=CacheLock(wait=0))
+class TestQueryBudgets(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.canvas_user = CanvasUser.objects.create(canvas_user_id='42', canvas_domain=DOMAIN, name='Jane')
+        self.oauth_token = CanvasOAuth2Token.objects.create(
+            user=self.canvas_user, canvas_domain=DOMAIN, access_token='access-token',
+            refresh_token='refresh-token', expires=timezone.now() + timedelta(hours=1))
+
+    def get_request(self, path='/index', **params):
+        request = RequestFactory().get(path, params)
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request.session['user_id'] = '42'
+        return request
+
+    def test_get_oauth_token(self, mock_lock):
+        with self.assertNumQueries(1):
+            self.assertEqual(('access-token', '42'), get_oauth_token(self.get_request()))
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_get_oauth_token_with_refresh(self, mock_get_access_token, mock_lock):
+        CanvasOAuth2Token.objects.update(expires=timezone.now() - timedelta(minutes=1))
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        # Token lookup, reload under the refresh lock and compare-and-swap update
+        with self.assertNumQueries(3):
+            self.assertEqual(('new-access-token', '42'), get_oauth_token(self.get_request()))
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_refresh_oauth_token(self, mock_get_access_token, mock_lock):
+        oauth_token = CanvasOAuth2Token.objects.select_related('user').get(pk=self.oauth_token.pk)
+        oauth_token.expires = timezone.now()
+        CanvasOAuth2Token.objects.update(expires=oauth_token.expires)
+        mock_get_access_token.return_value = ('new-access-token', timezone.now() + timedelta(hours=1), None)
+        with self.assertNumQueries(2):
+            refresh_oauth_token(self.get_request(), oauth_token)
+
+    def test_reload_includes_user(self, mock_lock):
+        with self.assertNumQueries(1):
+            self.assertEqual('42', ModelTokenStore().reload(self.oauth_token).user.canvas_user_id)
+
+    @patch('canvas_oauth.oauth.settings.get_profile_updater')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_oauth_callback(self, mock_get_access_token, mock_get_profile_updater, mock_lock):
+        mock_get_access_token.return_value = (
+            'new-access-token', timezone.now() + timedelta(hours=1), 'new-refresh-token', {'id': 42, 'name': 'Jane'})
+        cache.set('oauth_state:state', {'redirect_uri': '/oauth/oauth-callback', 'initial_uri': '/index'})
+        request = self.get_request('/oauth/oauth-callback', code='code', state='state')
+
+        # get_or_create of the user and update_or_create of the token (a
+        # locking select and an update inside a transaction); the default
+        # ThreadPoolProfileUpdater fetches the profile after the redirect
+        with self.assertNumQueries(5):
+            self.assertEqual(302, oauth_callback(request).status_code)
+        self.assertEqual('new-access-token', CanvasOAuth2Token.objects.get(pk=self.oauth_token.pk).access_token)
+        self.assertTrue(mock_get_profile_updater.return_value.schedule.called)
+
+    @patch('canvas_oauth.profile.get_client')
+    def test_inline_profile_update(self, mock_get_client, mock_lock):
+        mock_get_client.return_value.get_json.return_value = {'id': 42, 'name': 'Jane Doe'}
+        # Select and bulk update of the profile
+        with self.assertNumQueries(2):
+            InlineProfileUpdater().schedule('42', 'access-token', DOMAIN)
+        self.assertEqual('Jane Doe', CanvasUser.objects.get(pk=self.canvas_user.pk).name)
@@ -0,0 +1,132 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from django.test import TestCase
+
+from canvas_oauth.client import CanvasClient
+from canvas_oauth.deadline import deadline
+from canvas_oauth.exceptions import DeadlineExceededError
+from canvas_oauth.ratelimit import RateLimitScheduler
+
+
+def get_response(status_code=200, remaining=None, cost=None, text=''):
+    response = MagicMock()
+    response.status_code = status_code
+    response.text = text
+    response.headers = {}
+    if remaining is not None:
+        response.headers['X-Rate-Limit-Remaining'] = str(remaining)
+    if cost is not None:
+        response.headers['X-Request-Cost'] = str(cost)
+    return response
+
+
+class TestRateLimitScheduler(TestCase):
+
+    def setUp(self):
+        self.scheduler = RateLimitScheduler(max_concurrency=8, low_watermark=100, high_watermark=300)
+
+    def get_state(self):
+        return self.scheduler._get_state('canvas.localhost', 'token-123')
+
+    def test_throttle_halves_concurrency(self):
+        self.scheduler.record('canvas.localhost', 'token-123',
+                              get_response(403, remaining=0, text='403 Forbidden (Rate Limit Exceeded)'))
+        self.assertEqual(4, self.get_state().concurrency)
+        self.assertEqual(1, self.scheduler.get_metrics()['throttle_events'])
+
+    def test_concurrency_recovers_with_quota(self):
+        self.get_state().concurrency = 2
+        self.scheduler.record('canvas.localhost', 'token-123', get_response(remaining=650, cost=1.5))
+        self.assertEqual(3, self.get_state().concurrency)
+        self.assertEqual(650, self.get_state().remaining)
+        self.assertEqual(1.5, self.get_state().cost)
+
+    def test_low_quota_lowers_concurrency(self):
+        self.scheduler.record('canvas.localhost', 'token-123', get_response(remaining=50))
+        self.assertEqual(7, self.get_state().concurrency)
+
+    @patch('canvas_oauth.ratelimit.time.sleep')
+    def test_low_quota_paces_requests(self, mock_sleep):
+        self.scheduler.record('canvas.localhost', 'token-123', get_response(remaining=80))
+        with self.scheduler.slot('canvas.localhost', 'token-123'):
+            pass
+        mock_sleep.assert_called_with(2.0)
+        self.assertEqual(1, self.scheduler.get_metrics()['paced_requests'])
+
+    @patch('canvas_oauth.ratelimit.time.sleep', side_effect=KeyboardInterrupt)
+    def test_interrupted_pacing_releases_slot(self, mock_sleep):
+        self.scheduler.record('canvas.localhost', 'token-123', get_response(remaining=80))
+        with self.assertRaises(KeyboardInterrupt):
+            with self.scheduler.slot('canvas.localhost', 'token-123'):
+                pass
+        self.assertEqual(0, self.get_state().in_flight)
+
+    @patch('canvas_oauth.ratelimit.time.sleep')
+    def test_pacing_stops_at_deadline(self, mock_sleep):
+        self.scheduler.record('canvas.localhost', 'token-123', get_response(remaining=80))
+        with deadline(1):
+            with self.assertRaises(DeadlineExceededError):
+                with self.scheduler.slot('canvas.localhost', 'token-123'):
+                    pass
+        self.assertFalse(mock_sleep.called)
+        self.assertEqual(0, self.get_state().in_flight)
+
+    def test_waiting_for_slot_stops_at_deadline(self):
+        self.get_state().concurrency = 1
+        with self.scheduler.slot('canvas.localhost', 'token-123'):
+            started = time.monotonic()
+            with deadline(0.05):
+                with self.assertRaises(DeadlineExceededError):
+                    with self.scheduler.slot('canvas.localhost', 'token-123'):
+                        pass
+            self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(0, self.get_state().waiting)
+        self.assertEqual(0, self.get_state().in_flight)
+
+    def test_requests_queue_beyond_concurrency(self):
+        self.get_state().concurrency = 1
+        released = threading.Event()
+
+        def hold_slot():
+            with self.scheduler.slot('canvas.localhost', 'token-123'):
+                released.wait(5)
+
+        first = threading.Thread(target=hold_slot)
+        first.start()
+        while self.scheduler.get_metrics()['in_flight'] < 1:
+            time.sleep(0.01)
+        second = threading.Thread(target=hold_slot)
+        second.start()
+        while self.scheduler.get_metrics()['queue_depth'] < 1:
+            time.sleep(0.01)
+
+        self.assertEqual(1, self.scheduler.get_metrics()['in_flight'])
+        released.set()
+        first.join()
+        second.join()
+        self.assertEqual({'queue_depth': 0, 'in_flight': 0},
+                         {key: self.scheduler.get_metrics()[key] for key in ('queue_depth', 'in_flight')})
+
+    def test_tokens_are_tracked_separately(self):
+        self.scheduler.record('canvas.localhost', 'token-123', get_response(remaining=10))
+        other = self.scheduler._get_state('canvas.localhost', 'token-456')
+        self.assertIsNone(other.remaining)
+
+
+class TestClientRateLimit(TestCase):
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_client_records_responses(self, mock_request):
+        mock_request.return_value = get_response(remaining=650)
+        scheduler = RateLimitScheduler()
+        client = CanvasClient(rate_limiter=scheduler)
+        client.get('canvas.localhost', '/api/v1/users/self', access_token='token-123')
+        self.assertEqual(650, scheduler._get_state('canvas.localhost', 'token-123').remaining)
+
+    @patch('canvas_oauth.client.requests.Session.request')
+    def test_requests_without_token_are_not_scheduled(self, mock_request):
+        scheduler = MagicMock()
+        CanvasClient(rate_limiter=scheduler).post('canvas.localhost', '/login/oauth2/token', data={})
+        self.assertFalse(scheduler.slot.called)
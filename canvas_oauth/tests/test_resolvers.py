@@ -0,0 +1,73 @@
+from unittest.mock import patch
+
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from canvas_oauth.resolvers import LtiBasedResolver, SingleEnvironmentResolver
+from canvas_oauth.settings import get_environment_resolver
+
+
+def get_lti_data(deployment_id='1:abc', api_domain='canvas.school.edu'):
+    return {
+        'iss': 'https://canvas.instructure.com',
+        'https://purl.imsglobal.org/spec/lti/claim/deployment_id': deployment_id,
+        'https://purl.imsglobal.org/spec/lti/claim/custom': {'api_domain': api_domain},
+    }
+
+
+class TestLtiBasedResolver(TestCase):
+
+    def get_request(self):
+        request = RequestFactory().get('/launch')
+        request.session = SessionStore()
+        return request
+
+    def test_resolve_domain_from_lti_data(self):
+        request = self.get_request()
+        domain = LtiBasedResolver().resolve_domain(request, lti_data=get_lti_data())
+        self.assertEqual('canvas.school.edu', domain)
+        self.assertEqual('canvas.school.edu', request.session['canvas_domain'])
+
+    def test_unchanged_domain_does_not_modify_session(self):
+        request = self.get_request()
+        request.session['canvas_domain'] = 'canvas.school.edu'
+        request.session.modified = False
+        LtiBasedResolver().resolve_domain(request, lti_data=get_lti_data())
+        self.assertFalse(request.session.modified)
+
+    def test_repeat_launch_uses_memo(self):
+        resolver = LtiBasedResolver()
+        resolver.resolve_domain(self.get_request(), lti_data=get_lti_data())
+        with patch.object(resolver, 'extract_domain_from_lti_data') as mock_extract:
+            domain = resolver.resolve_domain(self.get_request(), lti_data=get_lti_data())
+        self.assertEqual('canvas.school.edu', domain)
+        self.assertFalse(mock_extract.called)
+
+    def test_memo_is_bounded(self):
+        resolver = LtiBasedResolver()
+        resolver.memo_maxsize = 2
+        for deployment_id in ('1', '2', '3'):
+            resolver.get_domain_for_launch(get_lti_data(deployment_id=deployment_id))
+        self.assertEqual(2, len(resolver._domain_memo))
+
+    def test_launch_without_deployment_is_not_memoized(self):
+        resolver = LtiBasedResolver()
+        lti_data = get_lti_data()
+        del lti_data['https://purl.imsglobal.org/spec/lti/claim/deployment_id']
+        self.assertEqual('canvas.school.edu', resolver.get_domain_for_launch(lti_data))
+        self.assertEqual(0, len(resolver._domain_memo))
+
+
+class TestGetEnvironmentResolver(TestCase):
+
+    def test_resolver_is_cached(self):
+        resolver = get_environment_resolver()
+        self.assertIsInstance(resolver, SingleEnvironmentResolver)
+        self.assertIs(resolver, get_environment_resolver())
+
+    def test_resolver_follows_setting(self):
+        with self.settings(CANVAS_OAUTH_ENVIRONMENT_RESOLVER='canvas_oauth.resolvers.LtiBasedResolver'):
+            resolver = get_environment_resolver()
+            self.assertIsInstance(resolver, LtiBasedResolver)
+            self.assertIs(resolver, get_environment_resolver())
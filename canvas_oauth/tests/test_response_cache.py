@@ -0,0 +1,114 @@
+import json
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.client import CanvasClient
+from canvas_oauth.oauth import get_assignment
+from canvas_oauth.response_cache import CachedResponse, DjangoResponseCache, LocalResponseCache
+
+
+def get_response(status_code=200, data=None, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.content = json.dumps(data).encode() if data is not None else b''
+    response.json.side_effect = lambda: json.loads(response.content)
+    return response
+
+
+class TestLocalResponseCache(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        response_cache = LocalResponseCache(maxsize=2, max_bytes=1000)
+        response_cache.set('a', CachedResponse('"a"', None, b'1'))
+        response_cache.set('b', CachedResponse('"b"', None, b'2'))
+        response_cache.get('a')
+        response_cache.set('c', CachedResponse('"c"', None, b'3'))
+        self.assertIsNone(response_cache.get('b'))
+        self.assertIsNotNone(response_cache.get('a'))
+
+    def test_bounded_by_size(self):
+        response_cache = LocalResponseCache(maxsize=10, max_bytes=10)
+        response_cache.set('a', CachedResponse('"a"', None, b'x' * 6))
+        response_cache.set('b', CachedResponse('"b"', None, b'x' * 6))
+        self.assertIsNone(response_cache.get('a'))
+        self.assertEqual(6, response_cache.size)
+        response_cache.set('c', CachedResponse('"c"', None, b'x' * 11))
+        self.assertIsNone(response_cache.get('c'))
+
+
+class TestDjangoResponseCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_round_trip(self):
+        response_cache = DjangoResponseCache()
+        response_cache.set('a', CachedResponse('"a"', 'Mon, 01 Jan 2024 00:00:00 GMT', b'{}'))
+        self.assertEqual(CachedResponse('"a"', 'Mon, 01 Jan 2024 00:00:00 GMT', b'{}'), response_cache.get('a'))
+        response_cache.delete('a')
+        self.assertIsNone(response_cache.get('a'))
+
+
+@override_settings(CANVAS_OAUTH_RESPONSE_CACHE_BACKEND='canvas_oauth.response_cache.LocalResponseCache')
+@patch.object(oauth_settings, 'CANVAS_OAUTH_RESPONSE_CACHE_ENABLED', True)
+@patch('canvas_oauth.client.requests.Session.request')
+class TestConditionalRequests(TestCase):
+
+    def setUp(self):
+        oauth_settings.get_response_cache_backend().clear()
+        self.canvas_client = CanvasClient(rate_limiter=MagicMock())
+
+    def test_revalidates_with_etag(self, mock_request):
+        mock_request.side_effect = [
+            get_response(data={'id': 1}, headers={'ETag': '"v1"'}),
+            get_response(status_code=304),
+        ]
+        self.assertEqual({'id': 1}, self.canvas_client.get_json('canvas.localhost', '/api/v1/users/self', 'token-123'))
+        self.assertEqual({'id': 1}, self.canvas_client.get_json('canvas.localhost', '/api/v1/users/self', 'token-123'))
+        self.assertEqual('"v1"', mock_request.call_args.kwargs['headers']['If-None-Match'])
+
+    def test_changed_resource_replaces_entry(self, mock_request):
+        mock_request.side_effect = [
+            get_response(data={'id': 1}, headers={'ETag': '"v1"'}),
+            get_response(data={'id': 2}, headers={'ETag': '"v2"'}),
+            get_response(status_code=304),
+        ]
+        for expected in ({'id': 1}, {'id': 2}, {'id': 2}):
+            data = self.canvas_client.get_json('canvas.localhost', '/api/v1/users/self', 'token-123')
+            self.assertEqual(expected, data)
+        self.assertEqual('"v2"', mock_request.call_args.kwargs['headers']['If-None-Match'])
+
+    def test_entries_are_per_owner(self, mock_request):
+        mock_request.return_value = get_response(data={'id': 1}, headers={'ETag': '"v1"'})
+        self.canvas_client.get_json('canvas.localhost', '/api/v1/users/self', 'token-123')
+        self.canvas_client.get_json('canvas.localhost', '/api/v1/users/self', 'token-456')
+        self.assertNotIn('If-None-Match', mock_request.call_args.kwargs['headers'])
+
+    def test_user_owner_survives_token_refresh(self, mock_request):
+        mock_request.side_effect = [
+            get_response(data={'id': 1}, headers={'ETag': '"v1"'}),
+            get_response(status_code=304),
+        ]
+        with patch('canvas_oauth.oauth.get_client', return_value=self.canvas_client):
+            for access_token in ('token-123', 'refreshed-token'):
+                data = get_assignment(1, 2, access_token, domain='canvas.localhost', user_id=42)
+                self.assertEqual({'id': 1}, data)
+        self.assertEqual('"v1"', mock_request.call_args.kwargs['headers']['If-None-Match'])
+
+    def test_invalidate(self, mock_request):
+        mock_request.return_value = get_response(data={'id': 1}, headers={'ETag': '"v1"'})
+        self.canvas_client.get_json('canvas.localhost', '/api/v1/courses/1', 'token-123', owner=7)
+        self.canvas_client.invalidate('canvas.localhost', '/api/v1/courses/1', owner=7)
+        self.canvas_client.get_json('canvas.localhost', '/api/v1/courses/1', 'token-123', owner=7)
+        self.assertNotIn('If-None-Match', mock_request.call_args.kwargs['headers'])
+
+    def test_no_store_is_not_cached(self, mock_request):
+        mock_request.return_value = get_response(
+            data={'id': 1}, headers={'ETag': '"v1"', 'Cache-Control': 'private, no-store'})
+        self.canvas_client.get_json('canvas.localhost', '/api/v1/users/self', 'token-123')
+        self.canvas_client.get_json('canvas.localhost', '/api/v1/users/self', 'token-123')
+        self.assertNotIn('If-None-Match', mock_request.call_args.kwargs['headers'])
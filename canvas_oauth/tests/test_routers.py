@@ -0,0 +1,88 @@
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from canvas_oauth import routers
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.oauth import _get_stored_token
+
+DOMAIN = 'canvas.localhost'
+
+
+class TestCanvasOAuthRouter(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.router = routers.CanvasOAuthRouter()
+
+    def test_single_database(self):
+        self.assertEqual('default', self.router.db_for_read(CanvasOAuth2Token))
+        self.assertEqual('default', self.router.db_for_write(CanvasOAuth2Token))
+        self.assertTrue(self.router.allow_migrate('default', 'canvas_oauth'))
+
+    @override_settings(CANVAS_OAUTH_DATABASE='tokens', CANVAS_OAUTH_READ_DATABASES=['replica'])
+    def test_read_and_write_databases(self):
+        self.assertEqual('replica', self.router.db_for_read(CanvasUser))
+        self.assertEqual('tokens', self.router.db_for_write(CanvasUser))
+        self.assertTrue(self.router.allow_migrate('tokens', 'canvas_oauth', 'canvasuser'))
+        self.assertFalse(self.router.allow_migrate('replica', 'canvas_oauth', 'canvasuser'))
+        self.assertFalse(self.router.allow_migrate('default', 'canvas_oauth', 'canvasuser'))
+
+    @override_settings(CANVAS_OAUTH_DATABASE='tokens', CANVAS_OAUTH_READ_DATABASES=['replica'])
+    def test_other_apps(self):
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_write(User))
+        self.assertIsNone(self.router.allow_migrate('tokens', 'auth', 'user'))
+        self.assertIsNone(self.router.allow_relation(User(), CanvasUser()))
+        self.assertTrue(self.router.allow_relation(CanvasOAuth2Token(), CanvasUser()))
+
+    @override_settings(CANVAS_OAUTH_READ_DATABASES=['replica'])
+    def test_use_primary(self):
+        with routers.use_primary():
+            self.assertEqual('default', self.router.db_for_read(CanvasOAuth2Token))
+        with routers.use_primary(False):
+            self.assertEqual('replica', self.router.db_for_read(CanvasOAuth2Token))
+        self.assertEqual('replica', self.router.db_for_read(CanvasOAuth2Token))
+
+
+@override_settings(CANVAS_OAUTH_READ_DATABASES=['replica'], CANVAS_OAUTH_DATABASE_STICKY_SECONDS=10)
+class TestStickiness(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.router = routers.CanvasOAuthRouter()
+        # Writes made by one test must not pin the context of the next
+        token = routers._primary_until.set(0.0)
+        self.addCleanup(routers._primary_until.reset, token)
+
+    def test_stick(self):
+        self.assertFalse(routers.is_sticky('42', DOMAIN))
+        routers.stick('42', DOMAIN)
+        self.assertTrue(routers.is_sticky('42', DOMAIN))
+        self.assertFalse(routers.is_sticky('43', DOMAIN))
+        self.assertFalse(routers.is_sticky('42', 'other.localhost'))
+        # Reads in the writing context go to the write database
+        self.assertEqual('default', self.router.db_for_read(CanvasOAuth2Token))
+
+    def test_stick_expires(self):
+        with patch('canvas_oauth.routers.time.monotonic', return_value=100.0):
+            routers.stick('42', DOMAIN)
+        with patch('canvas_oauth.routers.time.monotonic', return_value=111.0):
+            self.assertEqual('replica', self.router.db_for_read(CanvasOAuth2Token))
+
+    @override_settings(CANVAS_OAUTH_READ_DATABASES=[])
+    def test_no_read_databases(self):
+        routers.stick('42', DOMAIN)
+        self.assertFalse(routers.is_sticky('42', DOMAIN))
+        self.assertEqual(0.0, routers._primary_until.get())
+
+    def test_stored_token_lookup(self):
+        routers.stick('42', DOMAIN)
+        routers._primary_until.set(0.0)
+        with patch('canvas_oauth.stores._get_stored_tokens') as mock_get_stored_tokens:
+            mock_get_stored_tokens.return_value.get.side_effect = (
+                lambda **kwargs: self.router.db_for_read(CanvasOAuth2Token))
+            self.assertEqual('default', _get_stored_token('42', DOMAIN))
+            self.assertEqual('replica', _get_stored_token('43', DOMAIN))
@@ -9,23 +9,50 @@ import datetime
 CANVAS_OAUTH_SETTINGS_MODULE_NAME = "canvas_oauth.settings"
 
 
+REQUIRED_SETTINGS = ('CANVAS_OAUTH_CLIENT_ID', 'CANVAS_OAUTH_CLIENT_SECRET', 'CANVAS_OAUTH_CANVAS_DOMAIN')
+
+
+@contextmanager
+def restored_oauth_settings():
+    """Restores the required settings, and drops any value read meanwhile."""
+    previous = {name: getattr(settings, name) for name in REQUIRED_SETTINGS if hasattr(settings, name)}
+    try:
+        yield
+    finally:
+        for name in REQUIRED_SETTINGS:
+            if hasattr(settings, name):
+                delattr(settings, name)
+            if name in previous:
+                setattr(settings, name, previous[name])
+            importlib.import_module(CANVAS_OAUTH_SETTINGS_MODULE_NAME).reset_caches(name)
+
+
 @contextmanager
 def required_oauth_settings(oauth_settings={}):
-    settings.CANVAS_OAUTH_CLIENT_ID = oauth_settings.get('CANVAS_OAUTH_CLIENT_ID', '10000000000012')
-    settings.CANVAS_OAUTH_CLIENT_SECRET = oauth_settings.get('CANVAS_OAUTH_CLIENT_SECRET', 'yKZc1bJpdykVBUT4')
-    settings.CANVAS_OAUTH_CANVAS_DOMAIN = oauth_settings.get('CANVAS_OAUTH_CANVAS_DOMAIN', 'canvas.localhost')
-    yield
-    delattr(settings, 'CANVAS_OAUTH_CLIENT_ID')
-    delattr(settings, 'CANVAS_OAUTH_CLIENT_SECRET')
-    delattr(settings, 'CANVAS_OAUTH_CANVAS_DOMAIN')
+    with restored_oauth_settings():
+        settings.CANVAS_OAUTH_CLIENT_ID = oauth_settings.get('CANVAS_OAUTH_CLIENT_ID', '10000000000012')
+        settings.CANVAS_OAUTH_CLIENT_SECRET = oauth_settings.get('CANVAS_OAUTH_CLIENT_SECRET', 'yKZc1bJpdykVBUT4')
+        settings.CANVAS_OAUTH_CANVAS_DOMAIN = oauth_settings.get('CANVAS_OAUTH_CANVAS_DOMAIN', 'canvas.localhost')
+        yield
+
+
+@contextmanager
+def missing_oauth_settings():
+    with restored_oauth_settings():
+        for name in REQUIRED_SETTINGS:
+            if hasattr(settings, name):
+                delattr(settings, name)
+        yield
 
 
 class TestCanvasOauthSettings(TestCase):
 
     def test_required_settings_raises_exception(self):
-        with self.assertRaises(ImproperlyConfigured):
+        with missing_oauth_settings():
             canvas_oauth_settings = importlib.import_module(CANVAS_OAUTH_SETTINGS_MODULE_NAME)
             canvas_oauth_settings = importlib.reload(canvas_oauth_settings)
+            with self.assertRaises(ImproperlyConfigured):
+                canvas_oauth_settings.CANVAS_OAUTH_CLIENT_ID
 
     def test_settings_are_present(self):
         with required_oauth_settings():
@@ -58,3 +85,80 @@ class TestCanvasOauthSettings(TestCase):
             canvas_oauth_settings = importlib.reload(canvas_oauth_settings)
             self.assertTrue(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_SCOPES'))
             self.assertEqual([], canvas_oauth_settings.CANVAS_OAUTH_SCOPES)
+
+
+class TestCanvasCredentialsIndex(TestCase):
+
+    ENVIRONMENTS = {
+        'production': {
+            'client_id': 'prod-client-id',
+            'client_secret': 'prod-secret',
+            'canvas_domain': 'canvas.school.edu',
+        },
+        'test': {
+            'client_id': 'test-client-id',
+            'client_secret': 'test-secret',
+            'domain': 'canvas.test.school.edu',
+        },
+    }
+
+    def test_default_domain_is_indexed(self):
+        from canvas_oauth.settings import get_canvas_credentials, get_credentials_index
+        self.assertIn(settings.CANVAS_OAUTH_CANVAS_DOMAIN, get_credentials_index())
+        self.assertEqual(
+            (settings.CANVAS_OAUTH_CLIENT_ID, settings.CANVAS_OAUTH_CLIENT_SECRET,
+             f"https://{settings.CANVAS_OAUTH_CANVAS_DOMAIN}"),
+            get_canvas_credentials(settings.CANVAS_OAUTH_CANVAS_DOMAIN))
+
+    def test_index_is_rebuilt_when_settings_change(self):
+        from canvas_oauth.settings import get_canvas_credentials, get_credentials_index
+        with self.settings(CANVAS_OAUTH_ENVIRONMENTS=self.ENVIRONMENTS):
+            self.assertEqual(('prod-client-id', 'prod-secret', 'https://canvas.school.edu'),
+                             get_canvas_credentials('canvas.school.edu'))
+            self.assertEqual(('test-client-id', 'test-secret', 'https://canvas.test.school.edu'),
+                             get_canvas_credentials('canvas.test.school.edu'))
+        self.assertNotIn('canvas.school.edu', get_credentials_index())
+
+    def test_index_is_immutable(self):
+        from canvas_oauth.settings import get_credentials_index
+        with self.assertRaises(TypeError):
+            get_credentials_index()['canvas.example.edu'] = ('id', 'secret', 'https://canvas.example.edu')
+
+    def test_domain_specific_settings(self):
+        from canvas_oauth.settings import get_canvas_credentials
+        with self.settings(CANVAS_OAUTH_CANVAS_OTHER_EDU_CLIENT_ID='other-id',
+                           CANVAS_OAUTH_CANVAS_OTHER_EDU_CLIENT_SECRET='other-secret'):
+            self.assertEqual(('other-id', 'other-secret', 'https://canvas.other.edu'),
+                             get_canvas_credentials('canvas.other.edu'))
+
+    def test_unknown_domain_without_default_credentials(self):
+        from canvas_oauth.settings import get_canvas_credentials
+        with self.settings(CANVAS_OAUTH_CLIENT_ID='', CANVAS_OAUTH_CLIENT_SECRET=''):
+            with self.assertRaises(ImproperlyConfigured):
+                get_canvas_credentials('canvas.unknown.edu')
+
+
+class TestLazySettings(TestCase):
+
+    def test_settings_are_cached_on_first_access(self):
+        from canvas_oauth import settings as canvas_oauth_settings
+        canvas_oauth_settings.reset_caches('CANVAS_OAUTH_STATE_MAX_AGE')
+        self.assertNotIn('CANVAS_OAUTH_STATE_MAX_AGE', vars(canvas_oauth_settings))
+        self.assertEqual(600, canvas_oauth_settings.CANVAS_OAUTH_STATE_MAX_AGE)
+        self.assertEqual(600, vars(canvas_oauth_settings)['CANVAS_OAUTH_STATE_MAX_AGE'])
+
+    def test_changed_settings_are_read_again(self):
+        from canvas_oauth import settings as canvas_oauth_settings
+        with self.settings(CANVAS_OAUTH_STATE_MAX_AGE=60):
+            self.assertEqual(60, canvas_oauth_settings.CANVAS_OAUTH_STATE_MAX_AGE)
+        self.assertEqual(600, canvas_oauth_settings.CANVAS_OAUTH_STATE_MAX_AGE)
+
+    def test_unknown_setting(self):
+        from canvas_oauth import settings as canvas_oauth_settings
+        self.assertFalse(hasattr(canvas_oauth_settings, 'CANVAS_OAUTH_UNKNOWN'))
+
+    def test_required_settings_are_optional_with_environments(self):
+        from canvas_oauth import settings as canvas_oauth_settings
+        with self.settings(CANVAS_OAUTH_ENVIRONMENTS={'production': {}}):
+            self.assertEqual(getattr(settings, 'CANVAS_OAUTH_CLIENT_ID', None),
+                             canvas_oauth_settings.CANVAS_OAUTH_CLIENT_ID)
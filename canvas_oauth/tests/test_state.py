@@ -0,0 +1,118 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs, urlparse
+
+from django.core import signing
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.oauth import handle_missing_token, oauth_callback
+from canvas_oauth.state import COOKIE_NAME, SALT, load_state, make_state
+
+
+class TestSignedState(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_round_trip(self):
+        state = make_state('https://tool.localhost/oauth/oauth-callback', '/index?x=1', user_id='7', course_id='42',
+                           canvas_domain='canvas.test.localhost')
+        self.assertEqual({
+            'redirect_uri': 'https://tool.localhost/oauth/oauth-callback',
+            'initial_uri': '/index?x=1',
+            'user_id': '7',
+            'course_id': '42',
+            'canvas_domain': 'canvas.test.localhost',
+        }, load_state(state))
+
+    def test_state_is_single_use(self):
+        state = make_state('https://tool.localhost/oauth/oauth-callback', '/index')
+        self.assertIsNotNone(load_state(state))
+        self.assertIsNone(load_state(state))
+
+    def test_tampered_state(self):
+        payload = signing.loads(make_state('https://tool.localhost/oauth/oauth-callback', '/index'), salt=SALT)
+        payload['i'] = 'https://evil.localhost/'
+        self.assertIsNone(load_state(signing.dumps(payload, salt='other', compress=True)))
+        self.assertIsNone(load_state('not-a-state'))
+        self.assertIsNone(load_state(None))
+
+    @patch.object(oauth_settings, 'CANVAS_OAUTH_STATE_MAX_AGE', -1)
+    def test_expired_state(self):
+        self.assertIsNone(load_state(make_state('https://tool.localhost/oauth/oauth-callback', '/index')))
+
+    def test_bound_state(self):
+        state = make_state('https://tool.localhost/oauth/oauth-callback', '/index', binding='browser')
+        self.assertIsNone(load_state(state))
+        self.assertIsNone(load_state(state, 'other-browser'))
+        self.assertEqual('/index', load_state(state, 'browser')['initial_uri'])
+
+
+@override_settings(CANVAS_OAUTH_CLIENT_ID=101, CANVAS_OAUTH_CLIENT_SECRET='fake-secret',
+                   CANVAS_OAUTH_CANVAS_DOMAIN='canvas.localhost')
+@patch.object(oauth_settings, 'CANVAS_OAUTH_STATELESS_STATE', True)
+class TestStatelessOauthFlow(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    @patch('canvas_oauth.oauth.cache')
+    def test_handle_missing_token_has_no_session_or_cache_writes(self, mock_cache):
+        request = self.factory.post('/index', {'user_id': '7', 'custom_canvas_course_id': '42'})
+        request.session = MagicMock()
+
+        response = handle_missing_token(request)
+
+        self.assertFalse(request.session.__setitem__.called)
+        self.assertFalse(mock_cache.set.called)
+        state = parse_qs(urlparse(response.url).query)['state'][0]
+        self.assertIsNone(load_state(state))
+        state_data = load_state(state, response.cookies[COOKIE_NAME].value)
+        self.assertEqual(('/index', '7', '42'),
+                         (state_data['initial_uri'], state_data['user_id'], state_data['course_id']))
+
+    @patch('canvas_oauth.oauth.settings.get_profile_updater')
+    @patch('canvas_oauth.oauth.invalidate_token')
+    @patch('canvas_oauth.oauth.CanvasOAuth2Token.objects')
+    @patch('canvas_oauth.oauth.CanvasUser.objects')
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    @patch('canvas_oauth.oauth.cache')
+    def test_callback_reads_signed_state(self, mock_cache, mock_get_access_token, mock_users, mock_tokens,
+                                         mock_invalidate, mock_get_profile_updater):
+        mock_get_access_token.return_value = (
+            'access-token', timezone.now() + timedelta(hours=1), 'refresh-token', {'id': 7, 'name': 'Jane'})
+        mock_users.get_or_create.return_value = (MagicMock(canvas_user_id=7), True)
+        mock_tokens.update_or_create.return_value = (MagicMock(pk=1), True)
+        state = make_state('https://tool.localhost/oauth/oauth-callback', '/index', course_id='42')
+
+        request = self.factory.get('/oauth/oauth-callback', {'code': 'code', 'state': state})
+        request.session = {}
+        response = oauth_callback(request)
+
+        self.assertFalse(mock_cache.get.called)
+        self.assertEqual('https://tool.localhost/oauth/oauth-callback',
+                         mock_get_access_token.call_args.kwargs['redirect_uri'])
+        self.assertEqual({'user_id': ['7'], 'custom_canvas_course_id': ['42']},
+                         parse_qs(urlparse(response.url).query))
+
+        # Replaying the callback is rejected
+        self.assertEqual(400, oauth_callback(request).status_code)
+
+    def test_state_is_bound_to_browser(self):
+        request = self.factory.get('/index')
+        request.COOKIES[COOKIE_NAME] = 'browser'
+        response = handle_missing_token(request)
+        self.assertEqual('browser', response.cookies[COOKIE_NAME].value)
+        self.assertTrue(response.cookies[COOKIE_NAME]['httponly'])
+
+        # An attacker's state replayed in another browser is rejected
+        state = parse_qs(urlparse(response.url).query)['state'][0]
+        request = self.factory.get('/oauth/oauth-callback', {'code': 'code', 'state': state})
+        request.session = {}
+        request.COOKIES[COOKIE_NAME] = 'victim'
+        self.assertEqual(400, oauth_callback(request).status_code)
@@ -0,0 +1,132 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import settings as oauth_settings
+from canvas_oauth.locks import CacheLock
+from canvas_oauth.models import CanvasOAuth2Token, CanvasUser
+from canvas_oauth.oauth import get_oauth_token
+from canvas_oauth.stores import CacheTokenStore, InMemoryTokenStore, ModelTokenStore
+
+DOMAIN = 'canvas.localhost'
+
+
+class TestInMemoryTokenStore(SimpleTestCase):
+
+    def setUp(self):
+        self.store = InMemoryTokenStore()
+        self.canvas_user = CanvasUser(canvas_user_id='42', canvas_domain=DOMAIN, name='Jane')
+        self.expires = timezone.now() + timedelta(hours=1)
+
+    def test_save_and_get(self):
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.store.get('42', DOMAIN)
+        saved = self.store.save(self.canvas_user, DOMAIN, 'access-token', 'refresh-token', self.expires)
+        oauth_token = self.store.get('42', DOMAIN)
+        self.assertEqual(saved.pk, oauth_token.pk)
+        self.assertEqual('access-token', oauth_token.access_token)
+        self.assertEqual('42', oauth_token.user.canvas_user_id)
+
+        # Saving again replaces the token
+        self.store.save(self.canvas_user, DOMAIN, 'access-token-2', 'refresh-token-2', self.expires)
+        self.assertEqual(saved.pk, self.store.get('42', DOMAIN).pk)
+        self.assertEqual('access-token-2', self.store.get('42', DOMAIN).access_token)
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.store.get('42', 'other.localhost')
+
+    def test_update_is_compare_and_swap(self):
+        self.store.save(self.canvas_user, DOMAIN, 'access-token', 'refresh-token', self.expires)
+        first, second = self.store.get('42', DOMAIN), self.store.get('42', DOMAIN)
+
+        self.assertTrue(self.store.update(first, 'new-token', self.expires, timezone.now()))
+        self.assertFalse(self.store.update(second, 'other-token', self.expires, timezone.now()))
+        self.assertEqual('new-token', self.store.reload(second).access_token)
+        # Tokens handed out are copies
+        self.assertEqual('access-token', first.access_token)
+
+
+class TestCacheTokenStore(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.store = CacheTokenStore(flush_interval=60)
+        self.canvas_user = CanvasUser.objects.create(canvas_user_id='42', canvas_domain=DOMAIN, name='Jane')
+        self.expires = timezone.now() + timedelta(hours=1)
+        self.oauth_token = CanvasOAuth2Token.objects.create(
+            user=self.canvas_user, canvas_domain=DOMAIN, access_token='access-token',
+            refresh_token='refresh-token', expires=self.expires)
+
+    def test_reads_through_to_the_database(self):
+        with self.assertNumQueries(1):
+            self.assertEqual('access-token', self.store.get('42', DOMAIN).access_token)
+        with self.assertNumQueries(0):
+            oauth_token = self.store.get('42', DOMAIN)
+            self.assertEqual('42', oauth_token.user.canvas_user_id)
+        with self.assertRaises(CanvasOAuth2Token.DoesNotExist):
+            self.store.get('43', DOMAIN)
+
+    @patch.object(CacheTokenStore, '_start_flusher')
+    def test_update_writes_behind(self, mock_start_flusher):
+        oauth_token = self.store.get('42', DOMAIN)
+        new_expires = timezone.now() + timedelta(hours=2)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.store.update(oauth_token, 'new-token', new_expires, timezone.now()))
+            self.assertEqual('new-token', self.store.get('42', DOMAIN).access_token)
+            # The cached token has moved on
+            self.assertFalse(self.store.update(oauth_token, 'other-token', new_expires, timezone.now()))
+        self.assertTrue(mock_start_flusher.called)
+        self.assertEqual('access-token', CanvasOAuth2Token.objects.get(pk=self.oauth_token.pk).access_token)
+
+        self.assertEqual(1, self.store.flush())
+        self.assertEqual('new-token', CanvasOAuth2Token.objects.get(pk=self.oauth_token.pk).access_token)
+        self.assertEqual(0, self.store.flush())
+
+    @patch.object(CacheTokenStore, '_start_flusher')
+    def test_save_replaces_queued_refresh(self, mock_start_flusher):
+        self.store.update(self.store.get('42', DOMAIN), 'new-token', self.expires, timezone.now())
+        self.store.save(self.canvas_user, DOMAIN, 'callback-token', 'refresh-token-2', self.expires)
+        self.assertEqual(0, self.store.flush())
+        self.assertEqual('callback-token', CanvasOAuth2Token.objects.get(pk=self.oauth_token.pk).access_token)
+        self.assertEqual('callback-token', self.store.get('42', DOMAIN).access_token)
+
+
+@override_settings(CANVAS_OAUTH_CLIENT_ID=101, CANVAS_OAUTH_CLIENT_SECRET='fake-secret',
+                   CANVAS_OAUTH_CANVAS_DOMAIN=DOMAIN,
+                   CANVAS_OAUTH_TOKEN_STORE='canvas_oauth.stores.InMemoryTokenStore')
+@patch.object(oauth_settings, 'CANVAS_OAUTH_CANVAS_DOMAIN', DOMAIN)
+@patch('canvas_oauth.oauth.settings.get_refresh_lock', return_value=CacheLock(wait=0))
+class TestGetOauthTokenStore(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.store = oauth_settings.get_token_store()
+        self.store.clear()
+
+    def get_request(self):
+        request = RequestFactory().get('/index')
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request.session['user_id'] = '42'
+        return request
+
+    def test_configured_store(self, mock_lock):
+        self.assertIsInstance(self.store, InMemoryTokenStore)
+        with override_settings(CANVAS_OAUTH_TOKEN_STORE='canvas_oauth.stores.ModelTokenStore'):
+            self.assertIsInstance(oauth_settings.get_token_store(), ModelTokenStore)
+
+    @patch('canvas_oauth.oauth.canvas.get_access_token')
+    def test_lookup_and_refresh(self, mock_get_access_token, mock_lock):
+        canvas_user = CanvasUser(canvas_user_id='42', canvas_domain=DOMAIN, name='Jane')
+        self.store.save(canvas_user, DOMAIN, 'access-token', 'refresh-token', timezone.now())
+        mock_get_access_token.return_value = ('new-token', timezone.now() + timedelta(hours=1), None)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(('new-token', '42'), get_oauth_token(self.get_request()))
+            self.assertEqual(('new-token', '42'), get_oauth_token(self.get_request()))
+        self.assertEqual(1, mock_get_access_token.call_count)
@@ -0,0 +1,118 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from canvas_oauth import settings
+from canvas_oauth.exceptions import MissingTokenError
+from canvas_oauth.models import CanvasOAuth2Token
+from canvas_oauth.oauth import get_oauth_token
+from canvas_oauth.token_cache import NO_TOKEN, LocalTokenCache, TokenCache
+
+
+class TestLocalTokenCache(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        local = LocalTokenCache(maxsize=2)
+        local.set('a', 1, 60)
+        local.set('b', 2, 60)
+        local.get('a')
+        local.set('c', 3, 60)
+        self.assertEqual(1, local.get('a'))
+        self.assertIsNone(local.get('b'))
+        self.assertEqual(3, local.get('c'))
+
+    @patch('canvas_oauth.token_cache.time.monotonic')
+    def test_expired_entries_are_dropped(self, mock_monotonic):
+        local = LocalTokenCache(maxsize=2)
+        mock_monotonic.return_value = 100
+        local.set('a', 1, 10)
+        mock_monotonic.return_value = 111
+        self.assertIsNone(local.get('a'))
+
+
+class TestTokenCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.token_cache = TokenCache()
+
+    def test_set_and_get(self):
+        expires = timezone.now() + timedelta(hours=1)
+        self.token_cache.set('42', 'canvas.localhost', 'access-token', expires)
+        cached = self.token_cache.get('42', 'canvas.localhost')
+        self.assertEqual('access-token', cached.access_token)
+        self.assertEqual(expires, cached.expires)
+
+    def test_shared_tier_refills_local_tier(self):
+        expires = timezone.now() + timedelta(hours=1)
+        self.token_cache.set('42', 'canvas.localhost', 'access-token', expires)
+        self.token_cache.local.clear()
+        self.assertEqual('access-token', self.token_cache.get('42', 'canvas.localhost').access_token)
+        key = self.token_cache.make_key('42', 'canvas.localhost')
+        self.assertIsNotNone(self.token_cache.local.get(key))
+
+    def test_token_inside_expiration_buffer_is_not_cached(self):
+        expires = timezone.now() + timedelta(minutes=2)
+        with patch.object(settings, 'CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER', timedelta(minutes=5)):
+            self.token_cache.set('42', 'canvas.localhost', 'access-token', expires)
+        self.assertIsNone(self.token_cache.get('42', 'canvas.localhost'))
+
+    def test_negative_entry(self):
+        self.token_cache.set_missing('42', 'canvas.localhost')
+        self.assertEqual(NO_TOKEN, self.token_cache.get('42', 'canvas.localhost'))
+        self.assertTrue(self.token_cache.get('42', 'canvas.localhost').missing)
+
+    def test_negative_entry_is_shared_between_processes(self):
+        # Two processes, sharing the Django cache
+        other_token_cache = TokenCache()
+        self.token_cache.set_missing('42', 'canvas.localhost')
+        self.assertEqual(NO_TOKEN, other_token_cache.get('42', 'canvas.localhost'))
+        self.assertEqual(NO_TOKEN, self.token_cache.get('42', 'canvas.localhost'))
+
+        # The OAuth callback runs in the other process
+        other_token_cache.invalidate('42', 'canvas.localhost')
+        self.assertIsNone(self.token_cache.get('42', 'canvas.localhost'))
+
+    def test_invalidate(self):
+        expires = timezone.now() + timedelta(hours=1)
+        self.token_cache.set('42', 'canvas.localhost', 'access-token', expires)
+        self.token_cache.invalidate('42', 'canvas.localhost')
+        self.assertIsNone(self.token_cache.get('42', 'canvas.localhost'))
+
+
+class TestGetOauthTokenCached(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.token_cache = TokenCache()
+        patcher = patch('canvas_oauth.oauth.get_token_cache', return_value=self.token_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_request(self):
+        request = RequestFactory().get('/index')
+        request.user = MagicMock()
+        request.session = SessionStore()
+        request.session['user_id'] = '42'
+        return request
+
+    @patch('canvas_oauth.oauth._get_stored_token')
+    def test_cache_hit_skips_database(self, mock_get):
+        expires = timezone.now() + timedelta(hours=1)
+        self.token_cache.set('42', settings.CANVAS_OAUTH_CANVAS_DOMAIN, 'cached-token', expires)
+        self.assertEqual(('cached-token', '42'), get_oauth_token(self.get_request()))
+        self.assertFalse(mock_get.called)
+
+    @patch('canvas_oauth.oauth._get_stored_token')
+    def test_missing_token_is_cached(self, mock_get):
+        mock_get.side_effect = CanvasOAuth2Token.DoesNotExist()
+        with self.assertRaises(MissingTokenError):
+            get_oauth_token(self.get_request())
+        with self.assertRaises(MissingTokenError):
+            get_oauth_token(self.get_request())
+        self.assertEqual(1, mock_get.call_count)
@@ -0,0 +1,213 @@
+"""
+Two-tier cache for stored Canvas OAuth2 access tokens.
+
+A small in-process LRU sits in front of a shared Django cache so that
+``get_oauth_token`` does not have to query the token table on every request.
+Entries never outlive ``CanvasOAuth2Token.expires`` minus
+``CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER``, so a cache hit never returns a token
+that should have been refreshed.  Users without a token are cached as
+negative entries for a short time, in the shared tier only: the OAuth callback
+can only clear the local tier of the process that handles it, so a local
+negative entry elsewhere would send the user back to Canvas right after
+authorizing.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.core.cache import caches
+from django.utils import timezone
+
+from canvas_oauth import settings as oauth_settings
+
+
+class CachedToken(namedtuple('CachedToken', ['access_token', 'expires'])):
+    """A cached token lookup.  Negative entries have no access token."""
+
+    @property
+    def missing(self):
+        return self.access_token is None
+
+
+NO_TOKEN = CachedToken(None, None)
+
+
+class LocalTokenCache(object):
+    """Thread-safe, size-bounded LRU with a per-entry time to live."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            deadline, value = entry
+            if deadline <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        if self.maxsize <= 0 or timeout <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TokenCache(object):
+    """
+    Caches ``(access_token, expires)`` per Canvas user and domain in a local
+    LRU tier backed by a shared Django cache tier.
+    """
+
+    def __init__(self, alias='default', timeout=300, negative_timeout=30,
+                 local_maxsize=1024, local_timeout=30,
+                 key_prefix='canvas_oauth:token'):
+        self.alias = alias
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.local_timeout = local_timeout
+        self.key_prefix = key_prefix
+        self.local = LocalTokenCache(local_maxsize)
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def make_key(self, user_id, domain):
+        return f"{self.key_prefix}:{domain}:{user_id}"
+
+    def get(self, user_id, domain):
+        """
+        Returns a CachedToken (possibly the negative NO_TOKEN entry), or None
+        when nothing usable is cached.
+        """
+        key = self.make_key(user_id, domain)
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        return self._fill_local(key, self.shared.get(key))
+
+    async def aget(self, user_id, domain):
+        """Async version of `get`, using the async cache API for the shared tier."""
+        key = self.make_key(user_id, domain)
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        return self._fill_local(key, await self.shared.aget(key))
+
+    def _fill_local(self, key, value):
+        if value is None:
+            return None
+        value = CachedToken(*value)
+        if value.missing:
+            # Negative entries are only trusted from the shared tier
+            return value
+        ttl = self._seconds_until_refresh(value.expires)
+        if ttl <= 0:
+            return None
+        self.local.set(key, value, min(self.local_timeout, ttl))
+        return value
+
+    def set(self, user_id, domain, access_token, expires):
+        """Cache a token until it is due to be refreshed."""
+        key = self.make_key(user_id, domain)
+        ttl = self._seconds_until_refresh(expires)
+        if ttl <= 0:
+            self.invalidate(user_id, domain)
+            return
+        value = CachedToken(access_token, expires)
+        self.shared.set(key, tuple(value), min(self.timeout, ttl))
+        self.local.set(key, value, min(self.local_timeout, ttl))
+
+    async def aset(self, user_id, domain, access_token, expires):
+        key = self.make_key(user_id, domain)
+        ttl = self._seconds_until_refresh(expires)
+        if ttl <= 0:
+            await self.ainvalidate(user_id, domain)
+            return
+        value = CachedToken(access_token, expires)
+        await self.shared.aset(key, tuple(value), min(self.timeout, ttl))
+        self.local.set(key, value, min(self.local_timeout, ttl))
+
+    def set_missing(self, user_id, domain):
+        """Cache the fact that a user has no stored token, in the shared tier."""
+        key = self.make_key(user_id, domain)
+        self.local.delete(key)
+        self.shared.set(key, tuple(NO_TOKEN), self.negative_timeout)
+
+    async def aset_missing(self, user_id, domain):
+        key = self.make_key(user_id, domain)
+        self.local.delete(key)
+        await self.shared.aset(key, tuple(NO_TOKEN), self.negative_timeout)
+
+    def invalidate(self, user_id, domain):
+        key = self.make_key(user_id, domain)
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    async def ainvalidate(self, user_id, domain):
+        key = self.make_key(user_id, domain)
+        self.local.delete(key)
+        await self.shared.adelete(key)
+
+    def _seconds_until_refresh(self, expires):
+        refresh_at = expires - oauth_settings.CANVAS_OAUTH_TOKEN_EXPIRATION_BUFFER
+        return int((refresh_at - timezone.now()).total_seconds())
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """
+    Returns the shared TokenCache configured by the CANVAS_OAUTH_TOKEN_CACHE_*
+    settings, or None if token caching is disabled.
+    """
+    global _token_cache
+    if not oauth_settings.CANVAS_OAUTH_TOKEN_CACHE_ENABLED:
+        return None
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                _token_cache = TokenCache(
+                    alias=oauth_settings.CANVAS_OAUTH_TOKEN_CACHE_ALIAS,
+                    timeout=oauth_settings.CANVAS_OAUTH_TOKEN_CACHE_TIMEOUT,
+                    negative_timeout=oauth_settings.CANVAS_OAUTH_TOKEN_CACHE_NEGATIVE_TIMEOUT,
+                    local_maxsize=oauth_settings.CANVAS_OAUTH_TOKEN_CACHE_LOCAL_MAXSIZE,
+                    local_timeout=oauth_settings.CANVAS_OAUTH_TOKEN_CACHE_LOCAL_TIMEOUT,
+                )
+    return _token_cache
+
+
+def invalidate_token(user_id, domain):
+    """Drop any cached token for the user; a no-op if caching is disabled."""
+    token_cache = get_token_cache()
+    if token_cache is not None:
+        token_cache.invalidate(user_id, domain)
+
+
+async def ainvalidate_token(user_id, domain):
+    """Async version of `invalidate_token`."""
+    token_cache = get_token_cache()
+    if token_cache is not None:
+        await token_cache.ainvalidate(user_id, domain)